@@ -1,8 +1,17 @@
-from django.db import models
-from django.db.models import Sum
+from itertools import chain
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes.generic import GenericForeignKey
+
+from object_permissions.registration import (permission_map,
+                                             get_model_perms)
+
 from ganeti_webmgr.utils.fields import SumIf
+from ganeti_webmgr.utils.models import QuerySetManager
 
 
 class ClusterUser(models.Model):
@@ -43,56 +52,29 @@ class ClusterUser(models.Model):
     def used_resources(self, cluster=None, only_running=True):
         """
         Return dictionary of total resources used by VMs that this ClusterUser
-        has perms to.
+        owns.  Totals are read from the ``ResourceUsage`` ledger.
         @param cluster  if set, get only VMs from specified cluster
-        @param only_running  if set, get only running VMs
+        @param only_running  if set, count ram and virtual cpus of running
+                             VMs only
         """
-        # XXX - order_by must be cleared or it breaks annotation grouping since
-        #       the default order_by field is also added to the group_by clause
-        base = self.virtual_machines.all().order_by()
-
-        # XXX - use a custom aggregate for ram and vcpu count when filtering by
-        # running.  this allows us to execute a single query.
-        #
-        # XXX - quotes must be used in this order.  postgresql quirk
         if only_running:
-            sum_ram = SumIf('ram', condition="status='running'")
-            sum_vcpus = SumIf('virtual_cpus', condition="status='running'")
+            ram, vcpus = 'running_ram', 'running_virtual_cpus'
         else:
-            sum_ram = Sum('ram')
-            sum_vcpus = Sum('virtual_cpus')
+            ram, vcpus = 'ram', 'virtual_cpus'
 
-        base = base.exclude(ram=-1, disk_size=-1, virtual_cpus=-1)
+        base = ResourceUsage.objects.filter(owner=self, vm_count__gt=0) \
+            .values('cluster', ram, 'disk', vcpus)
 
-        if cluster:
-            base = base.filter(cluster=cluster)
-            result = base.aggregate(ram=sum_ram, disk=Sum('disk_size'),
-                                    virtual_cpus=sum_vcpus)
-
-            # repack with zeros instead of Nones
-            if result['disk'] is None:
-                result['disk'] = 0
-            if result['ram'] is None:
-                result['ram'] = 0
-            if result['virtual_cpus'] is None:
-                result['virtual_cpus'] = 0
-            return result
-
-        else:
-            base = base.values('cluster').annotate(uram=sum_ram,
-                                                   udisk=Sum('disk_size'),
-                                                   uvirtual_cpus=sum_vcpus)
+        def repack(used):
+            return {'ram': used[ram], 'disk': used['disk'],
+                    'virtual_cpus': used[vcpus]}
 
-            # repack as dictionary
-            result = {}
-            for used in base:
-                # repack with zeros instead of Nones, change index names
-                used["ram"] = used.pop("uram") or 0
-                used["disk"] = used.pop("udisk") or 0
-                used["virtual_cpus"] = used.pop("uvirtual_cpus") or 0
-                result[used.pop('cluster')] = used
+        if cluster:
+            for used in base.filter(cluster=cluster):
+                return repack(used)
+            return {'ram': 0, 'disk': 0, 'virtual_cpus': 0}
 
-            return result
+        return dict((used['cluster'], repack(used)) for used in base)
 
 
 class Profile(ClusterUser):
@@ -152,3 +134,303 @@ class Organization(ClusterUser):
     def permissable(self):
         """ returns an object that can be granted permissions """
         return self.group
+
+
+class EffectivePermission(models.Model):
+    """
+    A flattened permission index: one row for every permission a User holds
+    on an object, whether granted directly or inherited from one of their
+    Groups.
+
+    object_permissions stores user and group grants separately, so every
+    lookup needs several joins.  This table is kept up to date incrementally
+    as permissions are granted and revoked and as group membership changes,
+    and lets permission lookups be answered with a single indexed query.
+    """
+    user = models.ForeignKey(User, related_name='effective_perms')
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+    obj = GenericForeignKey('content_type', 'object_id')
+    perm = models.CharField(max_length=32)
+
+    objects = QuerySetManager()
+
+    class Meta:
+        unique_together = (("user", "content_type", "object_id", "perm"),)
+
+    def __repr__(self):
+        return "<EffectivePermission: %s %s %s:%s>" % (
+            self.user_id, self.perm, self.content_type_id, self.object_id)
+
+    class QuerySet(QuerySet):
+
+        def for_model(self, model, perms=None):
+            """
+            Filter to permissions on instances of ``model``, optionally only
+            the given permissions.
+            """
+            ct = ContentType.objects.get_for_model(model)
+            qs = self.filter(content_type=ct)
+            if perms:
+                qs = qs.filter(perm__in=perms)
+            return qs
+
+        def object_ids(self, user, model, perms=None):
+            """
+            Ids of the instances of ``model`` on which ``user`` has any of
+            the given permissions, or any permission at all if ``perms`` is
+            empty.
+            """
+            return self.for_model(model, perms).filter(user=user) \
+                .order_by().values_list('object_id', flat=True).distinct()
+
+        def user_ids(self, obj, perms=None):
+            """
+            Ids of the users holding any of the given permissions on ``obj``.
+            """
+            return self.for_model(obj.__class__, perms) \
+                .filter(object_id=obj.pk) \
+                .order_by().values_list('user', flat=True).distinct()
+
+    @classmethod
+    def _members(cls, holder):
+        """ ids of the users a permission granted to ``holder`` applies to """
+        if isinstance(holder, (Group,)):
+            return set(holder.user_set.values_list('id', flat=True))
+        return set([holder.pk])
+
+    @classmethod
+    def grant(cls, holder, perm, obj):
+        """
+        Record that ``perm`` was granted on ``obj`` to a User or Group.
+        """
+        cls.grant_many(holder, perm, [obj])
+
+    @classmethod
+    def grant_many(cls, holder, perm, objs):
+        """
+        Record that ``perm`` was granted on several objects of the same model
+        to a User or Group, with the same queries as a single object.
+        """
+        objs = list(objs)
+        if not objs or objs[0].__class__ not in permission_map:
+            return
+        users = cls._members(holder)
+        ct = ContentType.objects.get_for_model(objs[0].__class__)
+        ids = [obj.pk for obj in objs]
+        existing = set(cls.objects.filter(content_type=ct, object_id__in=ids,
+                                          perm=perm, user__in=users)
+                       .values_list('object_id', 'user'))
+        cls.objects.bulk_create([
+            cls(user_id=user, content_type=ct, object_id=pk, perm=perm)
+            for pk in ids for user in users if (pk, user) not in existing
+        ])
+
+    @classmethod
+    def revoke(cls, holder, perm, obj):
+        """
+        Record that ``perm`` was revoked on ``obj`` from a User or Group.
+
+        Users keep the permission if it is still granted to them through
+        another route.  This is called before object_permissions updates its
+        own tables, so the grant being revoked is excluded explicitly.
+        """
+        model = obj.__class__
+        if model not in permission_map:
+            return
+        users = cls._members(holder)
+        grants = permission_map[model].objects.filter(obj=obj, **{perm: True})
+        if isinstance(holder, (Group,)):
+            direct = grants.filter(user__in=users)
+            via_groups = grants.filter(group__user__in=users) \
+                .exclude(group=holder)
+        else:
+            direct = grants.none()
+            via_groups = grants.filter(group__user__in=users)
+        retained = set(direct.values_list('user', flat=True))
+        retained.update(via_groups.values_list('group__user', flat=True))
+
+        ct = ContentType.objects.get_for_model(model)
+        cls.objects.filter(content_type=ct, object_id=obj.pk, perm=perm,
+                           user__in=users.difference(retained)).delete()
+
+    @classmethod
+    def rebuild(cls, users=None):
+        """
+        Recompute the index from the object_permissions tables.
+
+        @param users  ids of users to recompute, or None for everybody
+        """
+        stale = cls.objects.all()
+        if users is not None:
+            users = list(users)
+            stale = stale.filter(user__in=users)
+        stale.delete()
+
+        entries = set()
+        for model, perm_model in permission_map.items():
+            perms = get_model_perms(model)
+            ct = ContentType.objects.get_for_model(model)
+            direct = perm_model.objects.filter(user__isnull=False)
+            via_groups = perm_model.objects.filter(group__user__isnull=False)
+            if users is not None:
+                direct = direct.filter(user__in=users)
+                via_groups = via_groups.filter(group__user__in=users)
+
+            rows = chain(direct.values_list('user', 'obj', *perms),
+                         via_groups.values_list('group__user', 'obj', *perms))
+            for row in rows:
+                user, obj = row[:2]
+                for perm, enabled in zip(perms, row[2:]):
+                    if enabled:
+                        entries.add((user, ct.pk, obj, perm))
+
+        cls.objects.bulk_create([
+            cls(user_id=user, content_type_id=ct, object_id=obj, perm=perm)
+            for user, ct, obj, perm in entries
+        ])
+
+    @classmethod
+    def clear_object(cls, obj):
+        """ Drop all permissions on an object that was deleted """
+        ct = ContentType.objects.get_for_model(obj.__class__)
+        cls.objects.filter(content_type=ct, object_id=obj.pk).delete()
+
+
+class ResourceUsage(models.Model):
+    """
+    A ledger of the resources used by the VirtualMachines a ClusterUser owns
+    on one Cluster.
+
+    Quota checks used to sum all of the owner's VMs every time.  Instead the
+    totals are kept here and adjusted whenever a VirtualMachine is saved or
+    deleted, so a quota check reads a single row.  VMs whose resources are
+    all unknown (-1) are not counted.  ``rebuild()`` recomputes the ledger
+    from the VirtualMachine table if it ever drifts.
+    """
+    owner = models.ForeignKey(ClusterUser, related_name='resource_usage')
+    cluster = models.ForeignKey('clusters.Cluster', related_name='+')
+    vm_count = models.IntegerField(default=0)
+    ram = models.IntegerField(default=0)
+    disk = models.IntegerField(default=0)
+    virtual_cpus = models.IntegerField(default=0)
+    running_ram = models.IntegerField(default=0)
+    running_virtual_cpus = models.IntegerField(default=0)
+
+    FIELDS = ('vm_count', 'ram', 'disk', 'virtual_cpus', 'running_ram',
+              'running_virtual_cpus')
+
+    class Meta:
+        unique_together = (("owner", "cluster"),)
+
+    def __repr__(self):
+        return "<ResourceUsage: %s %s>" % (self.owner_id, self.cluster_id)
+
+    @classmethod
+    def usage_of(cls, vm):
+        """
+        What ``vm`` adds to the ledger.
+
+        @returns a tuple of ((owner id, cluster id), amounts), or None if the
+                 VM is not counted
+        """
+        if vm.owner_id is None or vm.cluster_id is None:
+            return None
+        if vm.ram == -1 and vm.disk_size == -1 and vm.virtual_cpus == -1:
+            return None
+        running = vm.status == 'running'
+        amounts = (1, vm.ram, vm.disk_size, vm.virtual_cpus,
+                   vm.ram if running else 0,
+                   vm.virtual_cpus if running else 0)
+        return (vm.owner_id, vm.cluster_id), amounts
+
+    @classmethod
+    def adjust(cls, key, amounts):
+        """
+        Add ``amounts`` to the ledger row for ``key``, an (owner id, cluster
+        id) tuple.  A missing row is created unless the amounts are being
+        taken away, in which case the owner or cluster is being deleted.
+        """
+        owner, cluster = key
+        rows = cls.objects.filter(owner=owner, cluster=cluster)
+        updates = dict((field, F(field) + amount)
+                       for field, amount in zip(cls.FIELDS, amounts))
+        if rows.update(**updates) or amounts[0] < 0:
+            return
+
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(owner_id=owner, cluster_id=cluster,
+                               **dict(zip(cls.FIELDS, amounts)))
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # created concurrently by somebody else
+            transaction.savepoint_rollback(sid)
+            rows.update(**updates)
+
+    @classmethod
+    def move(cls, old, new):
+        """
+        Replace a VM's previous contribution to the ledger with its current
+        one.  Both are values returned by ``usage_of()``.
+        """
+        if old == new:
+            return
+        if old and new and old[0] == new[0]:
+            cls.adjust(new[0], [n - o for n, o in zip(new[1], old[1])])
+            return
+        if old:
+            cls.adjust(old[0], [-amount for amount in old[1]])
+        if new:
+            cls.adjust(*new)
+
+    @classmethod
+    def rebuild(cls, owners=None, clusters=None):
+        """
+        Recompute the ledger from the VirtualMachine table.
+
+        @param owners  ids of ClusterUsers to recompute, or None for everybody
+        @param clusters  ids of Clusters to recompute, or None for all
+        @returns the number of rows that were out of date
+        """
+        # preventing circular import
+        from ganeti_webmgr.virtualmachines.models import VirtualMachine
+
+        stale = cls.objects.all()
+        vms = VirtualMachine.objects.filter(owner__isnull=False) \
+            .exclude(ram=-1, disk_size=-1, virtual_cpus=-1)
+        if owners is not None:
+            owners = list(owners)
+            stale = stale.filter(owner__in=owners)
+            vms = vms.filter(owner__in=owners)
+        if clusters is not None:
+            clusters = list(clusters)
+            stale = stale.filter(cluster__in=clusters)
+            vms = vms.filter(cluster__in=clusters)
+
+        # XXX - quotes must be used in this order.  postgresql quirk
+        totals = vms.order_by().values('owner', 'cluster').annotate(
+            uvm_count=Count('id'), uram=Sum('ram'), udisk=Sum('disk_size'),
+            uvirtual_cpus=Sum('virtual_cpus'),
+            urunning_ram=SumIf('ram', condition="status='running'"),
+            urunning_virtual_cpus=SumIf('virtual_cpus',
+                                        condition="status='running'"))
+        fresh = {}
+        for row in totals:
+            fresh[row['owner'], row['cluster']] = tuple(
+                row['u%s' % field] or 0 for field in cls.FIELDS)
+
+        current = {}
+        for row in stale.values_list('owner', 'cluster', *cls.FIELDS):
+            if any(row[2:]):
+                current[row[:2]] = row[2:]
+        drift = len([key for key in set(fresh).union(current)
+                     if fresh.get(key) != current.get(key)])
+
+        stale.delete()
+        cls.objects.bulk_create([
+            cls(owner_id=owner, cluster_id=cluster,
+                **dict(zip(cls.FIELDS, amounts)))
+            for (owner, cluster), amounts in fresh.items()
+        ])
+        return drift
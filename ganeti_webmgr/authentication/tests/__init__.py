@@ -1,2 +1,3 @@
 from .models import *
+from .permissions import *
 from .views import *
@@ -17,14 +17,15 @@
 
 
 from django.contrib.auth.models import User, Group
+from django.core.management import call_command
 from django.test import TestCase
 
 from ganeti_webmgr.utils.models import Quota
-from ..models import Profile, ClusterUser, Organization
+from ..models import Profile, ClusterUser, Organization, ResourceUsage
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
 from ganeti_webmgr.clusters.models import Cluster
 
-__all__ = ('TestClusterUser', 'TestProfileModel', )
+__all__ = ('TestClusterUser', 'TestProfileModel', 'TestResourceUsage', )
 
 
 class TestClusterUser(TestCase):
@@ -188,6 +189,77 @@ class TestClusterUser(TestCase):
         self.assertEqual(result["virtual_cpus"], 3)
 
 
+class TestResourceUsage(TestCase):
+
+    def setUp(self):
+        self.cluster = Cluster.objects.create(hostname="testing",
+                                              slug="testing")
+        self.owner = User.objects.create(username="owner").get_profile()
+        self.other = User.objects.create(username="other").get_profile()
+
+    def usage(self, owner):
+        return ResourceUsage.objects \
+            .filter(owner=owner, cluster=self.cluster) \
+            .values_list(*ResourceUsage.FIELDS)[0]
+
+    def test_ledger(self):
+        """
+        Saving and deleting VMs adjusts their owner's usage
+        """
+        vm = VirtualMachine(hostname="one", owner=self.owner,
+                            cluster=self.cluster, status="running",
+                            ram=2, virtual_cpus=3, disk_size=10)
+        vm.save()
+        VirtualMachine.objects.create(hostname="two", owner=self.owner,
+                                      cluster=self.cluster, status="stopped",
+                                      ram=1, virtual_cpus=1, disk_size=5)
+        # VMs without any known resources are not counted
+        VirtualMachine.objects.create(hostname="three", owner=self.owner,
+                                      cluster=self.cluster)
+        self.assertEqual((2, 3, 15, 4, 2, 3), self.usage(self.owner))
+
+        vm.status = "stopped"
+        vm.ram = 4
+        vm.save()
+        self.assertEqual((2, 5, 15, 4, 0, 0), self.usage(self.owner))
+
+        # reassigning the owner moves the resources
+        vm.owner = self.other
+        vm.save()
+        self.assertEqual((1, 1, 5, 1, 0, 0), self.usage(self.owner))
+        self.assertEqual((1, 4, 10, 3, 0, 0), self.usage(self.other))
+
+        vm.delete()
+        self.assertEqual((0, 0, 0, 0, 0, 0), self.usage(self.other))
+        self.assertEqual({}, self.other.used_resources())
+
+        with self.assertNumQueries(1):
+            used = self.owner.used_resources(self.cluster, only_running=False)
+        self.assertEqual({'ram': 1, 'disk': 5, 'virtual_cpus': 1}, used)
+
+    def test_rebuild(self):
+        """
+        Drift in the ledger is repaired by rebuilding it
+        """
+        VirtualMachine.objects.create(hostname="one", owner=self.owner,
+                                      cluster=self.cluster, status="running",
+                                      ram=2, virtual_cpus=3, disk_size=10)
+        VirtualMachine.objects.create(hostname="two", owner=self.other,
+                                      cluster=self.cluster, status="running",
+                                      ram=1, virtual_cpus=1, disk_size=5)
+        self.assertEqual(0, ResourceUsage.rebuild())
+
+        ResourceUsage.objects.filter(owner=self.owner).update(ram=100)
+        ResourceUsage.objects.filter(owner=self.other).delete()
+        self.assertEqual(2, ResourceUsage.rebuild())
+        self.assertEqual((1, 2, 10, 3, 2, 3), self.usage(self.owner))
+        self.assertEqual((1, 1, 5, 1, 1, 1), self.usage(self.other))
+
+        ResourceUsage.objects.all().delete()
+        call_command('reconcileusage', verbosity=0)
+        self.assertEqual((1, 2, 10, 3, 2, 3), self.usage(self.owner))
+
+
 class TestProfileModel(TestCase):
     def test_signal_listeners(self):
         """
@@ -0,0 +1,122 @@
+from django.contrib.auth.models import User, Group
+from django.test import TestCase
+
+from ..models import EffectivePermission
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
+
+__all__ = ('TestEffectivePermission', )
+
+
+class TestEffectivePermission(TestCase):
+
+    def setUp(self):
+        self.cluster = Cluster.objects.create(hostname='test.example.org',
+                                              slug='test')
+        self.vm = VirtualMachine.objects.create(hostname='vm.example.org',
+                                                cluster=self.cluster)
+        self.user = User.objects.create_user('tester', password='secret')
+        self.group = Group.objects.create(name='testing')
+
+    def tearDown(self):
+        self.vm.delete()
+        self.cluster.delete()
+        self.user.delete()
+        self.group.delete()
+
+    def perms(self, obj):
+        qs = EffectivePermission.objects.for_model(obj.__class__) \
+            .filter(user=self.user, object_id=obj.pk)
+        return sorted(qs.values_list('perm', flat=True))
+
+    def test_trivial(self):
+        pass
+
+    def test_user_grant_revoke(self):
+        self.user.grant('admin', self.cluster)
+        self.user.grant('tags', self.cluster)
+        self.assertEqual(['admin', 'tags'], self.perms(self.cluster))
+
+        self.user.revoke('admin', self.cluster)
+        self.assertEqual(['tags'], self.perms(self.cluster))
+
+        self.user.revoke_all(self.cluster)
+        self.assertEqual([], self.perms(self.cluster))
+
+    def test_set_perms(self):
+        self.user.set_perms(['power', 'modify'], self.vm)
+        self.assertEqual(['modify', 'power'], self.perms(self.vm))
+
+        self.user.set_perms(['remove'], self.vm)
+        self.assertEqual(['remove'], self.perms(self.vm))
+
+    def test_group_grant_revoke(self):
+        self.user.groups.add(self.group)
+        self.group.grant('admin', self.cluster)
+        self.assertEqual(['admin'], self.perms(self.cluster))
+
+        self.group.revoke('admin', self.cluster)
+        self.assertEqual([], self.perms(self.cluster))
+
+    def test_overlapping_grants(self):
+        """
+        Revoking one route to a permission keeps it if another remains.
+        """
+        self.user.groups.add(self.group)
+        self.user.grant('admin', self.cluster)
+        self.group.grant('admin', self.cluster)
+
+        self.user.revoke('admin', self.cluster)
+        self.assertEqual(['admin'], self.perms(self.cluster))
+
+        self.user.grant('admin', self.cluster)
+        self.group.revoke('admin', self.cluster)
+        self.assertEqual(['admin'], self.perms(self.cluster))
+
+    def test_group_membership(self):
+        self.group.grant('create_vm', self.cluster)
+        self.assertEqual([], self.perms(self.cluster))
+
+        self.group.user_set.add(self.user)
+        self.assertEqual(['create_vm'], self.perms(self.cluster))
+
+        self.user.groups.remove(self.group)
+        self.assertEqual([], self.perms(self.cluster))
+
+        self.user.groups.add(self.group)
+        self.group.user_set.clear()
+        self.assertEqual([], self.perms(self.cluster))
+
+    def test_group_deleted(self):
+        group = Group.objects.create(name='deleted')
+        group.user_set.add(self.user)
+        group.grant('admin', self.vm)
+        self.assertEqual(['admin'], self.perms(self.vm))
+
+        group.delete()
+        self.assertEqual([], self.perms(self.vm))
+
+    def test_object_deleted(self):
+        vm = VirtualMachine.objects.create(hostname='gone.example.org',
+                                           cluster=self.cluster)
+        self.user.grant('admin', vm)
+        self.assertEqual(['admin'], self.perms(vm))
+
+        vm.delete()
+        self.assertFalse(EffectivePermission.objects.for_model(VirtualMachine)
+                         .filter(object_id=vm.pk).exists())
+
+    def test_rebuild(self):
+        self.user.grant('admin', self.cluster)
+        self.user.groups.add(self.group)
+        self.group.grant('power', self.vm)
+
+        EffectivePermission.objects.all().delete()
+        EffectivePermission.rebuild()
+        self.assertEqual(['admin'], self.perms(self.cluster))
+        self.assertEqual(['power'], self.perms(self.vm))
+
+        EffectivePermission.objects.all().delete()
+        EffectivePermission.rebuild([self.user.pk])
+        self.assertEqual(['admin'], self.perms(self.cluster))
+        self.assertEqual(['power'], self.perms(self.vm))
@@ -18,6 +18,7 @@
 
 
 from django import forms
+from django.forms.fields import ChoiceField
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext as _
 
@@ -26,6 +27,42 @@ from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.authentication.models import ClusterUser
 
 
+class ClusterChoiceIterator(object):
+    """
+    Iterate over the choices of a ``ClusterChoiceField`` without creating
+    ``Cluster`` instances.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield (u"", self.field.empty_label)
+        for pk, hostname in self.field.queryset.values_list('pk', 'hostname'):
+            yield (pk, hostname)
+
+
+class ClusterChoiceField(forms.ModelChoiceField):
+    """
+    ModelChoiceField for clusters which builds its choices from the database
+    alone.
+
+    Creating a ``Cluster`` loads its cached info, which refreshes it from
+    Ganeti if the cache has expired.  Listing every cluster this way could
+    block rendering a form on one RAPI call per cluster, so choices are read
+    with ``values_list()`` instead.  Only the selected cluster is loaded, when
+    the form is cleaned.
+    """
+
+    def _get_choices(self):
+        if hasattr(self, '_choices'):
+            return self._choices
+        return ClusterChoiceIterator(self)
+
+    choices = property(_get_choices, ChoiceField._set_choices)
+
+
 class QuotaForm(forms.Form):
     """
     Form for editing user quota on a cluster
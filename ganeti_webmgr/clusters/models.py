@@ -1,6 +1,7 @@
 import binascii
 import re
 import cPickle
+import time
 from datetime import datetime, timedelta
 from hashlib import sha1
 
@@ -11,13 +12,23 @@ from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 
-from ganeti_webmgr.utils import get_rapi
+from ganeti_webmgr.utils import (bulk_update,
+                                 commit_on_success_unless_managed, get_rapi)
+from ganeti_webmgr.ganeti_web.caps import classify_version
 from ganeti_webmgr.utils.fields import (
     PatchedEncryptedCharField, PreciseDateTimeField, LowerCaseCharField
 )
 from ganeti_webmgr.utils.client import GanetiApiError
-from ganeti_webmgr.utils.models import Quota
+from ganeti_webmgr.utils.instrumentation import record_cache
+from ganeti_webmgr.utils.metrics import (CACHE_AGE, REFRESH_DURATION,
+                                         SYNC_DURATION)
+from ganeti_webmgr.utils.models import Quota, GanetiError
 
+# Columns of a VM parsed from its info by parse_persistent_info(), compared by
+# Cluster.refresh_virtual_machines() to find the VMs which changed.
+VM_REFRESH_FIELDS = ('mtime', 'ram', 'virtual_cpus', 'disk_size',
+                     'operating_system', 'status', 'primary_node',
+                     'secondary_node')
 
 class CachedClusterObject(models.Model):
     """
@@ -98,11 +109,18 @@ class CachedClusterObject(models.Model):
         epsilon = timedelta(0, 0, 0, settings.LAZY_CACHE_REFRESH)
 
         if self.id:
+            now = datetime.now()
+            if self.cached is not None:
+                age = now - self.cached
+                CACHE_AGE.observe(age.days * 86400 + age.seconds,
+                                  type=self.__class__.__name__)
             if (self.ignore_cache
                     or self.cached is None
-                    or datetime.now() > self.cached + epsilon):
+                    or now > self.cached + epsilon):
+                record_cache(self.__class__.__name__, False)
                 self.refresh()
             elif self.info:
+                record_cache(self.__class__.__name__, True)
                 self.parse_transient_info()
             else:
                 self.error = 'No Cached Info'
@@ -125,8 +143,14 @@ class CachedClusterObject(models.Model):
         If communication with Ganeti fails, an error will be stored in
         ``error``.
         """
-        from ganeti_webmgr.utils.models import GanetiError
+        start = time.time()
+        try:
+            self._refresh_info()
+        finally:
+            REFRESH_DURATION.observe(time.time() - start,
+                                     type=self.__class__.__name__)
 
+    def _refresh_info(self):
         job_data = self.check_job_status()
         for k, v in job_data.items():
             setattr(self, k, v)
@@ -178,7 +202,7 @@ class CachedClusterObject(models.Model):
         else:
             if self.error:
                 self.error = None
-                GanetiError.objects.clear_errors(obj=self)
+                GanetiError.clear_obj_errors(self)
 
     def _refresh(self):
         """
@@ -190,62 +214,52 @@ class CachedClusterObject(models.Model):
         raise NotImplementedError
 
     def check_job_status(self):
+        """
+        Refresh the pending jobs of this object's cluster, all at once, and
+        return the updates resulting from this object's jobs.
+
+        The jobs of other objects are completed along the way, so objects
+        loaded afterwards have nothing left to poll.  The jobs aren't
+        refreshed again for ``JOB_REFRESH_INTERVAL`` seconds.
+        """
         # preventing circular import
         from ganeti_webmgr.jobs.models import Job
+        from ganeti_webmgr.jobs.refresh import (jobs_refreshed,
+                                                refresh_cluster_jobs)
 
         if not self.last_job_id:
             return {}
 
         ct = ContentType.objects.get_for_model(self)
-        qs = Job.objects.filter(content_type=ct, object_id=self.pk)
-        jobs = qs.order_by("job_id")
-
-        updates = {}
-        status = 'unknown'
-        op = None
-
-        for job in jobs:
-            try:
-                data = self.rapi.GetJobStatus(job.job_id)
-
-                if Job.valid_job(data):
-                    op = Job.parse_op(data)
-                    status = data['status']
-
-            except GanetiApiError:
-                pass
-
-            if status in ('success', 'error'):
-                for k, v in Job.parse_persistent_info(data).items():
-                    setattr(job, k, v)
-
-            if status == 'unknown':
-                job.status = "unknown"
-                job.ignore_cache = False
-
-            if status in ('success', 'error', 'unknown'):
-                _updates = self._complete_job(self.cluster_id,
-                                              self.hostname, op, status)
-                # XXX if the delete flag is set in updates then delete this
-                # model this happens here because _complete_job cannot delete
-                # this model
-                if _updates:
-                    if 'deleted' in _updates:
-                        # Delete ourselves. Also delete the job that caused us
-                        # to delete ourselves; see #8439 for "fun" details.
-                        # Order matters; the job's deletion cascades over us.
-                        # Revisit that when we finally nuke all this caching
-                        # bullshit.
-                        self.delete()
-                        job.delete()
-                    else:
-                        updates.update(_updates)
-
-        # we only care about the very last job for resetting the cache flags
-        if not jobs or status in ('success', 'error', 'unknown'):
-            updates['ignore_cache'] = False
-            updates['last_job'] = None
-
+        if jobs_refreshed(self.cluster_id):
+            # this object's jobs were refreshed moments ago, along with the
+            # rest of the cluster's
+            results = {}
+        else:
+            results = refresh_cluster_jobs(self.cluster_id)
+        updates = results.get((ct.id, self.pk))
+        if updates is None:
+            jobs = Job.objects.filter(content_type=ct, object_id=self.pk)
+            if jobs.filter(ignore_cache=True).exists():
+                return {}
+            # completed earlier, while this object was already loaded, or
+            # left for this object to delete itself
+            updates = {}
+            for op, status in jobs.filter(pk=self.last_job_id) \
+                    .values_list('op', 'status'):
+                updates = self._complete_job(self.cluster_id, self.hostname,
+                                             op, status) or {}
+
+        if 'deleted' in updates:
+            # Delete ourselves. Also delete the job that caused us to delete
+            # ourselves; see #8439 for "fun" details.  Order matters; the
+            # job's deletion cascades over us.
+            last_job_id = self.last_job_id
+            self.delete()
+            Job.objects.filter(pk=last_job_id).delete()
+            updates = {}
+
+        updates.update(ignore_cache=False, last_job=None)
         return updates
 
     @classmethod
@@ -308,6 +322,9 @@ class Cluster(CachedClusterObject):
     password = PatchedEncryptedCharField(_('password'), default="",
                                          max_length=128, blank=True)
     hash = models.CharField(_('hash'), max_length=40, editable=False)
+    # class of the Ganeti version, see ganeti_web.caps
+    capability = models.PositiveSmallIntegerField(null=True, editable=False,
+                                                  db_index=True)
 
     # quota properties
     virtual_cpus = models.IntegerField(_('Virtual CPUs'), null=True,
@@ -336,6 +353,12 @@ class Cluster(CachedClusterObject):
     def get_absolute_url(self):
         return 'cluster-detail', (), {'cluster_slug': self.slug}
 
+    @classmethod
+    def parse_persistent_info(cls, info):
+        data = super(Cluster, cls).parse_persistent_info(info)
+        data['capability'] = classify_version(info.get('software_version'))
+        return data
+
     # XXX probably hax
     @property
     def cluster_id(self):
@@ -404,6 +427,10 @@ class Cluster(CachedClusterObject):
         if user is None:
             return self.get_default_quota()
 
+        cached = getattr(self, '_quota_cache', {})
+        if user.pk in cached:
+            return dict(cached[user.pk])
+
         # attempt to query user specific quota first. if it does not exist
         # then fall back to the default quota
         query = Quota.objects.filter(cluster=self, user=user)
@@ -424,6 +451,8 @@ class Cluster(CachedClusterObject):
         @param values: dictionary of values, or None to delete the quota
         """
 
+        getattr(self, '_quota_cache', {}).pop(user.pk, None)
+
         kwargs = {'cluster': self, 'user': user}
         if data is None:
             Quota.objects.filter(**kwargs).delete()
@@ -432,6 +461,35 @@ class Cluster(CachedClusterObject):
             quota.__dict__.update(data)
             quota.save()
 
+    def get_user_quotas(self, users):
+        """
+        Retrieve the quotas of many ClusterUsers on this cluster with a single
+        query.
+
+        @param users  ClusterUsers, or their ids
+        @returns dictionary of quotas keyed by ClusterUser id
+        """
+        ids = set(getattr(user, 'pk', user) for user in users)
+        quotas = dict((pk, self.get_default_quota()) for pk in ids)
+        if ids:
+            qs = Quota.objects.filter(cluster=self, user__in=ids)
+            for custom in qs.values('ram', 'disk', 'virtual_cpus', 'user'):
+                custom['default'] = 0
+                quotas[custom.pop('user')] = custom
+        return quotas
+
+    def prefetch_quotas(self, users):
+        """
+        Retrieve the quotas of many ClusterUsers at once and remember them, so
+        that ``get_quota()`` answers for them without a query.
+
+        The quotas are kept on this instance, so this should only be used on
+        short lived instances such as the cluster being displayed by a view.
+        """
+        if not hasattr(self, '_quota_cache'):
+            self._quota_cache = {}
+        self._quota_cache.update(self.get_user_quotas(users))
+
     @classmethod
     def get_quotas(cls, clusters=None, user=None):
         """ retrieve a bulk list of cluster quotas """
@@ -473,16 +531,25 @@ class Cluster(CachedClusterObject):
             * VMs no longer in ganeti are deleted
             * VMs missing from the database are added
         """
+        start = time.time()
+        try:
+            self._sync_virtual_machines(remove)
+        finally:
+            SYNC_DURATION.observe(time.time() - start,
+                                  cluster=self.hostname,
+                                  type='virtual_machines')
+
+    def _sync_virtual_machines(self, remove):
         # preventing circular imports
         from ganeti_webmgr.virtualmachines.models import VirtualMachine
 
         ganeti = self.instances()
         db = self.virtual_machines.all().values_list('hostname', flat=True)
 
-        # add VMs missing from the database
+        # add VMs missing from the database; they are filled in by the
+        # refresh below
         for hostname in filter(lambda x: unicode(x) not in db, ganeti):
-            vm = VirtualMachine.objects.create(cluster=self, hostname=hostname)
-            vm.refresh()
+            VirtualMachine.objects.create(cluster=self, hostname=hostname)
 
         # deletes VMs that are no longer in ganeti
         if remove:
@@ -495,8 +562,90 @@ class Cluster(CachedClusterObject):
         self.refresh_virtual_machines()
 
     def refresh_virtual_machines(self):
-        for vm in self.virtual_machines.all():
-            vm.refresh()
+        """
+        Refresh the cached info of every VM of this cluster from a single bulk
+        request.
+
+        Nodes are resolved from a map of this cluster's nodes, loaded once,
+        and the VMs are written in one transaction, a chunk of VMs per
+        UPDATE, instead of being loaded and saved one at a time.  VMs whose
+        stored columns all match their info only have their cache time
+        updated; their mtime alone isn't enough, as Ganeti doesn't update it
+        when an instance's state changes.  VMs missing from the cluster get
+        a 404 error, as they would refreshing themselves.
+
+        VMs with pending jobs still refresh themselves, since their jobs must
+        be completed.  VMs being deleted or created from templates are left
+        out, as ``VirtualMachine._refresh()`` doesn't fetch their info
+        either.
+        """
+        # preventing circular imports
+        from ganeti_webmgr.authentication.models import ResourceUsage
+        from ganeti_webmgr.ganeti_web.backend.queries import \
+            invalidate_used_resources
+        from ganeti_webmgr.nodes.models import Node
+        from ganeti_webmgr.virtualmachines.models import VirtualMachine
+
+        with GanetiError.batch() as batch:
+            for vm in self.virtual_machines.filter(ignore_cache=True):
+                vm.refresh()
+
+            vms = self.virtual_machines.filter(ignore_cache=False,
+                                               pending_delete=False,
+                                               template__isnull=True)
+            current = dict((row[0], row[1:]) for row in vms.values_list(
+                'hostname', 'id', 'owner', *VM_REFRESH_FIELDS))
+            if not current:
+                return
+
+            try:
+                infos = [info for info in self.rapi.GetInstances(bulk=True)
+                         if info['name'] in current]
+            except GanetiApiError as e:
+                GanetiError.store_error(str(e), obj=self, code=e.code)
+                return
+            nodes = dict(Node.objects.filter(cluster=self)
+                         .values_list('hostname', 'id'))
+
+            # values_list() returns the stored timestamps
+            to_datetime = VirtualMachine._meta.get_field('mtime').to_python
+            now = datetime.now()
+            changed = {}
+            unchanged = []
+            owners = set()
+            with commit_on_success_unless_managed():
+                for info in infos:
+                    row = current[info['name']]
+                    pk, owner = row[:2]
+                    stored = dict(zip(VM_REFRESH_FIELDS, row[2:]))
+                    stored['mtime'] = to_datetime(stored['mtime'])
+                    data = VirtualMachine.parse_persistent_info(info, nodes)
+                    if data == stored:
+                        unchanged.append(pk)
+                        continue
+                    if any(data[field] != stored[field]
+                           for field in ('ram', 'disk_size', 'virtual_cpus',
+                                         'status')):
+                        owners.add(owner)
+                    changed[pk] = dict(data, cached=now,
+                                       serialized_info=cPickle.dumps(info))
+                bulk_update(VirtualMachine, changed)
+                if unchanged:
+                    VirtualMachine.objects.filter(pk__in=unchanged) \
+                        .update(cached=now)
+                owners.discard(None)
+                if owners:
+                    # the ledger isn't maintained by queryset updates
+                    ResourceUsage.rebuild(owners=owners, clusters=[self.id])
+            invalidate_used_resources(*owners)
+
+            found = set(info['name'] for info in infos)
+            batch.clear_ids(VirtualMachine,
+                            [current[hostname][0] for hostname in found])
+            batch.store_ids(VirtualMachine,
+                            [row[0] for hostname, row in current.items()
+                             if hostname not in found],
+                            self.id, '404', 404)
 
     def sync_nodes(self, remove=False):
         """
@@ -505,6 +654,14 @@ class Cluster(CachedClusterObject):
             * Nodes no longer in ganeti are deleted
             * Nodes missing from the database are added
         """
+        start = time.time()
+        try:
+            self._sync_nodes(remove)
+        finally:
+            SYNC_DURATION.observe(time.time() - start, cluster=self.hostname,
+                                  type='nodes')
+
+    def _sync_nodes(self, remove):
         # to prevent circular imports
         from ganeti_webmgr.nodes.models import Node
 
@@ -512,9 +669,10 @@ class Cluster(CachedClusterObject):
         db = self.nodes.all().values_list('hostname', flat=True)
 
         # add Nodes missing from the database
-        for hostname in filter(lambda x: unicode(x) not in db, ganeti):
-            node = Node.objects.create(cluster=self, hostname=hostname)
-            node.refresh()
+        with GanetiError.batch():
+            for hostname in filter(lambda x: unicode(x) not in db, ganeti):
+                node = Node.objects.create(cluster=self, hostname=hostname)
+                node.refresh()
 
         # deletes Nodes that are no longer in ganeti
         if remove:
@@ -526,8 +684,9 @@ class Cluster(CachedClusterObject):
         self.refresh_nodes()
 
     def refresh_nodes(self):
-        for node in self.nodes.all():
-            node.refresh()
+        with GanetiError.batch():
+            for node in self.nodes.all():
+                node.refresh()
 
     @property
     def missing_in_ganeti(self):
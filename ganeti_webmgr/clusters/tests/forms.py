@@ -16,13 +16,15 @@
 # USA.
 
 
+from django import forms
 from django.test import TestCase
-from ..forms import EditClusterForm
+from ..forms import ClusterChoiceField, EditClusterForm
 
 from ..models import Cluster
 
 
-__all__ = ['TestClusterFormNew', 'TestClusterFormEdit']
+__all__ = ['TestClusterFormNew', 'TestClusterFormEdit',
+           'TestClusterChoiceField']
 
 
 class TestClusterFormBase(TestCase):
@@ -226,3 +228,57 @@ class TestClusterFormEdit(TestClusterFormBase):
         cluster = form.save()
         self.assertEqual('foo', cluster.username)
         self.assertEqual('bar', cluster.password)
+
+
+class TestClusterChoiceField(TestCase):
+
+    def setUp(self):
+        self.cluster = Cluster.objects.create(hostname='test.example.test',
+                                              slug='OSL_TEST')
+        self.cluster1 = Cluster.objects.create(hostname='test1.example.test',
+                                               slug='OSL_TEST1')
+
+        class Form(forms.Form):
+            cluster = ClusterChoiceField(queryset=Cluster.objects.all())
+        self.Form = Form
+
+        # count instances created to make sure clusters are not loaded
+        self.loaded = []
+        self.load_info = Cluster.load_info
+
+        def load_info(cluster):
+            self.loaded.append(cluster.pk)
+        Cluster.load_info = load_info
+
+    def tearDown(self):
+        Cluster.load_info = self.load_info
+        Cluster.objects.all().delete()
+
+    def test_choices(self):
+        """
+        Choices are listed from a single query without loading clusters
+        """
+        field = self.Form().fields['cluster']
+        with self.assertNumQueries(1):
+            choices = list(field.choices)
+        self.assertEqual([(u'', field.empty_label),
+                          (self.cluster.pk, self.cluster.hostname),
+                          (self.cluster1.pk, self.cluster1.hostname)],
+                         choices)
+        self.assertEqual([], self.loaded)
+
+        # rendering the form doesn't load any cluster either
+        self.assertTrue(self.cluster.hostname in unicode(self.Form()))
+        self.assertEqual([], self.loaded)
+
+    def test_clean(self):
+        """
+        Only the selected cluster is loaded
+        """
+        form = self.Form({'cluster': self.cluster1.pk})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(self.cluster1, form.cleaned_data['cluster'])
+        self.assertEqual([self.cluster1.pk], self.loaded)
+
+        form = self.Form({'cluster': -1})
+        self.assertFalse(form.is_valid())
@@ -16,18 +16,23 @@
 # USA.
 
 
+import cPickle
 from datetime import datetime
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TestCase
 
 from ganeti_webmgr.utils.proxy.constants import INFO, JOB_RUNNING, JOB
 
+from ganeti_webmgr.authentication.models import ResourceUsage
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
 from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.ganeti_web.caps import (FUTURE, GANETI25, GANETI26,
+                                           capable, has_balloonmem)
 from ganeti_webmgr.jobs.models import Job
 from ganeti_webmgr.nodes.models import Node
-from ganeti_webmgr.utils.models import Quota
+from ganeti_webmgr.utils.models import GanetiError, Quota
 
 
 __all__ = ['TestClusterModel']
@@ -35,6 +40,14 @@ __all__ = ['TestClusterModel']
 
 class TestClusterModel(TestCase):
 
+    def setUp(self):
+        # jobs are polled again right away
+        self.job_refresh_interval = settings.JOB_REFRESH_INTERVAL
+        settings.JOB_REFRESH_INTERVAL = 0
+
+    def tearDown(self):
+        settings.JOB_REFRESH_INTERVAL = self.job_refresh_interval
+
     def test_instantiation(self):
         """
         Test creating a Cluster Object
@@ -80,6 +93,28 @@ class TestClusterModel(TestCase):
 
         cluster.delete()
 
+    def test_capability(self):
+        """
+        Test the capability class is parsed from cached info and stored
+        """
+        cluster = Cluster(hostname='foo.fake.hostname', slug='foo')
+        cluster.save()
+        info = dict(INFO, software_version='2.6.0')
+        cluster.info = info
+        cluster.cached = datetime.now()
+        cluster.save()
+        self.assertEqual(GANETI26, cluster.capability)
+
+        cluster = Cluster.objects.get(pk=cluster.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(has_balloonmem(cluster))
+
+        qs = Cluster.objects.all()
+        self.assertEqual([cluster], list(capable(qs, GANETI25)))
+        self.assertEqual([], list(capable(qs, FUTURE)))
+
+        cluster.delete()
+
     def test_get_quota(self):
         """
         Tests cluster.get_quota() method
@@ -115,6 +150,39 @@ class TestClusterModel(TestCase):
         cluster.delete()
         user.delete()
 
+    def test_get_user_quotas(self):
+        """
+        Tests cluster.get_user_quotas() and cluster.prefetch_quotas()
+
+        Verifies:
+            * quotas of several users are retrieved with a single query
+            * users without a quota get the default quota
+            * prefetched quotas are used by get_quota() until set_quota()
+        """
+        default_quota = {'default': 1, 'ram': 1,
+                         'virtual_cpus': None, 'disk': 3}
+        user_quota = {'default': 0, 'ram': 4, 'virtual_cpus': 5, 'disk': None}
+
+        cluster = Cluster(hostname='foo.fake.hostname')
+        cluster.__dict__.update(default_quota)
+        cluster.save()
+        custom = User.objects.create(username='custom').get_profile()
+        default = User.objects.create(username='default').get_profile()
+        cluster.set_quota(custom, user_quota)
+
+        with self.assertNumQueries(1):
+            quotas = cluster.get_user_quotas([custom, default.pk])
+        self.assertEqual({custom.pk: user_quota, default.pk: default_quota},
+                         quotas)
+
+        cluster.prefetch_quotas([custom, default])
+        with self.assertNumQueries(0):
+            self.assertEqual(user_quota, cluster.get_quota(custom))
+            self.assertEqual(default_quota, cluster.get_quota(default))
+
+        cluster.set_quota(custom, None)
+        self.assertEqual(default_quota, cluster.get_quota(custom))
+
     def test_set_quota(self):
         """
         Tests cluster.set_quota()
@@ -202,6 +270,72 @@ class TestClusterModel(TestCase):
         vm_current.delete()
         cluster.delete()
 
+    def test_refresh_virtual_machines(self):
+        """
+        Tests refreshing the cached virtual machines of a cluster
+
+        Verifies:
+            * every VM is fetched with a single bulk request
+            * nodes are resolved from the nodes of the cluster
+            * VMs unchanged in ganeti only have their cache time updated
+            * state changes are refreshed even though the mtime is the same
+            * the owners' resource usage follows the refreshed VMs
+            * VMs missing from ganeti get a 404 error
+        """
+        cluster = Cluster.objects.create(hostname='ganeti.example.test')
+        node = Node.objects.create(cluster=cluster,
+                                   hostname='gtest1.example.bak')
+        owner = User.objects.create(username='owner').get_profile()
+        vm = VirtualMachine.objects.create(cluster=cluster, owner=owner,
+                                           hostname='gimager.example.bak')
+        missing = VirtualMachine.objects.create(
+            cluster=cluster, hostname='missing.example.bak')
+
+        rapi = cluster.rapi
+        rapi.GetInstances.reset()
+        rapi.GetInstance.reset()
+        cluster.refresh_virtual_machines()
+        rapi.GetInstances.assertCalled(self, bulk=True)
+        self.assertEqual(1, len(rapi.GetInstances.calls))
+        rapi.GetInstance.assertNotCalled(self)
+
+        vm = VirtualMachine.objects.get(pk=vm.pk)
+        self.assertEqual(node, vm.primary_node)
+        self.assertEqual(None, vm.secondary_node)
+        self.assertEqual((512, 2, 5120, 'running'),
+                         (vm.ram, vm.virtual_cpus, vm.disk_size, vm.status))
+        self.assertEqual('gimager.example.bak', vm.info['name'])
+        self.assertEqual(
+            (1, 512, 5120, 2, 512, 2),
+            ResourceUsage.objects.filter(owner=owner, cluster=cluster)
+            .values_list(*ResourceUsage.FIELDS)[0])
+        self.assertEqual(
+            [404],
+            list(GanetiError.objects.filter(obj_id=missing.pk, cleared=False)
+                 .values_list('code', flat=True)))
+
+        # unchanged VMs aren't written again
+        VirtualMachine.objects.filter(pk=vm.pk) \
+            .update(serialized_info=cPickle.dumps(None), cached=None)
+        cluster.refresh_virtual_machines()
+        info, cached = VirtualMachine.objects.filter(pk=vm.pk) \
+            .values_list('serialized_info', 'cached')[0]
+        self.assertTrue(cached)
+        self.assertFalse(cPickle.loads(str(info)))
+
+        # the status changes without the mtime
+        VirtualMachine.objects.filter(pk=vm.pk).update(status='ERROR_down')
+        ResourceUsage.rebuild(owners=[owner.pk], clusters=[cluster.pk])
+        cluster.refresh_virtual_machines()
+        info, status = VirtualMachine.objects.filter(pk=vm.pk) \
+            .values_list('serialized_info', 'status')[0]
+        self.assertEqual('running', status)
+        self.assertTrue(cPickle.loads(str(info)))
+        self.assertEqual(
+            (1, 512, 5120, 2, 512, 2),
+            ResourceUsage.objects.filter(owner=owner, cluster=cluster)
+            .values_list(*ResourceUsage.FIELDS)[0])
+
     def test_sync_nodes(self):
         """
         Tests synchronizing cached Nodes (stored in db) with info
@@ -380,6 +380,38 @@ class TestClusterViews(TestCase, ViewTestMixin, UserTestMixin):
         self.assertEquals('text/html; charset=utf-8', response['content-type'])
         self.assertTemplateUsed(response, 'ganeti/cluster/detail.html')
 
+    def test_view_available(self):
+        """
+        Tests the cluster availability check used by the VM wizard
+        """
+        url = '/cluster/%s/available/'
+        args = self.cluster.pk
+
+        # anonymous user
+        response = self.c.get(url % args, follow=True)
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, 'registration/login.html')
+
+        # unauthorized user
+        self.assertTrue(self.c.login(username=self.unauthorized.username,
+                                     password='secret'))
+        response = self.c.get(url % args)
+        self.assertEqual(404, response.status_code)
+
+        # authorized (permission)
+        self.assertTrue(self.c.login(username=self.cluster_admin.username,
+                                     password='secret'))
+        response = self.c.get(url % args)
+        self.assertEqual(200, response.status_code)
+        self.assertEquals('application/json', response['content-type'])
+        data = json.loads(response.content)
+        self.assertTrue(data['available'])
+        self.assertEqual(None, data['error'])
+
+        # invalid cluster
+        response = self.c.get(url % 0)
+        self.assertEqual(404, response.status_code)
+
     def test_view_users(self):
         """
         Tests view for cluster users:
@@ -45,6 +45,9 @@ urlpatterns = patterns(
     url(r'^(?P<id>\d+)/jobs/status/?$', "job_status",
         name="cluster-job-status"),
 
+    url(r'^cluster/(?P<id>\d+)/available/?$', "available",
+        name="cluster-available"),
+
     url(r'^%s/keys/(?P<api_key>[^/]+)/?$' % cluster, "ssh_keys",
         name="cluster-keys"),
 
@@ -36,9 +36,9 @@ from django.views.generic.detail import DetailView
 
 from django_tables2 import SingleTableView
 
-from object_permissions import get_users_any
+from object_permissions import get_users_any, get_users, get_groups
 from object_permissions import signals as op_signals
-from object_permissions.views.permissions import view_users, view_permissions
+from object_permissions.views.permissions import view_permissions
 
 from object_log.models import LogItem
 from object_log.views import list_for_object
@@ -312,9 +312,20 @@ def users(request, cluster_slug):
     if not (user.is_superuser or user.has_perm('admin', cluster)):
         raise PermissionDenied(NO_PRIVS)
 
+    # Same as object_permissions' view_users(), but the ClusterUsers and
+    # their quotas are fetched up front instead of once for every row.
+    users = list(get_users(cluster, groups=False).select_related('profile'))
+    groups = list(get_groups(cluster).select_related('organization'))
+    cluster.prefetch_quotas([u.profile for u in users]
+                            + [g.organization for g in groups])
+
     url = reverse('cluster-permissions', args=[cluster.slug])
-    return view_users(request, cluster, url,
-                      template='ganeti/cluster/users.html')
+    return render_to_response('ganeti/cluster/users.html',
+                              {'object': cluster,
+                               'users': users,
+                               'groups': groups,
+                               'url': url},
+                              context_instance=RequestContext(request))
 
 
 @login_required
@@ -440,14 +451,15 @@ def quota(request, cluster_slug, user_id):
 @login_required
 def job_status(request, id, rest=False):
     """
-    Return a list of basic info for running jobs.
+    Return a list of basic info for running jobs.  Only the summary of each
+    job is sent; see ``Job.status_info()``.
     """
 
     ct = ContentType.objects.get_for_model(Cluster)
     jobs = Job.objects.filter(status__in=("error", "running", "waiting"),
                               content_type=ct,
                               object_id=id).order_by('job_id')
-    jobs = [j.info for j in jobs]
+    jobs = [j.status_info() for j in jobs]
 
     if rest:
         return jobs
@@ -455,6 +467,27 @@ def job_status(request, id, rest=False):
         return HttpResponse(json.dumps(jobs), mimetype='application/json')
 
 
+@login_required
+def available(request, id, rest=False):
+    """
+    Report whether a cluster may be used to create virtual machines.
+
+    Loading the cluster refreshes its info from Ganeti if the cache has
+    expired.  The VM creation wizard calls this once a cluster is selected,
+    instead of loading every cluster it offers.
+    """
+    cluster = get_object_or_404(cluster_qs_for_user(request.user), pk=id)
+    data = {
+        'available': bool(cluster.info),
+        'error': unicode(cluster.error) if cluster.error else None,
+    }
+
+    if rest:
+        return data
+    else:
+        return HttpResponse(json.dumps(data), mimetype='application/json')
+
+
 @login_required
 def object_log(request, cluster_slug):
     """ displays object log for this cluster """
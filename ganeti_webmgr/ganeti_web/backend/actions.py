@@ -0,0 +1,273 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Power and migrate actions on many virtual machines at once.
+
+The VMs are never instantiated: their fields are read with a single query,
+permissions and quotas are checked for the whole selection, the RAPI
+requests are sent concurrently, and the resulting jobs, ``last_job``
+references and log entries are written in bulk.
+"""
+
+import cPickle
+from threading import Thread
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+# Per #6579, do not change this import without discussion.
+from django.utils import simplejson as json
+from django.utils.translation import ugettext as _
+
+from object_log.models import LogAction, LogItem
+
+from ganeti_webmgr.authentication.models import (EffectivePermission,
+                                                 ResourceUsage)
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.jobs.models import Job
+from ganeti_webmgr.utils import get_rapi, rapi_map
+from ganeti_webmgr.utils.instrumentation import propagate
+from ganeti_webmgr.utils.models import Quota
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
+
+# action -> (RAPI method, log action)
+POWER_ACTIONS = {
+    'startup': ('StartupInstance', 'VM_START'),
+    'shutdown': ('ShutdownInstance', 'VM_STOP'),
+    'shutdown_now': ('ShutdownInstance', 'VM_STOP'),
+    'reboot': ('RebootInstance', 'VM_REBOOT'),
+    'migrate': ('MigrateInstance', 'VM_MIGRATE'),
+}
+
+VM_FIELDS = ('id', 'hostname', 'cluster', 'cluster__slug', 'cluster__hash',
+             'owner', 'ram', 'virtual_cpus', 'status')
+
+
+def permitted_vm_ids(user, action, vm_ids):
+    """
+    Return the ids of the given VMs on which ``user`` may perform ``action``,
+    with a single query.
+
+    Power actions require admin or power on the VM, or admin on its cluster.
+    Migrating requires admin or migrate on the cluster.
+    """
+    vms = VirtualMachine.objects.filter(pk__in=vm_ids)
+    if not user.is_superuser:
+        if action == 'migrate':
+            clusters = EffectivePermission.objects.object_ids(
+                user, Cluster, ['admin', 'migrate'])
+            vms = vms.filter(cluster__in=clusters)
+        else:
+            clusters = EffectivePermission.objects.object_ids(
+                user, Cluster, ['admin'])
+            own = EffectivePermission.objects.object_ids(
+                user, VirtualMachine, ['admin', 'power'])
+            vms = vms.filter(Q(cluster__in=clusters) | Q(pk__in=own))
+    return set(vms.values_list('id', flat=True))
+
+
+def _over_quota(vms):
+    """
+    Check the VMs being started against the quotas of their owners.  The
+    quotas and usage of every (owner, cluster) pair are read at once, and
+    each VM started counts towards the ones after it.
+
+    @param vms  rows of ``VM_FIELDS`` as dictionaries
+    @returns a dictionary mapping the ids of VMs which can't be started to
+             an error message
+    """
+    owned = [vm for vm in vms if vm['owner'] is not None]
+    if not owned:
+        return {}
+    owners = set(vm['owner'] for vm in owned)
+    clusters = set(vm['cluster'] for vm in owned)
+
+    defaults = dict(
+        (row['id'], row) for row in Cluster.objects.filter(pk__in=clusters)
+        .values('id', 'ram', 'virtual_cpus'))
+    quotas = dict(
+        ((row['user'], row['cluster']), row) for row in Quota.objects
+        .filter(user__in=owners, cluster__in=clusters)
+        .values('user', 'cluster', 'ram', 'virtual_cpus'))
+    used = dict(
+        ((row['owner'], row['cluster']),
+         {'ram': row['running_ram'],
+          'virtual_cpus': row['running_virtual_cpus']})
+        for row in ResourceUsage.objects
+        .filter(owner__in=owners, cluster__in=clusters)
+        .values('owner', 'cluster', 'running_ram', 'running_virtual_cpus'))
+
+    errors = {}
+    for vm in owned:
+        key = (vm['owner'], vm['cluster'])
+        quota = quotas.get(key, defaults[vm['cluster']])
+        usage = used.setdefault(key, {'ram': 0, 'virtual_cpus': 0})
+        if quota['ram'] is not None \
+                and usage['ram'] + vm['ram'] > quota['ram']:
+            errors[vm['id']] = _('Owner does not have enough RAM remaining '
+                                 'on this cluster to start the virtual '
+                                 'machine.')
+        elif quota['virtual_cpus'] and usage['virtual_cpus'] \
+                + vm['virtual_cpus'] > quota['virtual_cpus']:
+            errors[vm['id']] = _('Owner does not have enough Virtual CPUs '
+                                 'remaining on this cluster to start the '
+                                 'virtual machine.')
+        else:
+            usage['ram'] += vm['ram']
+            usage['virtual_cpus'] += vm['virtual_cpus']
+    return errors
+
+
+def _submit(action, by_cluster, mode, cleanup):
+    """
+    Send the RAPI requests for every cluster concurrently.  Requests to a
+    single cluster are still limited by ``rapi_map()``.
+
+    @param by_cluster  dictionary mapping cluster ids to (hash, hostnames)
+    @returns a dictionary mapping (cluster id, hostname) to
+             (job id, error) tuples
+    """
+    method = POWER_ACTIONS[action][0]
+    if action == 'migrate':
+        kwargs = {'mode': mode, 'cleanup': cleanup}
+    elif action == 'shutdown_now':
+        kwargs = {'timeout': 0}
+    else:
+        kwargs = {}
+
+    submitted = {}
+
+    def submit(cluster_id, rapi, hostnames):
+        call = getattr(rapi, method)
+        for hostname, job_id, error in rapi_map(
+                cluster_id, lambda hostname: call(hostname, **kwargs),
+                hostnames):
+            submitted[cluster_id, hostname] = (job_id, error)
+
+    # clients are looked up here, since that may query the database
+    threads = [Thread(target=propagate(submit),
+                      args=(cluster_id, get_rapi(hash, cluster_id),
+                            hostnames))
+               for cluster_id, (hash, hostnames) in by_cluster.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return submitted
+
+
+def bulk_action(user, action, vm_ids, mode='live', cleanup=False):
+    """
+    Perform a power or migrate action on many virtual machines, which may
+    belong to different clusters.
+
+    VMs the user may not act on, VMs whose owner would exceed their quota
+    and VMs whose job couldn't be submitted are reported rather than
+    aborting the whole action.
+
+    @param action  one of ``POWER_ACTIONS``
+    @param mode  migration mode, only used when migrating
+    @param cleanup  clean up a previous migration, only used when migrating
+    @returns a list of dictionaries with the id, hostname and cluster slug of
+             each VM found, and either the id of the job submitted for it or
+             an error message
+    """
+    if action not in POWER_ACTIONS:
+        raise ValueError('Unknown action: %s' % action)
+
+    vms = list(VirtualMachine.objects.filter(pk__in=vm_ids)
+               .order_by('cluster', 'hostname').values(*VM_FIELDS))
+    permitted = permitted_vm_ids(user, action, [vm['id'] for vm in vms])
+
+    errors = {}
+    for vm in vms:
+        if vm['id'] not in permitted:
+            errors[vm['id']] = _('You do not have permission to perform '
+                                 'this action on the virtual machine')
+    if action == 'startup' and not user.is_superuser:
+        # superusers bypass quota checks
+        errors.update(_over_quota([vm for vm in vms
+                                   if vm['id'] not in errors]))
+
+    by_cluster = {}
+    for vm in vms:
+        if vm['id'] not in errors:
+            hostnames = by_cluster.setdefault(
+                vm['cluster'], (vm['cluster__hash'], []))[1]
+            hostnames.append(vm['hostname'])
+    submitted = _submit(action, by_cluster, mode, cleanup)
+
+    job_ids = {}
+    for vm in vms:
+        if vm['id'] in errors:
+            continue
+        job_id, error = submitted[vm['cluster'], vm['hostname']]
+        if error is None:
+            job_ids[vm['id']] = int(job_id)
+        else:
+            errors[vm['id']] = unicode(error)
+
+    if job_ids:
+        _record_jobs(user, action, [vm for vm in vms if vm['id'] in job_ids],
+                     job_ids)
+
+    return [{'id': vm['id'], 'hostname': vm['hostname'],
+             'cluster': vm['cluster__slug'],
+             'job_id': job_ids.get(vm['id']),
+             'error': errors.get(vm['id'])}
+            for vm in vms]
+
+
+def _record_jobs(user, action, vms, job_ids):
+    """
+    Create the jobs submitted for ``vms``, make them the VMs' last jobs and
+    log the action, in bulk.
+    """
+    # bulk_create() skips save(), so set what save() would have.
+    no_info = cPickle.dumps(None)
+    vm_type = ContentType.objects.get_for_model(VirtualMachine)
+    Job.objects.bulk_create([
+        Job(job_id=job_ids[vm['id']], content_type=vm_type,
+            object_id=vm['id'], cluster_id=vm['cluster'],
+            cluster_hash=vm['cluster__hash'], ignore_cache=True,
+            serialized_info=no_info)
+        for vm in vms])
+
+    # VMs may have older jobs with the same job id; the newest row is ours.
+    jobs = {}
+    for object_id, job_id, pk in Job.objects \
+            .filter(content_type=vm_type, object_id__in=job_ids.keys()) \
+            .order_by('id').values_list('object_id', 'job_id', 'id'):
+        if job_ids[object_id] == job_id:
+            jobs[object_id] = pk
+
+    VirtualMachine.objects.filter(pk__in=job_ids.keys()) \
+        .update(ignore_cache=True)
+    Job.objects.set_last_jobs(VirtualMachine, jobs.keys())
+
+    # The same data build_vm_cache() would have logged.
+    log = LogAction.objects.get_from_cache(POWER_ACTIONS[action][1])
+    job_type = ContentType.objects.get_for_model(Job)
+    LogItem.objects.bulk_create([
+        LogItem(action=log, user=user, object_type1=vm_type,
+                object_id1=vm['id'], object_type2=job_type,
+                object_id2=jobs[vm['id']],
+                serialized_data=json.dumps({
+                    'cluster_slug': vm['cluster__slug'],
+                    'hostname': vm['hostname'],
+                    'job_id': job_ids[vm['id']]}))
+        for vm in vms])
@@ -0,0 +1,171 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+A paginated timeline of ``GanetiError``s and failed ``Job``s.
+
+Both tables only ever grow, so the timeline is read a page at a time with
+keyset pagination: each page is described by the position of the last row
+of the previous one, and both tables are queried for the rows that come
+after it in timeline order, newest first.  Rows are read with ``values()``;
+no model instances (and in particular no ``Job.info``) are loaded.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.nodes.models import Node
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
+
+# Rows with the same timestamp are ordered by kind, then by id.
+ERROR = 1
+JOB = 0
+
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(row):
+    """
+    Return a cursor string pointing just after the given timeline row.
+    """
+    return '%s.%d.%d' % (row['timestamp'].strftime(CURSOR_TIME_FORMAT),
+                         row['kind'], row['id'])
+
+
+def decode_cursor(cursor):
+    """
+    Parse a cursor created by ``encode_cursor()``.
+
+    @raises ValueError  if the cursor is malformed
+    """
+    timestamp, kind, pk = cursor.split('.')
+    timestamp = datetime.strptime(timestamp, CURSOR_TIME_FORMAT)
+    kind = int(kind)
+    if kind not in (ERROR, JOB):
+        raise ValueError('Unknown row kind %d' % kind)
+    return timestamp, kind, int(pk)
+
+
+def _after(field, kind, cursor):
+    """
+    Build a filter selecting rows of one kind that come after the cursor in
+    timeline order.
+    """
+    timestamp, cursor_kind, pk = cursor
+    q = Q(**{'%s__lt' % field: timestamp})
+    if kind < cursor_kind:
+        q |= Q(**{field: timestamp})
+    elif kind == cursor_kind:
+        q |= Q(**{field: timestamp, 'pk__lt': pk})
+    return q
+
+
+def _rows(qs, kind, field, cursor, limit, fields):
+    """
+    Fetch up to ``limit`` rows of one kind as dictionaries in timeline order.
+    """
+    if cursor is not None:
+        qs = qs.filter(_after(field, kind, cursor))
+    qs = qs.order_by('-%s' % field, '-pk').values(*fields)[:limit]
+
+    rows = []
+    for row in qs:
+        row['kind'] = kind
+        row['timestamp'] = row.pop(field)
+        rows.append(row)
+    return rows
+
+
+def _timeline_key(row):
+    return (row['timestamp'], row['kind'], row['id'])
+
+
+def _add_objects(rows):
+    """
+    Attach the hostname and slugs needed to link to each row's object.  This
+    takes one query per type of object involved.
+    """
+    types = ContentType.objects.get_for_models(Cluster, VirtualMachine, Node)
+    cluster_type = types[Cluster].pk
+
+    ids = defaultdict(set)
+    for row in rows:
+        ids[row['obj_type']].add(row['obj_id'])
+        ids[cluster_type].add(row['cluster'])
+
+    objects = {}
+    for model, ct in types.items():
+        if not ids[ct.pk]:
+            continue
+        qs = model.objects.filter(pk__in=ids[ct.pk])
+        if model is Cluster:
+            values = qs.values('id', 'hostname', 'slug')
+        else:
+            values = qs.values('id', 'hostname', 'cluster__slug')
+        for value in values:
+            value['class'] = model.__name__
+            objects[ct.pk, value['id']] = value
+
+    for row in rows:
+        row['obj'] = objects.get((row['obj_type'], row['obj_id']))
+        cluster = objects.get((cluster_type, row['cluster']))
+        row['cluster_slug'] = cluster['slug'] if cluster else None
+
+
+def error_timeline(errors, jobs, before=None, limit=50):
+    """
+    Return one page of the merged timeline of errors and failed jobs.
+
+    @param errors  queryset of ``GanetiError``s to include
+    @param jobs    queryset of ``Job``s to include
+    @param before  cursor returned for the previous page, or None for the
+                   newest rows
+    @param limit   number of rows per page
+
+    @returns a tuple of (rows, cursor) where rows is a list of dictionaries
+             and cursor points to the next page, or is None if this is the
+             last one
+    """
+    cursor = decode_cursor(before) if before else None
+
+    # Fetch one row more than needed to find out whether there's a next page.
+    errors = _rows(errors, ERROR, 'timestamp', cursor, limit + 1,
+                   ('id', 'timestamp', 'msg', 'cleared', 'obj_type',
+                    'obj_id', 'cluster'))
+    jobs = _rows(jobs.filter(finished__isnull=False), JOB, 'finished',
+                 cursor, limit + 1,
+                 ('id', 'finished', 'job_id', 'op', 'content_type',
+                  'object_id', 'cluster'))
+    for row in jobs:
+        row['obj_type'] = row.pop('content_type')
+        row['obj_id'] = row.pop('object_id')
+
+    # each list holds at most limit + 1 rows, so merging them is cheap
+    rows = sorted(errors + jobs, key=_timeline_key, reverse=True)
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1])
+    else:
+        cursor = None
+
+    _add_objects(rows)
+    return rows, cursor
@@ -15,13 +15,19 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
-from django.db.models import Q
+from uuid import uuid4
 
-from object_permissions import get_users_any, get_groups_any
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from object_permissions import get_groups_any
 
 from ganeti_webmgr.clusters.models import Cluster
-from ganeti_webmgr.authentication.models import ClusterUser
+from ganeti_webmgr.authentication.models import (ClusterUser,
+                                                 EffectivePermission)
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
+from ganeti_webmgr.utils.instrumentation import record_cache
 
 
 def cluster_qs_for_user(user, groups=True, readonly=True, **kwargs):
@@ -32,6 +38,10 @@ def cluster_qs_for_user(user, groups=True, readonly=True, **kwargs):
         qs = Cluster.objects.all()
     elif user.is_anonymous():
         qs = Cluster.objects.none()
+    elif groups and not kwargs:
+        ids = EffectivePermission.objects.object_ids(user, Cluster,
+                                                     ['admin', 'create_vm'])
+        qs = Cluster.objects.filter(pk__in=ids)
     else:
         qs = user.get_objects_any_perms(Cluster, ['admin', 'create_vm'],
                                         groups=groups, **kwargs)
@@ -64,8 +74,9 @@ def admin_qs_for_cluster(cluster):
         profile__user__is_superuser=True)
 
     # Get all users who have the given permissions on the given cluster.
-    # This will include users who's groups have admin privs.
-    users = get_users_any(cluster, ["admin"], groups=True)
+    # The effective permission index includes users who's groups have admin
+    # privs.
+    users = EffectivePermission.objects.user_ids(cluster, ["admin"])
     # Get the actual groups themselves.
     groups = get_groups_any(cluster, ["admin"])
 
@@ -91,6 +102,10 @@ def owner_qs(cluster, user):
     if user.is_superuser:
         return owner_qs_for_superuser(cluster)
 
+    # The effective permission index can't answer these: it merges group
+    # grants into every member's permissions and doesn't record where they
+    # came from, while owners are chosen by who was granted the permission.
+    # Both are single lookups on one cluster's grants anyway.
     user_is_admin = user.has_any_perms(
         cluster, ['admin', 'create_vm'], groups=False
     )
@@ -115,7 +130,8 @@ def admin_group_qs(cluster, user):
     """
     # Get the list of groups the user is in
     users_groups = user.profile.user.groups.all().distinct()
-    # Get a list of groups which has admin on this cluster
+    # Get a list of groups which has admin on this cluster.  Group grants
+    # aren't in the effective permission index, see owner_qs().
     admin_groups = get_groups_any(cluster, ["admin", 'create_vm'])
     # Intersection: Which groups are both the users group and admin groups
     groups = users_groups & admin_groups
@@ -127,6 +143,28 @@ def owner_qs_for_superuser(cluster):
     return ClusterUser.objects.all().order_by('name')
 
 
+def accessible_vms_q(user, admin=False):
+    """
+    Return a Q object matching all virtual machines a user may access.
+
+    The permissions are looked up with subqueries of the effective permission
+    index, so the query never binds a list of ids, which could exceed the
+    parameter limits of some databases.
+
+    @param admin  only include VMs the user is an administrator of
+    """
+    # If no permissions are provided, then *any* permission will cause a VM
+    # to be added to the query.
+    perms = ["admin"] if admin else None
+    vm_ids = EffectivePermission.objects.object_ids(user, VirtualMachine,
+                                                    perms)
+    # Union of vms a user has any permissions to and vms a user has admin
+    # permissions to via cluster perms
+    cluster_ids = EffectivePermission.objects.object_ids(user, Cluster,
+                                                         ['admin'])
+    return Q(pk__in=vm_ids) | Q(cluster__in=cluster_ids)
+
+
 def vm_qs_for_admins(user):
     """
     Retrieve a queryset of all of the virtual machines for which this user is
@@ -138,9 +176,7 @@ def vm_qs_for_admins(user):
     elif user.is_anonymous():
         qs = VirtualMachine.objects.none()
     else:
-        qs = user.get_objects_any_perms(VirtualMachine, groups=True,
-                                        perms=["admin"])
-        qs |= cluster_vm_qs(user, ['admin'])
+        qs = VirtualMachine.objects.filter(accessible_vms_q(user, admin=True))
 
     return qs
 
@@ -155,18 +191,16 @@ def vm_qs_for_users(user, clusters=True):
         qs = VirtualMachine.objects.all()
     elif user.is_anonymous():
         qs = VirtualMachine.objects.none()
+    elif clusters:
+        # subqueries can't duplicate rows, so no DISTINCT is needed
+        qs = VirtualMachine.objects.filter(accessible_vms_q(user))
     else:
         # If no permissions are provided, then *any* permission will cause a VM
         # to be added to the query.
-        qs = user.get_objects_any_perms(VirtualMachine, groups=True)
-
-        # Add all VMs including VMs you have permission to via Cluster Perms
-        if clusters:
-            # Union of vms a user has any permissions to
-            # and vms a user has admin permissions to via cluster perms
-            qs |= cluster_vm_qs(user, ['admin'])
+        qs = user.get_objects_any_perms(VirtualMachine, groups=True) \
+            .distinct()
 
-    return qs.distinct()
+    return qs
 
 
 def cluster_vm_qs(user, perms=[], groups=True):
@@ -175,12 +209,128 @@ def cluster_vm_qs(user, perms=[], groups=True):
     through cluster permissions.
     """
     # first we get the IDs of the clusters which a user has perms to
-    cluster_ids = user.get_objects_any_perms(
-        Cluster, perms, groups
-    ).values_list('pk', flat=True)
+    if groups:
+        cluster_ids = EffectivePermission.objects.object_ids(user, Cluster,
+                                                             perms)
+    else:
+        cluster_ids = user.get_objects_any_perms(
+            Cluster, perms, groups
+        ).values_list('pk', flat=True)
     # # a queryset of VMs
     vms = VirtualMachine.objects.filter(
         cluster__pk__in=cluster_ids  # VMs we have perms to
-    ).distinct()
+    )
 
     return vms
+
+
+# Cache key for the resources used by a ClusterUser, as shown on the overview.
+# Every key embeds a generation token; replacing the token discards all of
+# them at once, without having to know which keys exist, when permissions
+# change.
+USED_RESOURCES_KEY = 'ganeti_web:used_resources:%s:%s'
+USED_RESOURCES_GENERATION_KEY = 'ganeti_web:used_resources:generation'
+
+USED_NOTHING = dict(disk=0, ram=0, virtual_cpus=0)
+
+
+def _used_resources_generation(timeout):
+    """
+    Return the current generation token for cached resource usage.
+    """
+    generation = cache.get(USED_RESOURCES_GENERATION_KEY)
+    if generation is None:
+        # add() so that concurrent processes agree on a single token
+        cache.add(USED_RESOURCES_GENERATION_KEY, uuid4().hex, timeout)
+        generation = cache.get(USED_RESOURCES_GENERATION_KEY)
+    return generation
+
+
+def invalidate_all_used_resources():
+    """
+    Discard the cached resource usage of every ClusterUser.
+
+    This is called whenever permissions, group memberships or the set of
+    clusters and virtual machines change.
+    """
+    timeout = settings.USED_RESOURCES_CACHE_TIMEOUT
+    if timeout:
+        cache.set(USED_RESOURCES_GENERATION_KEY, uuid4().hex, timeout)
+
+
+def invalidate_used_resources(*cluster_users):
+    """
+    Discard the cached resource usage of the given ClusterUser ids.  Ids that
+    are None are ignored.
+    """
+    timeout = settings.USED_RESOURCES_CACHE_TIMEOUT
+    if not timeout:
+        return
+    generation = _used_resources_generation(timeout)
+    keys = [USED_RESOURCES_KEY % (generation, pk)
+            for pk in cluster_users if pk is not None]
+    if keys:
+        cache.delete_many(keys)
+
+
+def get_used_resources(cluster_user):
+    """
+    Return the resources used by a ClusterUser's virtual machines, their
+    quota and how many of them are running, for every cluster the
+    ClusterUser has permissions on or owns virtual machines on.
+
+    The result is a dictionary keyed by ``Cluster``.  It is cached per
+    ClusterUser for ``USED_RESOURCES_CACHE_TIMEOUT`` seconds, and discarded
+    whenever permissions or one of the ClusterUser's virtual machines or
+    quotas change.  Only cluster ids are cached, never the clusters
+    themselves, which hold their RAPI credentials.
+    """
+    timeout = settings.USED_RESOURCES_CACHE_TIMEOUT
+    if timeout:
+        key = USED_RESOURCES_KEY % (_used_resources_generation(timeout),
+                                    cluster_user.pk)
+        resources = cache.get(key)
+        record_cache('used_resources', resources is not None)
+        if resources is not None:
+            clusters = Cluster.objects.filter(pk__in=resources.keys())
+            return dict((cluster, resources[cluster.pk])
+                        for cluster in clusters)
+
+    used = cluster_user.used_resources()
+
+    # one grouped query counts the VMs on every cluster at once
+    counts = {}
+    vms = cluster_user.virtual_machines.order_by() \
+        .values('cluster', 'status').annotate(count=Count('id'))
+    for row in vms:
+        total, running = counts.get(row['cluster'], (0, 0))
+        if row['status'] == 'running':
+            running += row['count']
+        counts[row['cluster']] = (total + row['count'], running)
+
+    clusters = cluster_user.permissable.get_objects_any_perms(Cluster)
+    quotas = Cluster.get_quotas(clusters, cluster_user)
+
+    # add any clusters that have used resources but no perms (and thus no
+    # quota).  since we know they don't have a custom quota just add the
+    # default quota
+    others = set(used).difference(c.id for c in quotas)
+    if others:
+        for cluster in Cluster.objects.filter(pk__in=others):
+            quotas[cluster] = cluster.get_default_quota()
+
+    resources = {}
+    for cluster, quota in quotas.items():
+        total, running = counts.get(cluster.id, (0, 0))
+        resources[cluster] = {
+            "used": used.get(cluster.id, USED_NOTHING),
+            "set": quota,
+            "total": total,
+            "running": running,
+        }
+
+    if timeout:
+        cache.set(key, dict((cluster.pk, values)
+                            for cluster, values in resources.items()),
+                  timeout)
+    return resources
@@ -23,15 +23,31 @@ These only depend on Django's ORM and not on any of the view or form
 machinery.
 """
 
+import cPickle
+import re
+
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+
 from object_log.models import LogItem
+from object_permissions.registration import permission_map
 
+from ganeti_webmgr.authentication.models import (EffectivePermission,
+                                                 ResourceUsage)
+from ganeti_webmgr.ganeti_web.backend.queries import (
+    invalidate_used_resources, invalidate_all_used_resources)
 from ganeti_webmgr.ganeti_web.caps import has_balloonmem
 from ganeti_webmgr.jobs.models import Job
+from ganeti_webmgr.utils import rapi_map
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
-from ganeti_webmgr.vm_templates.models import VirtualMachineTemplate
+from ganeti_webmgr.vm_templates.models import (InstanceBatch,
+                                               VirtualMachineTemplate)
 
 log_action = LogItem.objects.log_action
 
+# the run of '#' replaced by the instance number in batch hostname patterns
+HOSTNAME_NUMBER = re.compile('#+')
+
 
 def instance_to_template(vm, name):
     """
@@ -76,9 +92,13 @@ def instance_to_template(vm, name):
     return template
 
 
-def template_to_instance(template, hostname, owner):
+def _instance_params(template):
     """
-    Instantiate a VM template with a given hostname and owner.
+    Build the parameters used to create instances of a VM template.
+
+    @returns a tuple of (kwargs, fields): the keyword arguments for
+             ``CreateInstance`` and the field values of the new
+             ``VirtualMachine``
     """
 
     cluster = template.cluster
@@ -106,16 +126,17 @@ def template_to_instance(template, hostname, owner):
         hvparams.update(cdrom2_image_path=template.cdrom2_image_path)
         hvparams.update(serial_console=template.serial_console)
 
-    memory = template.memory
+    fields = {
+        "ram": template.memory,
+        "virtual_cpus": template.vcpus,
+        "disk_size": template.disks[0]["size"],
+    }
     if has_balloonmem(cluster):
-        minram = template.minmem
-        beparams['minmem'] = minram
-        beparams['maxmem'] = memory
+        fields['minram'] = template.minmem
+        beparams['minmem'] = template.minmem
+        beparams['maxmem'] = template.memory
     else:
-        beparams['memory'] = memory
-
-    vcpus = template.vcpus
-    disk_size = template.disks[0]["size"]
+        beparams['memory'] = template.memory
 
     kwargs = {
         "os": template.os,
@@ -144,22 +165,23 @@ def template_to_instance(template, hostname, owner):
             msg = 'Disk template set to drdb, but no secondary node set'
             raise RuntimeError(msg)
 
+    return kwargs, fields
+
+
+def template_to_instance(template, hostname, owner):
+    """
+    Instantiate a VM template with a given hostname and owner.
+    """
+
+    cluster = template.cluster
+    kwargs, fields = _instance_params(template)
+
     job_id = cluster.rapi.CreateInstance('create', hostname,
                                          template.disk_template,
                                          template.disks, template.nics,
                                          **kwargs)
-    vm = VirtualMachine()
-
-    vm.cluster = cluster
-    vm.hostname = hostname
-    vm.ram = memory
-    if has_balloonmem(cluster):
-        vm.minram = minram
-    vm.virtual_cpus = vcpus
-    vm.disk_size = disk_size
-
-    vm.owner = owner
-    vm.ignore_cache = True
+    vm = VirtualMachine(cluster=cluster, hostname=hostname, owner=owner,
+                        ignore_cache=True, **fields)
 
     # Do a dance to get the VM and the job referencing each other.
     vm.save()
@@ -172,3 +194,104 @@ def template_to_instance(template, hostname, owner):
     owner.permissable.grant('admin', vm)
 
     return vm
+
+
+def batch_hostnames(pattern, count, start=1):
+    """
+    Expand a hostname pattern into ``count`` hostnames.
+
+    The pattern must contain a single run of ``#`` characters, which is
+    replaced by the instance number padded with zeros to the length of the
+    run, e.g. ``web##.example.org`` gives ``web01.example.org``,
+    ``web02.example.org``, ...
+
+    @raises ValueError  if the pattern doesn't contain exactly one run of
+                        ``#``
+    """
+    runs = HOSTNAME_NUMBER.findall(pattern)
+    if len(runs) != 1:
+        raise ValueError("Hostname pattern must contain one run of '#'")
+    width = len(runs[0])
+    return [HOSTNAME_NUMBER.sub(str(i).zfill(width), pattern)
+            for i in xrange(start, start + count)]
+
+
+def template_to_instances(template, hostnames, owner, pattern=None):
+    """
+    Instantiate a VM template once for each of the given hostnames.
+
+    Creation jobs are submitted concurrently, within the per-cluster limit of
+    ``RAPI_CONCURRENCY``, and the resulting virtual machines and jobs are
+    stored with bulk inserts.  Hostnames Ganeti refuses are recorded as
+    failures of the batch rather than aborting it.
+
+    @param pattern  hostname pattern the hostnames were generated from, kept
+                    to describe the batch
+    @returns a tuple of (batch, vms): the ``InstanceBatch`` tracking the new
+             instances and the list of ``VirtualMachine``s created
+    """
+
+    cluster = template.cluster
+    kwargs, fields = _instance_params(template)
+    rapi = cluster.rapi
+
+    def create(hostname):
+        return rapi.CreateInstance('create', hostname, template.disk_template,
+                                   template.disks, template.nics, **kwargs)
+
+    results = rapi_map(cluster.pk, create, hostnames)
+    job_ids = dict((hostname, job_id)
+                   for hostname, job_id, error in results if error is None)
+    failures = [(hostname, unicode(error))
+                for hostname, job_id, error in results if error is not None]
+
+    batch = InstanceBatch.objects.create(
+        template=template, cluster=cluster, owner=owner,
+        hostname_pattern=pattern or ', '.join(hostnames),
+        count=len(hostnames), failures=failures)
+    if not job_ids:
+        return batch, []
+
+    # bulk_create() skips save(), so set what save() would have.
+    no_info = cPickle.dumps(None)
+    vms = [VirtualMachine(cluster=cluster, cluster_hash=cluster.hash,
+                          hostname=hostname, owner=owner, ignore_cache=True,
+                          serialized_info=no_info, **fields)
+           for hostname in job_ids]
+    VirtualMachine.objects.bulk_create(vms)
+    ids = dict(VirtualMachine.objects
+               .filter(cluster=cluster, hostname__in=job_ids.keys())
+               .values_list('hostname', 'id'))
+    for vm in vms:
+        vm.id = ids[vm.hostname]
+    ResourceUsage.rebuild(owners=[owner.pk], clusters=[cluster.pk])
+    invalidate_used_resources(owner.pk)
+
+    vm_type = ContentType.objects.get_for_model(VirtualMachine)
+    Job.objects.bulk_create([
+        Job(job_id=job_ids[vm.hostname], content_type=vm_type,
+            object_id=vm.id, cluster=cluster, cluster_hash=cluster.hash,
+            ignore_cache=True, serialized_info=no_info)
+        for vm in vms])
+    jobs = dict(Job.objects.filter(content_type=vm_type,
+                                   object_id__in=ids.values())
+                .values_list('object_id', 'id'))
+    Job.objects.set_last_jobs(VirtualMachine, ids.values())
+    for vm in vms:
+        vm.last_job_id = jobs[vm.id]
+    batch.jobs.add(*jobs.values())
+
+    # Grant admin permissions to the owner.  None of the VMs can have
+    # permissions yet, so the rows are inserted in bulk, and the effective
+    # permission index and caches are updated once for the whole batch
+    # instead of through a granted signal per VM.  Permission lookups
+    # memoized during this request can't involve the new VMs.
+    holder = owner.permissable
+    Permissions = permission_map[VirtualMachine]
+    key = 'group' if isinstance(holder, Group) else 'user'
+    Permissions.objects.bulk_create([
+        Permissions(obj=vm, admin=True, **{key: holder}) for vm in vms])
+    EffectivePermission.grant_many(holder, 'admin', vms)
+    invalidate_all_used_resources()
+
+    return batch, vms
@@ -0,0 +1,151 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Benchmarks of the pages and jobs whose cost grows with the size of the
+clusters being managed.
+
+Clusters are backed by ``SimulatedRapi``, so any number of nodes and
+instances can be simulated without a Ganeti cluster.  Every benchmark
+reports its wall clock time together with the number of database queries
+and RAPI requests it made; the counts don't depend on the machine the
+benchmark runs on, which makes them the better measure for spotting
+regressions.
+
+The benchmarks create their own clusters, virtual machines and user, so they
+must be run against an empty database.  The ``benchmark`` management command
+takes care of creating and destroying a test database.
+"""
+
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.utils import RAPI_REGISTRY
+from ganeti_webmgr.utils.proxy import SimulatedRapi
+
+BENCHMARK_USER = 'benchmark'
+
+
+def create_clusters(count, nodes, instances, latency=0, jitter=0):
+    """
+    Create clusters whose RAPI clients are ``SimulatedRapi``s.
+
+    @returns a list of (cluster, rapi) tuples
+    """
+    clusters = []
+    for i in xrange(count):
+        hostname = 'cluster%02d.benchmark.test' % i
+        cluster = Cluster.objects.create(hostname=hostname,
+                                         slug='cluster%02d' % i)
+        rapi = SimulatedRapi(hostname, nodes=nodes, instances=instances,
+                             latency=latency, jitter=jitter, seed=i)
+        RAPI_REGISTRY.add(cluster.id, cluster.hash, rapi)
+        clusters.append((cluster, rapi))
+    return clusters
+
+
+def measure(name, func, rapis, repeat=1):
+    """
+    Time ``func``, running it ``repeat`` times.
+
+    Query and request counts are those of the last run; the first run may
+    warm up caches that later runs benefit from.
+
+    @returns a dictionary with the name, the fastest and mean times in
+             seconds, and the number of queries and RAPI requests
+    """
+    times = []
+    for i in xrange(repeat):
+        for rapi in rapis:
+            rapi.reset()
+        del connection.queries[:]
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    return {
+        'name': name,
+        'seconds': min(times),
+        'mean': sum(times) / len(times),
+        'queries': len(connection.queries),
+        'rapi_calls': sum(rapi.total_calls for rapi in rapis),
+    }
+
+
+def run_benchmarks(clusters=1, nodes=10, instances=100, latency=0, jitter=0,
+                   repeat=3):
+    """
+    Simulate ``clusters`` clusters of ``nodes`` nodes and ``instances``
+    instances each, and benchmark syncing, refreshing and viewing them.
+
+    @param latency  seconds each RAPI request takes
+    @param jitter   maximum random variation of the latency, in seconds
+    @param repeat   number of times each benchmark is run, except the
+                    initial sync which populates the database
+    @returns a list of results as returned by ``measure()``
+    """
+    created = create_clusters(clusters, nodes, instances, latency, jitter)
+    rapis = [rapi for cluster, rapi in created]
+    slug = created[0][0].slug
+
+    User.objects.create_superuser(BENCHMARK_USER, '', BENCHMARK_USER)
+    client = Client()
+    client.login(username=BENCHMARK_USER, password=BENCHMARK_USER)
+
+    def sync():
+        for cluster, rapi in created:
+            cluster.sync_nodes()
+            cluster.sync_virtual_machines()
+
+    def refreshcache():
+        call_command('refreshcache', verbosity=0)
+
+    def page(url):
+        def get():
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError('%s returned %d'
+                                   % (url, response.status_code))
+        return get
+
+    pages = (
+        ('overview', reverse('overview')),
+        ('vm list', reverse('virtualmachine-list')),
+        ('cluster detail', reverse('cluster-detail', args=[slug])),
+        ('node table', reverse('cluster-nodes', args=[slug])),
+    )
+
+    # queries are only recorded by debug cursors
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        results = [measure('sync', sync, rapis),
+                   measure('refreshcache', refreshcache, rapis, repeat)]
+        for name, url in pages:
+            results.append(measure(name, page(url), rapis, repeat))
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+        for cluster, rapi in created:
+            RAPI_REGISTRY.invalidate(cluster.id)
+
+    return results
@@ -36,17 +36,29 @@ x.y.z (major.minor.patch) versioning pattern.
 
 def classify(cluster):
     """
-    Determine the class of a cluster by examining its version.
+    Determine the class of a cluster.
+
+    Clusters store their class in ``Cluster.capability`` when their info is
+    refreshed, so it can be read without unpickling the info.  Objects
+    without a stored class are classified by examining their version.
     """
 
-    # Extract the version string from the cluster.
-    s = cluster.info["software_version"]
+    capability = getattr(cluster, "capability", None)
+    if capability is not None:
+        return capability
+    return classify_version(cluster.info["software_version"])
+
+
+def classify_version(s):
+    """
+    Determine the class of a cluster from its version string.
+    """
 
     # First, try the whole splitting thing. If we can't do it that way, assume
     # it's ancient.
     try:
         version = tuple(int(x) for x in s.split("."))
-    except ValueError:
+    except (AttributeError, ValueError):
         return ANCIENT
 
     if version >= (2, 7, 0):
@@ -67,6 +79,14 @@ def classify(cluster):
         return ANCIENT
 
 
+def capable(clusters, capability):
+    """
+    Filter a queryset of clusters down to those of the given class or newer.
+    """
+
+    return clusters.filter(capability__gte=capability)
+
+
 def has_shutdown_timeout(cluster):
     """
     Determine whether a cluster supports timeouts for shutting down VMs.
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from ganeti_webmgr.jobs.archive import archivable_jobs, archive_jobs
+
+
+class Command(NoArgsCommand):
+    help = ("Moves jobs which finished more than JOB_ARCHIVE_DAYS days ago "
+            "to the job archive, in batches.  Jobs which are still the last "
+            "job of a cluster, node or virtual machine are kept.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', default=None,
+                    help='Archive jobs which finished more than this many '
+                         'days ago.  Defaults to JOB_ARCHIVE_DAYS.'),
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of jobs archived per transaction.'),
+        make_option('--sleep', type='float', default=0,
+                    help='Seconds to wait between batches.'),
+        make_option('--prune', action='store_true', default=False,
+                    help='Delete the jobs instead of archiving them.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only count the jobs which would be archived.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+        days = options['days']
+        if days is None:
+            days = settings.JOB_ARCHIVE_DAYS
+        before = datetime.now() - timedelta(days=days)
+
+        if options['dry_run']:
+            count = archivable_jobs(before).count()
+            verb = 'would be'
+        else:
+            count = archive_jobs(before, batch_size=options['batch_size'],
+                                 delay=options['sleep'],
+                                 prune=options['prune'])
+            verb = 'were'
+
+        if verbosity > 0:
+            action = 'deleted' if options['prune'] else 'archived'
+            self.stdout.write('%d jobs %s %s.\n' % (count, verb, action))
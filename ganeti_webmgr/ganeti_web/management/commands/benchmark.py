@@ -0,0 +1,67 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import (setup_test_environment,
+                               teardown_test_environment)
+
+from south.management.commands import patch_for_test_db_setup
+
+from ganeti_webmgr.ganeti_web.benchmark import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks syncing, refreshing and viewing simulated clusters "
+            "of the given size.  A test database is created for the run and "
+            "destroyed afterwards.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clusters', type='int', default=1,
+                    help='Number of clusters to simulate.'),
+        make_option('--nodes', type='int', default=10,
+                    help='Number of nodes in each cluster.'),
+        make_option('--instances', type='int', default=100,
+                    help='Number of instances in each cluster.'),
+        make_option('--latency', type='float', default=0,
+                    help='Milliseconds each RAPI request takes.'),
+        make_option('--jitter', type='float', default=0,
+                    help='Maximum random variation of the latency, in '
+                         'milliseconds.'),
+        make_option('--repeat', type='int', default=3,
+                    help='Number of times each benchmark is run.'),
+        make_option('--json', action='store_true', default=False,
+                    help='Print the results as JSON.'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True,
+                    help='Destroy an old test database without asking.'),
+    )
+
+    def handle(self, **options):
+        setup_test_environment()
+        patch_for_test_db_setup()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=not options['interactive'])
+        try:
+            results = run_benchmarks(
+                clusters=options['clusters'], nodes=options['nodes'],
+                instances=options['instances'],
+                latency=options['latency'] / 1000.0,
+                jitter=options['jitter'] / 1000.0,
+                repeat=options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2) + '\n')
+            return
+
+        self.stdout.write('%-16s %10s %10s %8s %10s\n' % (
+            'benchmark', 'best (ms)', 'mean (ms)', 'queries', 'rapi calls'))
+        for result in results:
+            self.stdout.write('%-16s %10.1f %10.1f %8d %10d\n' % (
+                result['name'], result['seconds'] * 1000,
+                result['mean'] * 1000, result['queries'],
+                result['rapi_calls']))
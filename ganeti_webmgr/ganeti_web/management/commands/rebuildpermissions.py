@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+
+from ganeti_webmgr.authentication.models import EffectivePermission
+from ganeti_webmgr.ganeti_web.backend.queries import (
+    invalidate_all_used_resources)
+
+
+class Command(NoArgsCommand):
+    help = ("Rebuilds the effective permission index from user and group "
+            "permissions.")
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+
+        EffectivePermission.rebuild()
+        invalidate_all_used_resources()
+
+        if verbosity > 0:
+            count = EffectivePermission.objects.count()
+            self.stdout.write('Indexed %d effective permissions.\n' % count)
@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.virtualmachines.tags import reconcile_owner_tags
+
+
+class Command(NoArgsCommand):
+    help = ("Fixes the owner tags of instances whose cached tags disagree "
+            "with the owner of their virtual machine, a cluster at a time.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--cluster', default=None,
+                    help='Only reconcile the cluster with this hostname.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only count the instances which would be fixed.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+
+        clusters = Cluster.objects.exclude(username='')
+        if options['cluster']:
+            clusters = clusters.filter(hostname=options['cluster'])
+
+        for cluster_id, hostname in clusters.values_list('id', 'hostname'):
+            fixed, failed = reconcile_owner_tags(cluster_id,
+                                                 dry_run=options['dry_run'])
+            if verbosity > 0:
+                verb = 'would be' if options['dry_run'] else 'were'
+                self.stdout.write('%s: %d instances %s fixed, %d failed.\n'
+                                  % (hostname, fixed, verb, failed))
@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+
+from ganeti_webmgr.authentication.models import ResourceUsage
+
+
+class Command(NoArgsCommand):
+    help = ("Recomputes the resource usage ledger used for quota checks from "
+            "the virtual machines in the database.")
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+
+        drift = ResourceUsage.rebuild()
+
+        if verbosity > 0:
+            self.stdout.write('Corrected %d resource usage totals.\n' % drift)
@@ -3,9 +3,25 @@
 
 # This module provides middleware which Django is too wimpy to provide itself.
 
+import json
+import logging
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.middleware import get_user
+from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
+from django.db import connections
+from django.db.models import Model, signals as model_signals
 from django.http import HttpResponseForbidden
 from django.template import RequestContext, loader
+from django.utils.functional import SimpleLazyObject
+
+from object_permissions import signals as op_signals
+
+from ganeti_webmgr.utils import instrumentation
+
+request_logger = logging.getLogger('ganeti_webmgr.requests')
 
 
 def render_403(request, message):
@@ -29,3 +45,160 @@ class PermissionDeniedMiddleware(object):
     def process_exception(self, request, e):
         if isinstance(e, PermissionDenied):
             return render_403(request, ", ".join(e.args))
+
+
+# Permission lookups on User which are memoized for the duration of a request.
+MEMOIZED_PERMISSION_METHODS = ('has_perm', 'has_any_perms', 'has_all_perms',
+                               'get_perms', 'get_perms_any')
+
+# Bumped whenever permissions or group memberships change, so that a request
+# which edits permissions never sees its own stale lookups.
+_permission_generation = [0]
+
+
+def _bump_permission_generation(sender, **kwargs):
+    _permission_generation[0] += 1
+
+op_signals.granted.connect(_bump_permission_generation)
+op_signals.revoked.connect(_bump_permission_generation)
+model_signals.m2m_changed.connect(_bump_permission_generation,
+                                  sender=User.groups.through)
+
+
+def _cache_key(value):
+    """
+    Reduce an argument of a permission lookup to a hashable key.  Objects
+    are keyed by type and id; lists of permissions are unordered.
+    """
+    if isinstance(value, (Model,)):
+        return value.__class__, value.pk
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+def _memoize(cache, name, method):
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if cache['generation'] != _permission_generation[0]:
+            cache.clear()
+            cache['generation'] = _permission_generation[0]
+
+        key = (name, tuple(_cache_key(arg) for arg in args),
+               frozenset((k, _cache_key(v)) for k, v in kwargs.items()))
+        try:
+            hash(key)
+        except TypeError:
+            # unhashable arguments; don't memoize
+            return method(*args, **kwargs)
+
+        if key not in cache:
+            cache[key] = method(*args, **kwargs)
+        result = cache[key]
+
+        # don't hand out the cached list itself; callers may modify it.
+        if isinstance(result, (list,)):
+            return list(result)
+        return result
+
+    return wrapper
+
+
+def memoize_permissions(user):
+    """
+    Memoize permission lookups on a single User instance.
+
+    Lookups are keyed by method, object type and id, and set of permissions.
+    Because the memo lives on the instance it should only be used for
+    short-lived users such as ``request.user``.
+    """
+    if not user.is_authenticated() or hasattr(user, '_perm_cache'):
+        return user
+
+    cache = user._perm_cache = {'generation': _permission_generation[0]}
+    for name in MEMOIZED_PERMISSION_METHODS:
+        setattr(user, name, _memoize(cache, name, getattr(user, name)))
+    return user
+
+
+class PermissionCacheMiddleware(object):
+    """
+    Middleware which memoizes permission lookups on ``request.user`` for the
+    duration of the request, so views and template tags asking the same
+    question repeatedly only hit the database once.
+
+    Must come after ``AuthenticationMiddleware``.
+    """
+
+    def process_request(self, request):
+        request.user = SimpleLazyObject(
+            lambda: memoize_permissions(get_user(request)))
+
+
+class RequestStatsMiddleware(object):
+    """
+    Middleware which records the database queries, RAPI requests and cache
+    lookups made by each request.
+
+    The stats of every request are logged as JSON to the
+    ``ganeti_webmgr.requests`` logger and added to the totals of its view.
+    If ``REQUEST_STATS_HEADERS`` is set they are also returned in
+    ``X-GWM-*`` response headers.
+
+    Queries are only recorded by debug cursors, which keep the SQL of every
+    query, so unless ``DEBUG`` is set they are only switched on for the
+    duration of the request if ``REQUEST_STATS_QUERIES`` is set.  Should
+    come first so that the time spent in other middleware is included.
+    """
+
+    def process_request(self, request):
+        request._stats = instrumentation.start_request()
+        request._stats_view = None
+        request._stats_queries = []
+        for connection in connections.all():
+            request._stats_queries.append((connection,
+                                           connection.use_debug_cursor,
+                                           len(connection.queries)))
+            if settings.REQUEST_STATS_QUERIES:
+                connection.use_debug_cursor = True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._stats_view = '%s.%s' % (view_func.__module__,
+                                         getattr(view_func, '__name__',
+                                                 view_func.__class__.__name__))
+
+    def process_response(self, request, response):
+        stats = getattr(request, '_stats', None)
+        if stats is None:
+            return response
+        instrumentation.end_request()
+
+        for connection, use_debug_cursor, start in request._stats_queries:
+            stats.add_queries(connection.queries[start:])
+            connection.use_debug_cursor = use_debug_cursor
+            if not (use_debug_cursor or
+                    (use_debug_cursor is None and settings.DEBUG)):
+                # don't keep queries around that Django wouldn't have kept
+                del connection.queries[start:]
+
+        view = request._stats_view or 'unresolved'
+        instrumentation.add_to_totals(view, stats)
+
+        data = stats.as_dict()
+        if request_logger.isEnabledFor(logging.INFO):
+            data.update(method=request.method, path=request.path,
+                        view=view, status=response.status_code)
+            request_logger.info(json.dumps(data, sort_keys=True))
+
+        if settings.REQUEST_STATS_HEADERS:
+            response['X-GWM-Time'] = '%.6f' % stats.seconds
+            response['X-GWM-DB'] = '%d; time=%.6f' % (stats.queries,
+                                                       stats.query_time)
+            response['X-GWM-RAPI'] = '%d; time=%.6f' % (stats.rapi_calls,
+                                                         stats.rapi_time)
+            response['X-GWM-Cache'] = 'hits=%d; misses=%d' % (
+                stats.cache_hits, stats.cache_misses)
+            response['X-GWM-RAPI-Clusters'] = json.dumps(
+                data['rapi']['clusters'], sort_keys=True)
+        return response
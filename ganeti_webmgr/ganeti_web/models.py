@@ -23,7 +23,8 @@ from django.contrib.auth.models import User, Group
 from django.contrib.sites import models as sites_app
 from django.contrib.sites.management import create_default_site
 from django.contrib.sites.models import Site
-from django.db.models.signals import post_save, post_syncdb
+from django.db.models.signals import (post_init, post_save, pre_delete,
+                                      post_delete, post_syncdb, m2m_changed)
 from django.db.utils import DatabaseError
 
 from ganeti_webmgr.utils.logs import register_log_actions
@@ -32,14 +33,21 @@ from object_log.models import LogItem
 log_action = LogItem.objects.log_action
 
 from object_permissions.registration import register
+from object_permissions.signals import granted, revoked
 
 from ganeti_webmgr.muddle_users import signals as muddle_user_signals
 
-from ganeti_webmgr.authentication.models import Organization
+from ganeti_webmgr.authentication.models import (Organization,
+                                                 EffectivePermission,
+                                                 ResourceUsage)
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.nodes.models import Node
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
+from ganeti_webmgr.utils import RAPI_REGISTRY, invalidate_os_list
 from ganeti_webmgr.utils.client import GanetiApiError
+from ganeti_webmgr.ganeti_web.backend.queries import (
+    invalidate_all_used_resources, invalidate_used_resources)
+from ganeti_webmgr.utils.models import Quota
 
 import permissions
 
@@ -68,13 +76,25 @@ def create_profile(sender, instance, **kwargs):
 
 def update_cluster_hash(sender, instance, **kwargs):
     """
-    Updates the Cluster hash for all of it's VirtualMachines, Nodes, and Jobs
+    Updates the Cluster hash for all of it's VirtualMachines, Nodes, and Jobs,
+    and drops the cached RAPI client if it was created for old credentials.
+    The cached operating systems are dropped as well.
     """
+    RAPI_REGISTRY.invalidate(instance.pk, instance.hash)
+    invalidate_os_list(instance.pk)
     instance.virtual_machines.all().update(cluster_hash=instance.hash)
     instance.jobs.all().update(cluster_hash=instance.hash)
     instance.nodes.all().update(cluster_hash=instance.hash)
 
 
+def forget_rapi_client(sender, instance, **kwargs):
+    """
+    Drops the cached RAPI client and operating systems of a deleted Cluster
+    """
+    RAPI_REGISTRY.invalidate(instance.pk)
+    invalidate_os_list(instance.pk)
+
+
 def update_organization(sender, instance, **kwargs):
     """
     Creates a Organizations whenever a contrib.auth.models.Group is created
@@ -83,10 +103,139 @@ def update_organization(sender, instance, **kwargs):
     org.name = instance.name
     org.save()
 
+
+def grant_effective_perm(sender, perm, object, **kwargs):
+    """
+    Adds a granted permission to the effective permission index
+    """
+    EffectivePermission.grant(sender, perm, object)
+
+
+def revoke_effective_perm(sender, perm, object, **kwargs):
+    """
+    Removes a revoked permission from the effective permission index
+    """
+    EffectivePermission.revoke(sender, perm, object)
+
+
+def update_effective_perms_members(sender, instance, action, reverse, pk_set,
+                                   **kwargs):
+    """
+    Rebuilds the effective permissions of users whose groups changed.  When
+    reverse is set the change was made through Group.user_set.
+    """
+    if action == 'pre_clear' and reverse:
+        # members are gone once the clear is done; remember them now.
+        instance._cleared_members = list(
+            instance.user_set.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        EffectivePermission.rebuild(pk_set if reverse else [instance.pk])
+    elif action == 'post_clear':
+        if reverse:
+            EffectivePermission.rebuild(instance._cleared_members)
+        else:
+            EffectivePermission.rebuild([instance.pk])
+
+
+def remember_group_members(sender, instance, **kwargs):
+    """
+    Deleting a Group removes its memberships without any m2m signals.
+    """
+    instance._cleared_members = list(
+        instance.user_set.values_list('id', flat=True))
+
+
+def rebuild_group_members(sender, instance, **kwargs):
+    """
+    Rebuilds the effective permissions of members of a deleted Group
+    """
+    EffectivePermission.rebuild(instance._cleared_members)
+
+
+def clear_effective_perms(sender, instance, **kwargs):
+    """
+    Removes permissions on a deleted object from the index
+    """
+    EffectivePermission.clear_object(instance)
+
+
+def clear_used_resources_cache(sender, **kwargs):
+    """
+    Invalidates the cached resource usage, which lists the clusters users
+    have permissions on.  Only creations and deletions matter for saves.
+    """
+    if kwargs.get('created', True):
+        invalidate_all_used_resources()
+
+def remember_vm_usage(sender, instance, **kwargs):
+    """
+    Remembers the owner of a VirtualMachine loaded from the database and what
+    it contributes to their resource usage, so that saves can adjust the
+    ledger.
+    """
+    instance._owner_id = instance.owner_id
+    instance._usage = ResourceUsage.usage_of(instance)
+
+
+def update_vm_usage(sender, instance, created, raw=False, **kwargs):
+    """
+    Moves a saved VirtualMachine's resources within the usage ledger
+    """
+    if raw:
+        return
+    old = None if created else getattr(instance, '_usage', None)
+    new = ResourceUsage.usage_of(instance)
+    ResourceUsage.move(old, new)
+    invalidate_used_resources(getattr(instance, '_owner_id', None),
+                              instance.owner_id)
+    instance._owner_id = instance.owner_id
+    instance._usage = new
+
+
+def remove_vm_usage(sender, instance, **kwargs):
+    """
+    Removes a deleted VirtualMachine's resources from the usage ledger
+    """
+    ResourceUsage.move(getattr(instance, '_usage', None), None)
+    invalidate_used_resources(getattr(instance, '_owner_id', None))
+
+
+def clear_quota_usage(sender, instance, **kwargs):
+    """
+    Discards the cached resource usage of a ClusterUser whose quota changed
+    """
+    invalidate_used_resources(instance.user_id)
+
+
 post_save.connect(create_profile, sender=User)
 post_save.connect(update_cluster_hash, sender=Cluster)
+post_delete.connect(forget_rapi_client, sender=Cluster)
 post_save.connect(update_organization, sender=Group)
 
+# The permission index must be updated before the used resources cache is
+# invalidated, so that recomputed usage never sees stale permissions.
+granted.connect(grant_effective_perm)
+revoked.connect(revoke_effective_perm)
+m2m_changed.connect(update_effective_perms_members,
+                    sender=User.groups.through)
+pre_delete.connect(remember_group_members, sender=Group)
+post_delete.connect(rebuild_group_members, sender=Group)
+for model in (Group, Cluster, VirtualMachine):
+    post_delete.connect(clear_effective_perms, sender=model)
+
+post_init.connect(remember_vm_usage, sender=VirtualMachine)
+post_save.connect(update_vm_usage, sender=VirtualMachine)
+post_delete.connect(remove_vm_usage, sender=VirtualMachine)
+post_save.connect(clear_quota_usage, sender=Quota)
+post_delete.connect(clear_quota_usage, sender=Quota)
+
+granted.connect(clear_used_resources_cache)
+revoked.connect(clear_used_resources_cache)
+m2m_changed.connect(clear_used_resources_cache, sender=User.groups.through)
+for model in (User, Group, Cluster, VirtualMachine):
+    post_save.connect(clear_used_resources_cache, sender=model)
+    post_delete.connect(clear_used_resources_cache, sender=model)
+
 
 def regenerate_cu_children(sender, **kwargs):
     """
@@ -116,7 +116,10 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'null': {
+            'class': 'django.utils.log.NullHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -124,12 +127,20 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # Stats of every request as JSON; add a handler to collect them.
+        'ganeti_webmgr.requests': {
+            'handlers': ['null'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 # -- End Logging Configuration ----------
 
 # Middleware. Order matters; these are all applied *in the order given*.
 MIDDLEWARE_CLASSES = (
+    # Request stats come first so that they include all other middleware.
+    'ganeti_webmgr.ganeti_web.middleware.RequestStatsMiddleware',
     'django.middleware.common.CommonMiddleware',
     # Transaction middleware is early so that it can apply to all later
     # middlewares.
@@ -139,6 +150,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.locale.LocaleMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'ganeti_webmgr.ganeti_web.middleware.PermissionCacheMiddleware',
     'ganeti_webmgr.ganeti_web.middleware.PermissionDeniedMiddleware'
 )
 
@@ -193,9 +205,44 @@ LANGUAGES = (
 #    checked when the object is instantiated. It defaults to 600000ms, or ten
 #    minutes.
 LAZY_CACHE_REFRESH = 600000
+#    USED_RESOURCES_CACHE_TIMEOUT (seconds) is how long the resources used by
+#    each user and group, shown on the overview, are cached.  Changes to
+#    their virtual machines, quotas or permissions discard the cached value
+#    right away; changes to a cluster's default quota show up once it
+#    expires.  Set to 0 to disable.
+USED_RESOURCES_CACHE_TIMEOUT = 60
+#    OS_LIST_CACHE_TIMEOUT (seconds) is how long the operating systems of
+#    each cluster, offered by the create and modify forms, are cached.  Set
+#    to 0 to disable.
+OS_LIST_CACHE_TIMEOUT = 300
 # Other GWM Stuff
 VNC_PROXY = 'localhost:8888'
 RAPI_CONNECT_TIMEOUT = 3
+# Maximum number of RAPI clients each process keeps; the least recently used
+# client is dropped first.
+RAPI_CLIENT_CACHE_SIZE = 100
+# Maximum number of RAPI requests sent to one cluster at once by bulk
+# operations, such as creating many virtual machines from a template.
+RAPI_CONCURRENCY = 4
+# Maximum number of virtual machines created from a template at once.
+MAX_BATCH_INSTANCES = 200
+# Jobs which finished more than this many days ago are moved to the job
+# archive by the archivejobs command.
+JOB_ARCHIVE_DAYS = 90
+# Pending jobs of a cluster are refreshed at most once every this many
+# seconds, however many objects with pending jobs are loaded.
+JOB_REFRESH_INTERVAL = 5
+# Return the number and time of the database queries, RAPI requests and
+# cache lookups made by each request in X-GWM-* response headers.
+REQUEST_STATS_HEADERS = False
+# Record the database queries of every request in the request stats, even
+# when DEBUG is off.  This keeps the SQL of each query for the duration of
+# the request, so it is off by default.
+REQUEST_STATS_QUERIES = False
+# Addresses allowed to scrape the Prometheus metrics at /metrics without
+# logging in.  Superusers can always see them.  Behind a reverse proxy every
+# client has the proxy's address, so none are allowed by default.
+METRICS_ALLOWED_IPS = ()
 
 
 def create_secrets(folder='.secrets'):
@@ -229,11 +229,13 @@ def render_storage(value):
         return "%d MiB" % amount
 
 
-# XXX QuerySet
 @register.filter
 def quota(cluster_user, cluster):
     """
     Returns the quota for user/cluster combination.
+
+    Views rendering many rows should call ``cluster.prefetch_quotas()`` first
+    so that this doesn't take a query per row.
     """
     return cluster.get_quota(cluster_user)
 
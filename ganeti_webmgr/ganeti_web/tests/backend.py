@@ -4,7 +4,8 @@ from django.test import TestCase
 from ganeti_webmgr.django_test_tools.users import UserTestMixin
 
 from ..backend.queries import (
-    cluster_qs_for_user, owner_qs, cluster_vm_qs
+    cluster_qs_for_user, owner_qs, cluster_vm_qs, vm_qs_for_admins,
+    vm_qs_for_users
 )
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
@@ -14,6 +15,7 @@ __all__ = (
     "TestOwnerQSNoGroups",
     "TestOwnerQSWithGroups",
     "TestClusterVMQS",
+    "TestVMQSCache",
 )
 
 
@@ -222,3 +224,77 @@ class TestClusterVMQS(TestCase):
         vms = cluster_vm_qs(self.standard, perms=['admin'])
         self.standard.grant('admin', self.vm1)
         self.assertQuerysetEqual(vms, [])
+
+
+class TestVMQSCache(TestCase):
+    """
+    The accessible VMs are looked up in the effective permission index; make
+    sure every change that affects them shows up right away.
+    """
+
+    def setUp(self):
+        self.cluster = Cluster.objects.create(hostname="ganeti.example.org",
+                                              slug="ganeti")
+        self.vm1 = VirtualMachine.objects.create(
+            hostname="vm1", cluster=self.cluster
+        )
+        self.vm2 = VirtualMachine.objects.create(
+            hostname="vm2", cluster=self.cluster
+        )
+        self.user = User.objects.create_user('standard', password='secret')
+        self.group = Group.objects.create(name='testing')
+
+    def tearDown(self):
+        self.cluster.delete()
+        self.user.delete()
+        self.group.delete()
+
+    def test_grant_and_revoke(self):
+        self.assertQuerysetEqual(vm_qs_for_users(self.user), [])
+
+        self.user.grant('power', self.vm1)
+        self.assertQuerysetEqual(vm_qs_for_users(self.user),
+                                 [repr(self.vm1)])
+        self.assertQuerysetEqual(vm_qs_for_admins(self.user), [])
+
+        self.user.revoke('power', self.vm1)
+        self.assertQuerysetEqual(vm_qs_for_users(self.user), [])
+
+    def test_cluster_admin_sees_new_vms(self):
+        self.user.grant('admin', self.cluster)
+        expected = [repr(self.vm1), repr(self.vm2)]
+        self.assertQuerysetEqual(vm_qs_for_admins(self.user), expected)
+
+        vm3 = VirtualMachine.objects.create(hostname="vm3",
+                                            cluster=self.cluster)
+        expected.append(repr(vm3))
+        self.assertQuerysetEqual(vm_qs_for_admins(self.user), expected)
+
+        vm3.delete()
+        self.assertQuerysetEqual(vm_qs_for_admins(self.user), expected[:2])
+
+    def test_subquery(self):
+        """
+        Listings look permissions up in a subquery instead of binding ids.
+        """
+        self.user.grant('power', self.vm1)
+        self.user.grant('admin', self.cluster)
+        qs = vm_qs_for_users(self.user).values_list('pk', flat=True)
+        with self.assertNumQueries(1):
+            # vm1 is matched twice, but only listed once without DISTINCT
+            self.assertEqual(sorted([self.vm1.pk, self.vm2.pk]),
+                             sorted(qs))
+        self.assertFalse(str(qs.query).startswith('SELECT DISTINCT'))
+        where = str(qs.query).split(' WHERE ', 1)[1]
+        self.assertIn('SELECT', where)
+
+    def test_group_membership(self):
+        self.group.grant('admin', self.vm2)
+        self.assertQuerysetEqual(vm_qs_for_admins(self.user), [])
+
+        self.group.user_set.add(self.user)
+        self.assertQuerysetEqual(vm_qs_for_admins(self.user),
+                                 [repr(self.vm2)])
+
+        self.group.user_set.remove(self.user)
+        self.assertQuerysetEqual(vm_qs_for_admins(self.user), [])
@@ -1,7 +1,8 @@
 from unittest import TestCase
 
 from ..caps import (ANCIENT, FUTURE, GANETI22, GANETI24, GANETI242, GANETI25,
-                    classify, has_cdrom2, has_shutdown_timeout, has_balloonmem)
+                    GANETI26, classify, classify_version, has_cdrom2,
+                    has_shutdown_timeout, has_balloonmem)
 
 
 class Mock(object):
@@ -40,6 +41,14 @@ class TestClassify(TestCase):
         cluster = make_mock_cluster("2.5.0")
         self.assertEqual(classify(cluster), GANETI25)
 
+    def test_stored_capability(self):
+        cluster = make_mock_cluster("2.5.0")
+        cluster.capability = GANETI26
+        self.assertEqual(classify(cluster), GANETI26)
+
+    def test_missing_version(self):
+        self.assertEqual(classify_version(None), ANCIENT)
+
 
 class TestHasShutdownTimeout(TestCase):
 
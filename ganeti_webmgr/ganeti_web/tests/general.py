@@ -15,7 +15,11 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import cPickle
+from datetime import datetime
+
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Group
 from django.test import TestCase
@@ -26,21 +30,25 @@ from django.utils import simplejson as json
 from ganeti_webmgr.django_test_tools.views import ViewTestMixin
 
 from ganeti_webmgr.utils.proxy.constants import JOB_ERROR
-from ganeti_webmgr.utils.models import SSHKey
+from ganeti_webmgr.utils.models import GanetiError, SSHKey
 
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
 from ganeti_webmgr.jobs.models import Job
+from ..backend import queries
 from ..backend.queries import vm_qs_for_admins
+from ..benchmark import run_benchmarks
+from ..views import general
 
 
-__all__ = ('TestGeneralViews', 'TestOverviewVMSummary')
+__all__ = ('TestGeneralViews', 'TestOverviewVMSummary', 'TestBenchmarks')
 
 
 class TestGeneralViews(TestCase, ViewTestMixin):
 
     def setUp(self):
         self.tearDown()
+        self.errors_per_page = general.ERRORS_PER_PAGE
 
         self.cluster = Cluster(hostname='test.example.test', slug='OSL_TEST')
         self.cluster.save()
@@ -67,6 +75,8 @@ class TestGeneralViews(TestCase, ViewTestMixin):
         self.c = Client()
 
     def tearDown(self):
+        if hasattr(self, 'errors_per_page'):
+            general.ERRORS_PER_PAGE = self.errors_per_page
         SSHKey.objects.all().delete()
         Cluster.objects.all().delete()
         User.objects.all().delete()
@@ -147,6 +157,70 @@ class TestGeneralViews(TestCase, ViewTestMixin):
         self.assertEqual(2, response.context["missing"])
         self.assertEqual(4, response.context["import_ready"])
 
+    def test_view_errors(self):
+        """
+        Tests the errors page
+
+        Verifies:
+            * errors and failed jobs are merged newest first
+            * the timeline is paginated with a cursor
+            * invalid cursors are rejected
+        """
+        url = reverse('cluster-errors')
+        GanetiError.objects.create(msg='first', obj=self.vm, code=500,
+                                   cluster=self.cluster,
+                                   timestamp=datetime(2011, 1, 1))
+        Job.objects.create(job_id=233, obj=self.vm, cluster=self.cluster,
+                           finished=datetime(2011, 1, 2), status='error')
+        GanetiError.objects.create(msg='third', obj=self.cluster, code=500,
+                                   cluster=self.cluster,
+                                   timestamp=datetime(2011, 1, 3))
+        GanetiError.objects.create(msg='fourth', obj=self.vm, code=501,
+                                   cluster=self.cluster,
+                                   timestamp=datetime(2011, 1, 3))
+
+        self.assertTrue(self.c.login(username=self.user2.username,
+                                     password='secret'))
+        response = self.c.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, 'ganeti/errors.html')
+        errors = response.context['errors']
+        self.assertEqual(['fourth', 'third', None, 'first'],
+                         [e.get('msg') for e in errors])
+        self.assertEqual(233, errors[2]['job_id'])
+        self.assertEqual('vm1.example.bak', errors[0]['obj']['hostname'])
+        self.assertEqual('OSL_TEST', errors[1]['obj']['slug'])
+        self.assertEqual(None, response.context['next_page'])
+
+        # paginated; tearDown() restores the page size if this fails
+        general.ERRORS_PER_PAGE = 3
+        response = self.c.get(url)
+        errors = response.context['errors']
+        self.assertEqual(3, len(errors))
+        cursor = response.context['next_page']
+        self.assertTrue(cursor)
+        self.assertContains(response, '?before=%s' % cursor)
+
+        response = self.c.get(url, {'before': cursor})
+        errors = response.context['errors']
+        self.assertEqual(['first'], [e.get('msg') for e in errors])
+        self.assertEqual(None, response.context['next_page'])
+        general.ERRORS_PER_PAGE = self.errors_per_page
+
+        # invalid cursor
+        response = self.c.get(url, {'before': 'invalid'})
+        self.assertEqual(404, response.status_code)
+
+        # authorized user (admin on a VM only) sees errors of that VM
+        self.user.grant('admin', self.vm)
+        self.assertTrue(self.c.login(username=self.user.username,
+                                     password='secret'))
+        response = self.c.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['fourth', None, 'first'],
+                         [e.get('msg') for e in response.context['errors']])
+        GanetiError.objects.all().delete()
+
     def test_used_resources(self):
         """ tests the used_resources view """
 
@@ -213,6 +287,99 @@ class TestGeneralViews(TestCase, ViewTestMixin):
         self.assertEqual(mimetype, response['content-type'])
         self.assertTemplateUsed(response, template)
 
+    def test_get_used_resources(self):
+        """
+        Used resources are counted for every cluster at once and cached until
+        the owner's virtual machines change
+        """
+        owner = self.user1.get_profile()
+        other = Cluster.objects.create(hostname='other.example.test',
+                                       slug='OTHER', ram=64,
+                                       username='gwm',
+                                       password='cluster-password')
+        self.vm.owner = owner
+        self.vm.status = 'running'
+        self.vm.ram = 2
+        self.vm.save()
+        VirtualMachine.objects.create(hostname='vm2.example.bak',
+                                      cluster=self.cluster, owner=owner,
+                                      status='stopped', ram=4)
+        VirtualMachine.objects.create(hostname='vm3.example.bak',
+                                      cluster=other, owner=owner,
+                                      status='running', ram=8)
+
+        resources = general.get_used_resources(owner)
+        by_slug = dict((c.slug, r) for c, r in resources.items())
+        self.assertEqual(set(['OSL_TEST', 'OTHER']), set(by_slug))
+        self.assertEqual((2, 1, 2), (by_slug['OSL_TEST']['total'],
+                                     by_slug['OSL_TEST']['running'],
+                                     by_slug['OSL_TEST']['used']['ram']))
+        self.assertEqual((1, 1, 8), (by_slug['OTHER']['total'],
+                                     by_slug['OTHER']['running'],
+                                     by_slug['OTHER']['used']['ram']))
+        self.assertEqual(64, by_slug['OTHER']['set']['ram'])
+
+        # only cluster ids are cached, never the clusters and their passwords
+        key = queries.USED_RESOURCES_KEY % (
+            queries._used_resources_generation(60), owner.pk)
+        cached = cache.get(key)
+        self.assertEqual(set([self.cluster.pk, other.pk]), set(cached))
+        self.assertNotIn('cluster-password', cPickle.dumps(cached))
+        self.assertEqual(resources, general.get_used_resources(owner))
+
+        # changes to the owner's VMs discard the cached value
+        self.vm.status = 'stopped'
+        self.vm.save()
+        resources = general.get_used_resources(owner)
+        by_slug = dict((c.slug, r) for c, r in resources.items())
+        self.assertEqual((2, 0, 0), (by_slug['OSL_TEST']['total'],
+                                     by_slug['OSL_TEST']['running'],
+                                     by_slug['OSL_TEST']['used']['ram']))
+
+    def test_view_metrics(self):
+        """
+        Tests the Prometheus metrics
+        """
+        url = reverse('metrics')
+        Job(job_id=1, obj=self.vm, cluster=self.cluster,
+            status='running').save()
+        Job(job_id=2, obj=self.vm, cluster=self.cluster,
+            finished='2011-01-07 21:59', status='success').save()
+
+        allowed = settings.METRICS_ALLOWED_IPS
+        try:
+            # no address is allowed by default
+            self.assertEqual((), allowed)
+            response = self.c.get(url)
+            self.assertEqual(403, response.status_code)
+
+            # allowed by address
+            settings.METRICS_ALLOWED_IPS = ('127.0.0.1',)
+            response = self.c.get(url)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('text/plain; version=0.0.4',
+                             response['content-type'])
+            self.assertTrue('# TYPE gwm_rapi_request_duration_seconds '
+                            'histogram' in response.content)
+            self.assertTrue('gwm_jobs_pending{cluster="test.example.test",'
+                            'status="running"} 1' in response.content)
+            self.assertFalse('status="success"' in response.content)
+
+            # other addresses must log in as superusers
+            settings.METRICS_ALLOWED_IPS = ()
+            response = self.c.get(url)
+            self.assertEqual(403, response.status_code)
+            self.assertTrue(self.c.login(username=self.user.username,
+                                         password='secret'))
+            response = self.c.get(url)
+            self.assertEqual(403, response.status_code)
+            self.assertTrue(self.c.login(username=self.user2.username,
+                                         password='secret'))
+            response = self.c.get(url)
+            self.assertEqual(200, response.status_code)
+        finally:
+            settings.METRICS_ALLOWED_IPS = allowed
+
     def test_view_ssh_keys(self):
         """ tests retrieving all sshkeys from the gwm instance """
 
@@ -326,3 +493,20 @@ class TestOverviewVMSummary(TestCase):
             }
         }
         self.assertEqual(vm_summary, expected_summary)
+
+
+class TestBenchmarks(TestCase):
+
+    def test_run_benchmarks(self):
+        """
+        The benchmarks run against a small simulated cluster and count
+        queries and RAPI requests
+        """
+        results = run_benchmarks(nodes=2, instances=4, repeat=1)
+        self.assertEqual(['sync', 'refreshcache', 'overview', 'vm list',
+                          'cluster detail', 'node table'],
+                         [r['name'] for r in results])
+        sync = results[0]
+        self.assertTrue(sync['queries'] > 0)
+        self.assertTrue(sync['rapi_calls'] > 0)
+        self.assertEqual(4, VirtualMachine.objects.count())
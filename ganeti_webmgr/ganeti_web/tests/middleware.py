@@ -0,0 +1,144 @@
+import json
+
+from django.conf import settings
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.urlresolvers import reverse
+from django.db import connections
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from ..middleware import memoize_permissions, PermissionCacheMiddleware
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.utils import instrumentation
+
+__all__ = ('TestPermissionCache', 'TestRequestStats')
+
+
+class TestPermissionCache(TestCase):
+
+    def setUp(self):
+        self.cluster = Cluster.objects.create(hostname='test.example.org',
+                                              slug='test')
+        self.user = User.objects.create_user('tester', password='secret')
+
+    def tearDown(self):
+        self.cluster.delete()
+        self.user.delete()
+
+    def test_trivial(self):
+        pass
+
+    def test_lookups_are_memoized(self):
+        user = memoize_permissions(User.objects.get(pk=self.user.pk))
+
+        with self.assertNumQueries(1):
+            self.assertFalse(user.has_any_perms(self.cluster, ['admin']))
+            self.assertFalse(user.has_any_perms(self.cluster, ['admin']))
+
+        # same object and permissions, given differently
+        cluster = Cluster.objects.get(pk=self.cluster.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(user.has_any_perms(cluster, ('admin',)))
+
+        with self.assertNumQueries(1):
+            user.has_any_perms(Cluster, ['admin'])
+            user.has_any_perms(Cluster, ['admin'])
+
+    def test_returned_lists_are_copies(self):
+        user = memoize_permissions(User.objects.get(pk=self.user.pk))
+        user.get_perms(self.cluster).append('admin')
+        self.assertEqual([], user.get_perms(self.cluster))
+
+    def test_permission_changes_invalidate(self):
+        user = memoize_permissions(User.objects.get(pk=self.user.pk))
+        self.assertFalse(user.has_perm('admin', self.cluster))
+
+        self.user.grant('admin', self.cluster)
+        self.assertTrue(user.has_perm('admin', self.cluster))
+
+        self.user.revoke('admin', self.cluster)
+        self.assertFalse(user.has_perm('admin', self.cluster))
+
+    def test_anonymous_user(self):
+        user = AnonymousUser()
+        self.assertEqual(user, memoize_permissions(user))
+        self.assertFalse(hasattr(user, '_perm_cache'))
+
+    def test_middleware(self):
+        request = RequestFactory().get('/')
+        request._cached_user = User.objects.get(pk=self.user.pk)
+        PermissionCacheMiddleware().process_request(request)
+        self.assertTrue(hasattr(request.user, '_perm_cache'))
+
+
+class TestRequestStats(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='secret')
+        self.user.is_superuser = True
+        self.user.save()
+        self.headers = settings.REQUEST_STATS_HEADERS
+        self.queries = settings.REQUEST_STATS_QUERIES
+        instrumentation.reset_totals()
+
+    def tearDown(self):
+        settings.REQUEST_STATS_HEADERS = self.headers
+        settings.REQUEST_STATS_QUERIES = self.queries
+        instrumentation.reset_totals()
+        self.user.delete()
+
+    def test_headers(self):
+        self.client.login(username='tester', password='secret')
+
+        settings.REQUEST_STATS_HEADERS = False
+        response = self.client.get(reverse('about'))
+        self.assertFalse(response.has_header('X-GWM-DB'))
+
+        settings.REQUEST_STATS_HEADERS = True
+        settings.REQUEST_STATS_QUERIES = True
+        response = self.client.get(reverse('about'))
+        self.assertEqual(200, response.status_code)
+        for header in ('X-GWM-Time', 'X-GWM-DB', 'X-GWM-RAPI',
+                       'X-GWM-Cache', 'X-GWM-RAPI-Clusters'):
+            self.assertTrue(response.has_header(header), header)
+        queries = int(response['X-GWM-DB'].split(';')[0])
+        self.assertTrue(queries > 0)
+
+    def test_queries(self):
+        """
+        Queries are only recorded when REQUEST_STATS_QUERIES is set
+        """
+        self.client.login(username='tester', password='secret')
+        settings.REQUEST_STATS_HEADERS = True
+
+        settings.REQUEST_STATS_QUERIES = False
+        response = self.client.get(reverse('about'))
+        self.assertEqual(0, int(response['X-GWM-DB'].split(';')[0]))
+        for connection in connections.all():
+            self.assertNotEqual(True, connection.use_debug_cursor)
+
+        settings.REQUEST_STATS_QUERIES = True
+        response = self.client.get(reverse('about'))
+        self.assertTrue(int(response['X-GWM-DB'].split(';')[0]) > 0)
+        for connection in connections.all():
+            self.assertNotEqual(True, connection.use_debug_cursor)
+
+    def test_stats(self):
+        url = reverse('request-stats')
+        response = self.client.get(url)
+        self.assertEqual(302, response.status_code)
+
+        self.client.login(username='tester', password='secret')
+        self.client.get(reverse('about'))
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/json', response['content-type'])
+        totals = json.loads(response.content)
+        view = 'ganeti_webmgr.ganeti_web.views.general.AboutView'
+        self.assertEqual(1, totals[view]['requests'])
+
+        # only superusers may see the stats
+        self.user.is_superuser = False
+        self.user.save()
+        response = self.client.get(url)
+        self.assertEqual(403, response.status_code)
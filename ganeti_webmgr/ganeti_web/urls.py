@@ -98,6 +98,9 @@ urlpatterns += patterns(
 
     url(r'clusters/errors', 'get_errors', name="cluster-errors"),
 
+    url(r'^stats/?$', 'request_stats', name="request-stats"),
+    url(r'^metrics/?$', 'metrics', name="metrics"),
+
     url(r'^about/?$', AboutView.as_view(), name="about"),
 )
 
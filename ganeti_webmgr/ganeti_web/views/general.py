@@ -15,8 +15,10 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import json
 from itertools import chain, izip, repeat
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
@@ -30,11 +32,14 @@ from django.http import HttpResponse
 from . import render_404
 from .generic import NO_PRIVS
 from ..constants import VERSION
-from ..backend.queries import vm_qs_for_admins
+from ..backend.errors import error_timeline
+from ..backend.queries import get_used_resources, vm_qs_for_admins
 
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
 from ganeti_webmgr.jobs.models import Job
+from ganeti_webmgr.utils.instrumentation import totals
+from ganeti_webmgr.utils.metrics import export
 from ganeti_webmgr.utils.models import GanetiError
 from ganeti_webmgr.authentication.models import (ClusterUser,
                                                  Organization, Profile)
@@ -68,13 +73,14 @@ def merge_errors(errors, jobs):
     return list(sorted(i, key=keyfunc))
 
 
-USED_NOTHING = dict(disk=0, ram=0, virtual_cpus=0)
+# number of rows shown per page of the errors page
+ERRORS_PER_PAGE = 50
 
 
 @login_required
 def get_errors(request):
-    """ Returns all errors that have ever been generated for clusters/vms
-    and then sends them to the errors page.
+    """ Returns a page of the errors that have been generated for
+    clusters/vms, newest first, and sends them to the errors page.
     """
     user = request.user
 
@@ -110,8 +116,12 @@ def get_errors(request):
     if admin:
         ganeti_errors |= qs.get_errors(obj=clusters)
 
-    # merge error lists
-    errors = merge_errors(ganeti_errors, job_errors)
+    try:
+        errors, cursor = error_timeline(ganeti_errors, job_errors,
+                                        before=request.GET.get('before'),
+                                        limit=ERRORS_PER_PAGE)
+    except ValueError:
+        return render_404(request, _('Invalid page of errors'))
 
     return render_to_response("ganeti/errors.html",
                               {
@@ -119,43 +129,11 @@ def get_errors(request):
                                   'cluster_list': clusters,
                                   'user': request.user,
                                   'errors': errors,
+                                  'next_page': cursor,
                               },
                               context_instance=RequestContext(request))
 
 
-def get_used_resources(cluster_user):
-    """ help function for querying resources used for a given cluster_user """
-    resources = {}
-    owned_vms = cluster_user.virtual_machines.all()
-    used = cluster_user.used_resources()
-    clusters = cluster_user.permissable.get_objects_any_perms(Cluster)
-    quotas = Cluster.get_quotas(clusters, cluster_user)
-
-    for cluster, quota in quotas.items():
-        resources[cluster] = {
-            "used": used.pop(cluster.id)
-            if cluster.id in used else USED_NOTHING,
-            "set": quota
-        }
-        resources[cluster]["total"] = owned_vms.filter(cluster=cluster).count()
-        resources[cluster]["running"] = owned_vms \
-            .filter(cluster=cluster, status="running").count()
-
-    # add any clusters that have used resources
-    # but no perms (and thus no quota)
-    # since we know they don't have a custom quota just add the default quota
-    if used:
-        for cluster in Cluster.objects.filter(pk__in=used):
-            resources[cluster] = {"used": used[cluster.id],
-                                  "set": cluster.get_default_quota()}
-            resources[cluster]["total"] = owned_vms \
-                .filter(cluster=cluster).count()
-            resources[cluster]["running"] = owned_vms \
-                .filter(cluster=cluster, status="running").count()
-
-    return resources
-
-
 def get_vm_counts(clusters):
     """
     Helper for getting the list of orphaned/ready to import/missing VMs.
@@ -347,3 +325,29 @@ def clear_ganeti_error(request, pk):
     GanetiError.objects.filter(pk=error.pk).update(cleared=True)
 
     return HttpResponse('1', mimetype='application/json')
+
+
+@login_required
+def request_stats(request):
+    """
+    Totals of the database queries, RAPI requests and cache lookups made by
+    each view, as recorded by ``RequestStatsMiddleware`` in this process.
+    """
+    if not request.user.is_superuser:
+        raise PermissionDenied(NO_PRIVS)
+
+    return HttpResponse(json.dumps(totals(), indent=2, sort_keys=True),
+                        mimetype='application/json')
+
+
+def metrics(request):
+    """
+    Metrics of this process in the Prometheus text format.  Scrapers are
+    allowed in by address, see ``METRICS_ALLOWED_IPS``; anyone else must be
+    a superuser.
+    """
+    if (request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS
+            and not request.user.is_superuser):
+        raise PermissionDenied(NO_PRIVS)
+
+    return HttpResponse(export(), mimetype='text/plain; version=0.0.4')
@@ -6,6 +6,19 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE",
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Create the RAPI clients of all clusters before serving the first request.
+# If this module is loaded before worker processes are forked, they inherit
+# the clients, so the database connection is closed to keep it from being
+# shared.  Clusters whose clients can't be created are logged and skipped.
+from django.db import connection, DatabaseError
+from ganeti_webmgr.utils import warm_rapi_cache
+try:
+    warm_rapi_cache()
+except DatabaseError:
+    # the database may not have been set up yet
+    pass
+connection.close()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
@@ -0,0 +1,231 @@
+"""
+Compact graph of a cluster for ganetiviz.
+
+Instead of every node and instance, the graph first describes the nodes only,
+together with the aggregates the client would otherwise compute itself: the
+number of primary instances of each node, how many of them are running, and
+the number of instances that can fail over between each pair of nodes.  The
+instances of a single node are fetched when that node is expanded.
+
+Rows are lists rather than dictionaries; the field names are sent once.
+
+Details of instances shown when hovering over them are read from their
+cached info, many instances at once.
+"""
+
+import cPickle
+from hashlib import sha1
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+import simplejson as json
+
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.nodes.models import Node
+from ganeti_webmgr.utils import get_rapi, rapi_map
+from ganeti_webmgr.utils.client import GanetiApiError
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
+
+NODE_FIELDS = ('hostname', 'offline', 'role', 'ram_total', 'ram_free',
+               'instances', 'running')
+VM_FIELDS = ('hostname', 'secondary_node', 'status', 'owner')
+
+# Fields of an instance's info returned by ``instance_details()``.
+DETAIL_FIELDS = ('beparams', 'nic.bridges', 'network_port', 'status', 'os')
+
+# Number of rows serialized per chunk of a streamed response.
+CHUNK_SIZE = 500
+
+# More instances than this are fetched with a single bulk request.
+BULK_FETCH_THRESHOLD = 5
+
+# Instance details of a cluster are refreshed at most once every this many
+# seconds, whoever asks.
+REFRESH_INTERVAL = 10
+REFRESHED_KEY = 'ganetiviz:refreshed:%s'
+
+
+def graph_etag(cluster_id, mtime, node=None):
+    """
+    Build an ETag for the graph of a cluster, or of one of its nodes.
+
+    Ganeti updates the mtime of nodes and instances when their configuration
+    changes, but not when their state does, for instance when an instance
+    goes down.  Refreshing a node or instance updates when it was cached
+    though, so the newest mtimes and refreshes and the number of nodes and
+    instances change whenever Ganeti's side of the graph does.  Owners are
+    only stored here, so the owner of every instance is hashed as well.
+
+    @param mtime  the mtime of the cluster
+    """
+    nodes = Node.objects.filter(cluster=cluster_id) \
+        .aggregate(mtime=Max('mtime'), cached=Max('cached'),
+                   count=Count('id'))
+    vms = VirtualMachine.objects.filter(cluster=cluster_id)
+    aggregates = vms.aggregate(mtime=Max('mtime'), cached=Max('cached'),
+                               count=Count('id'))
+    key = ':'.join(unicode(part) for part in (
+        cluster_id, mtime, nodes['mtime'], nodes['cached'], nodes['count'],
+        aggregates['mtime'], aggregates['cached'], aggregates['count'],
+        node or ''))
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    etag = sha1(key)
+    for pk, owner in vms.order_by('id').values_list('id', 'owner') \
+            .iterator():
+        etag.update('%s:%s;' % (pk, owner))
+    return '"%s"' % etag.hexdigest()
+
+
+def _chunks(rows):
+    """
+    Serialize rows as the elements of a JSON array, a chunk at a time.
+    """
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(json.dumps(row))
+        if len(chunk) == CHUNK_SIZE:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+
+
+def _stream(header, key, rows, footer=None):
+    """
+    Stream a JSON object made of the items of ``header`` and ``footer``, with
+    ``rows`` as an array under ``key`` in between.
+    """
+    yield json.dumps(header)[:-1]
+    yield ', "%s": [' % key
+    for chunk in _chunks(rows):
+        yield chunk
+    yield ']'
+    if footer:
+        yield ', ' + json.dumps(footer)[1:-1]
+    yield '}'
+
+
+def node_graph(cluster_id):
+    """
+    Stream the nodes of a cluster with their instance counts, and the
+    failover links between them as (primary, secondary, count) triples.
+    """
+    vms = VirtualMachine.objects.filter(cluster=cluster_id).order_by()
+
+    instances = dict(vms.values_list('primary_node')
+                     .annotate(count=Count('id')))
+    running = dict(vms.filter(status='running')
+                   .values_list('primary_node').annotate(count=Count('id')))
+
+    nodes = Node.objects.filter(cluster=cluster_id).order_by('hostname') \
+        .values_list('id', 'hostname', 'offline', 'role', 'ram_total',
+                     'ram_free')
+    hostnames = {}
+    rows = []
+    for pk, hostname, offline, role, ram_total, ram_free in nodes:
+        hostnames[pk] = hostname
+        rows.append((hostname, offline, role, ram_total, ram_free,
+                     instances.get(pk, 0), running.get(pk, 0)))
+
+    links = vms.filter(primary_node__isnull=False,
+                       secondary_node__isnull=False) \
+        .values_list('primary_node', 'secondary_node') \
+        .annotate(count=Count('id'))
+    links = [(hostnames[primary], hostnames[secondary], count)
+             for primary, secondary, count in links
+             if primary in hostnames and secondary in hostnames]
+
+    return _stream({'node_fields': NODE_FIELDS}, 'nodes', rows,
+                   {'links': sorted(links)})
+
+
+def node_instances(cluster_id, hostname):
+    """
+    Stream the primary instances of one node of a cluster.
+
+    @raises Node.DoesNotExist  if the cluster has no such node
+    """
+    node = Node.objects.filter(cluster=cluster_id, hostname=hostname) \
+        .values_list('id', flat=True)
+    if not node:
+        raise Node.DoesNotExist(hostname)
+
+    vms = VirtualMachine.objects.filter(cluster=cluster_id,
+                                        primary_node=node[0]) \
+        .order_by('hostname') \
+        .values_list('hostname', 'secondary_node__hostname', 'status',
+                     'owner')
+    return _stream({'node': hostname, 'vm_fields': VM_FIELDS}, 'vms',
+                   vms.iterator())
+
+
+def _details(info):
+    return dict((field, info.get(field)) for field in DETAIL_FIELDS)
+
+
+def _fetch(cluster_id, hostnames):
+    """
+    Fetch the info of some instances of a cluster from Ganeti.  A handful
+    are fetched concurrently, one request each; more are picked out of a
+    single bulk request for every instance of the cluster.
+
+    @returns a dictionary mapping hostnames to the info fetched.  Instances
+             which couldn't be fetched are left out.
+    """
+    (hash,) = Cluster.objects.filter(pk=cluster_id) \
+        .values_list('hash', flat=True)
+    rapi = get_rapi(hash, cluster_id)
+
+    if len(hostnames) > BULK_FETCH_THRESHOLD:
+        wanted = set(hostnames)
+        try:
+            return dict((info['name'], info)
+                        for info in rapi.GetInstances(bulk=True)
+                        if info['name'] in wanted)
+        except GanetiApiError:
+            return {}
+
+    return dict((hostname, info) for hostname, info, error
+                in rapi_map(cluster_id, rapi.GetInstance, hostnames)
+                if error is None)
+
+
+def instance_details(cluster_id, hostnames, refresh=False):
+    """
+    Return details of many instances of a cluster, read from their cached
+    info without instantiating them.
+
+    Instances are only fetched from Ganeti if ``refresh`` is set, or if they
+    have no cached info yet, and the fetched info is not stored.  Refreshing
+    is throttled to once every ``REFRESH_INTERVAL`` seconds per cluster;
+    cached info is returned meanwhile.
+
+    @returns a dictionary mapping each hostname to its details, or to None
+             if the cluster has no such instance or it couldn't be fetched
+    """
+    if refresh:
+        refresh = cache.add(REFRESHED_KEY % cluster_id, True,
+                            REFRESH_INTERVAL)
+
+    details = dict.fromkeys(hostnames)
+    vms = VirtualMachine.objects.filter(cluster=cluster_id,
+                                        hostname__in=hostnames) \
+        .values_list('hostname', 'serialized_info')
+
+    fetch = []
+    for hostname, serialized in vms:
+        info = cPickle.loads(str(serialized)) if serialized else None
+        if info and not refresh:
+            details[hostname] = _details(info)
+        else:
+            fetch.append(hostname)
+
+    if fetch:
+        for hostname, info in _fetch(cluster_id, fetch).items():
+            details[hostname] = _details(info)
+
+    return details
@@ -1,10 +1,17 @@
+import cPickle
+from datetime import datetime
+
+from ganeti_webmgr.authentication.models import ClusterUser
 from ganeti_webmgr.clusters.models import Cluster
 from django.contrib.auth.models import User, Group
+from django.core.cache import cache
 from django.test import TestCase
 from django.test import LiveServerTestCase
 from django.utils import unittest, simplejson as json
+from ganeti_webmgr.ganetiviz.graph import BULK_FETCH_THRESHOLD, REFRESHED_KEY
 from ganeti_webmgr.nodes.models import Node
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
+from ganeti_webmgr.utils.proxy.constants import INSTANCE
 
 try:
     from selenium import webdriver
@@ -108,6 +115,135 @@ class TestGanetivizViews(TestCase):
 
         self.assertEqual(cluster_data, testcluster0_data)
 
+    def test_cluster_graph_output(self):
+        url = "/ganetiviz/cluster/%s/graph/" % self.cluster.slug
+
+        self.client.login(username='tester_pranjal', password='secret')
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        graph = json.loads(response.content)
+        self.assertEqual(['hostname', 'offline', 'role', 'ram_total',
+                          'ram_free', 'instances', 'running'],
+                         graph['node_fields'])
+        self.assertEqual([['node0.example.test', False, '', -1, -1, 3, 0],
+                          ['node1.example.test', False, '', -1, -1, 1, 0]],
+                         graph['nodes'])
+        self.assertEqual([['node0.example.test', 'node1.example.test', 3],
+                          ['node1.example.test', 'node0.example.test', 1]],
+                         graph['links'])
+
+        # unchanged graphs aren't sent again
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+        # expanding a node
+        response = self.client.get(url, {'node': 'node1.example.test'})
+        self.assertNotEqual(etag, response['ETag'])
+        graph = json.loads(response.content)
+        self.assertEqual('node1.example.test', graph['node'])
+        self.assertEqual([['instance4.example.test', 'node0.example.test',
+                           '', None]], graph['vms'])
+
+        response = self.client.get(url, {'node': 'missing.example.test'})
+        self.assertEqual(404, response.status_code)
+
+        # state changes don't touch the mtime, but are refreshed
+        VirtualMachine.objects.filter(hostname='instance1.example.test') \
+            .update(status='running', cached=datetime.now())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        graph = json.loads(response.content)
+        self.assertEqual(1, graph['nodes'][0][6])
+        etag = response['ETag']
+
+        # reassigning an instance
+        owner = ClusterUser.objects.create(name='owner')
+        other = ClusterUser.objects.create(name='other')
+        VirtualMachine.objects.filter(hostname='instance1.example.test') \
+            .update(owner=owner)
+        VirtualMachine.objects.filter(hostname='instance2.example.test') \
+            .update(owner=other)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+
+        # swapping owners
+        VirtualMachine.objects.filter(hostname='instance1.example.test') \
+            .update(owner=other)
+        VirtualMachine.objects.filter(hostname='instance2.example.test') \
+            .update(owner=owner)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+
+        # the graph changes along with the cluster
+        VirtualMachine.objects.filter(hostname='instance1.example.test') \
+            .delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        graph = json.loads(response.content)
+        self.assertEqual(2, graph['nodes'][0][5])
+
+    def test_instance_details(self):
+        info = dict(INSTANCE, os='cached-os')
+        VirtualMachine.objects.filter(hostname='instance1.example.test') \
+            .update(serialized_info=cPickle.dumps(info))
+        self.client.login(username='tester_pranjal', password='secret')
+
+        url = "/ganetiviz/%s/instances/" % self.cluster.slug
+        response = self.client.get(url, {
+            'hostname': ['instance1.example.test', 'instance2.example.test',
+                         'missing.example.test']})
+        self.assertEqual(200, response.status_code)
+        details = json.loads(response.content)
+        # cached info is used when there is some, otherwise Ganeti is asked
+        self.assertEqual('cached-os', details['instance1.example.test']['os'])
+        self.assertEqual(['br42'],
+                         details['instance1.example.test']['nic.bridges'])
+        self.assertEqual(INSTANCE['os'],
+                         details['instance2.example.test']['os'])
+        self.assertEqual(None, details['missing.example.test'])
+
+        cache.delete(REFRESHED_KEY % self.cluster.pk)
+        response = self.client.get(url, {
+            'hostname': 'instance1.example.test', 'refresh': 1})
+        details = json.loads(response.content)
+        self.assertEqual(INSTANCE['os'],
+                         details['instance1.example.test']['os'])
+
+        # refreshing again right away returns the cached info
+        response = self.client.get(url, {
+            'hostname': 'instance1.example.test', 'refresh': 1})
+        details = json.loads(response.content)
+        self.assertEqual('cached-os', details['instance1.example.test']['os'])
+
+        # more than a handful of instances are fetched in bulk
+        hostnames = ['bulk%d.example.test' % i
+                     for i in range(BULK_FETCH_THRESHOLD + 1)]
+        for hostname in hostnames:
+            VirtualMachine.objects.create(cluster=self.cluster,
+                                          hostname=hostname)
+        rapi = self.cluster.rapi
+        rapi.GetInstances.response = [dict(INSTANCE, name=hostname)
+                                      for hostname in hostnames[1:]]
+        rapi.GetInstances.reset()
+        rapi.GetInstance.reset()
+        response = self.client.get(url, {'hostname': hostnames})
+        details = json.loads(response.content)
+        rapi.GetInstances.assertCalled(self, bulk=True)
+        self.assertEqual(1, len(rapi.GetInstances.calls))
+        rapi.GetInstance.assertNotCalled(self)
+        self.assertEqual(None, details[hostnames[0]])
+        self.assertEqual(INSTANCE['os'], details[hostnames[1]]['os'])
+
+        # single instances
+        url = "/ganetiviz/%s/instance1.example.test/" % self.cluster.slug
+        response = self.client.get(url)
+        self.assertEqual('cached-os', json.loads(response.content)['os'])
+        url = "/ganetiviz/%s/missing.example.test/" % self.cluster.slug
+        self.assertEqual(404, self.client.get(url).status_code)
+
 
 def check_help_status(driver):
     help_status = driver.execute_script("return window.GANETIVIZ_HELP_MODE")
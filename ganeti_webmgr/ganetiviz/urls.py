@@ -1,7 +1,8 @@
 from ganeti_webmgr.clusters.urls import cluster_slug
 from django.conf.urls.defaults import patterns, url
 from ganeti_webmgr.ganetiviz.views import ClusterGraphView, AllClustersView,\
-    ClusterJsonView, InstanceExtraDataView
+    ClusterJsonView, ClusterGraphJsonView, InstanceExtraDataView, \
+    InstancesExtraDataView
 
 # Care must be taken to allow dots to be captured in any hostname.
 instance_hostname = '(?P<instance_hostname>[^/]+)'
@@ -12,6 +13,12 @@ urlpatterns = patterns(
     url(r'^ganetiviz/cluster/%s/$' % cluster_slug, ClusterJsonView.as_view(),
         name='json-cluster'),
 
+    url(r'^ganetiviz/cluster/%s/graph/$' % cluster_slug,
+        ClusterGraphJsonView.as_view(), name='json-cluster-graph'),
+
+    url(r'^ganetiviz/%s/instances/$' % cluster_slug,
+        InstancesExtraDataView.as_view(), name='instances-info'),
+
     url(r'^ganetiviz/%s/%s/$' % (cluster_slug, instance_hostname),
         InstanceExtraDataView.as_view(), name='instance-info'),
 
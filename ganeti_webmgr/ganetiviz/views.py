@@ -1,10 +1,16 @@
-from django.http import HttpResponse
-from django.views.generic import DetailView, TemplateView
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from django.views.generic import DetailView, TemplateView, View
 
 from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.nodes.models import Node
 from ganeti_webmgr.ganeti_web.views.generic import LoginRequiredMixin
 import simplejson as json
-from ganeti_webmgr.utils import get_rapi
+from ganeti_webmgr.ganetiviz.graph import (graph_etag, instance_details,
+                                           node_graph, node_instances)
+
+# Maximum number of instances whose details are returned at once.
+MAX_INSTANCE_DETAILS = 500
 
 
 class ClusterJsonView(LoginRequiredMixin, DetailView):
@@ -33,6 +39,40 @@ class ClusterJsonView(LoginRequiredMixin, DetailView):
         return HttpResponse(cluster_json, content_type='application/json')
 
 
+class ClusterGraphJsonView(LoginRequiredMixin, View):
+    """
+    View streaming the compact graph of a Cluster: its nodes with instance
+    counts and the failover links between them.  Passing a node's hostname
+    as ``node`` returns the instances of that node instead, example:
+    "/ganetiviz/cluster/ganeti/graph/?node=node1.example.org"
+
+    Responses carry an ETag, so unchanged graphs aren't sent again.
+    """
+    def get(self, request, *args, **kwargs):
+        cluster = Cluster.objects.filter(slug=self.kwargs['cluster_slug']) \
+            .values_list('id', 'mtime')
+        if not cluster:
+            raise Http404
+        cluster_id, mtime = cluster[0]
+        node = request.GET.get('node')
+
+        etag = graph_etag(cluster_id, mtime, node)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+
+        if node:
+            try:
+                content = node_instances(cluster_id, node)
+            except Node.DoesNotExist:
+                raise Http404
+        else:
+            content = node_graph(cluster_id)
+
+        response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+
 class ClusterGraphView(LoginRequiredMixin, TemplateView):
     """
     View that dispatches the appropriate template file responsible for visual
@@ -68,25 +108,44 @@ class AllClustersView(LoginRequiredMixin, TemplateView):
 class InstanceExtraDataView(LoginRequiredMixin, DetailView):
     """
     View for returning additional instance information (useful) for a
-    particular instance in a cluster via ganeti RAPI  python client.
+    particular instance in a cluster, read from its cached info.  Passing
+    ``refresh`` fetches the information from Ganeti instead, at most once
+    every few seconds per cluster.
     """
     def get(self, request, *args, **kwargs):
-        cluster_slug = self.kwargs['cluster_slug']
+        cluster = get_object_or_404(Cluster.objects.values_list('id'),
+                                    slug=self.kwargs['cluster_slug'])
         instance_hostname = self.kwargs['instance_hostname']
 
-        cluster = Cluster.objects.get(slug=cluster_slug)
+        details = instance_details(cluster[0], [instance_hostname],
+                                   'refresh' in request.GET)
+        if details[instance_hostname] is None:
+            raise Http404
 
-        r = get_rapi(cluster.hash, cluster.cluster_id)
+        instance_info_json = json.dumps(details[instance_hostname])
 
-        selected_fields = ('beparams', 'nic.bridges', 'network_port',
-                           'status', 'os')
+        return HttpResponse(instance_info_json,
+                            content_type='application/json')
 
-        # Blocking request to Ganeti RAPI to return instance info.
-        instance_info = r.GetInstance(instance_hostname)
 
-        useful_instance_info = dict((useful_key, instance_info[useful_key])
-                                    for useful_key in selected_fields)
-        instance_info_json = json.dumps(useful_instance_info)
+class InstancesExtraDataView(LoginRequiredMixin, View):
+    """
+    View returning additional information about many instances of a cluster
+    at once, keyed by hostname.  Instances are given by repeating the
+    ``hostname`` parameter, example:
+    "/ganetiviz/ganeti/instances/?hostname=vm1.example.org&hostname=..."
+
+    Information is read from the cached info of the instances; passing
+    ``refresh`` fetches it from Ganeti instead, at most once every few
+    seconds per cluster.
+    """
+    def get(self, request, *args, **kwargs):
+        cluster = get_object_or_404(Cluster.objects.values_list('id'),
+                                    slug=self.kwargs['cluster_slug'])
 
-        return HttpResponse(instance_info_json,
+        hostnames = request.GET.getlist('hostname')[:MAX_INSTANCE_DETAILS]
+        details = instance_details(cluster[0], hostnames,
+                                   'refresh' in request.GET)
+
+        return HttpResponse(json.dumps(details),
                             content_type='application/json')
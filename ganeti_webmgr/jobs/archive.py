@@ -0,0 +1,101 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Archival of finished jobs.
+
+Jobs are kept in the Job table forever, although only unfinished jobs and
+the most recent jobs of each object are ever looked at.  ``archive_jobs()``
+moves jobs which finished before a cutoff to ``ArchivedJob``, a batch at a
+time, so that the Job table stays small.
+"""
+
+import time
+
+from django.db import transaction
+from django.db.models.sql import DeleteQuery
+
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.nodes.models import Node
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
+from ganeti_webmgr.vm_templates.models import InstanceBatch
+
+from .models import ArchivedJob, Job
+
+FIELDS = ('id', 'job_id', 'content_type', 'object_id', 'cluster', 'finished',
+          'status', 'op', 'serialized_info')
+
+
+def archivable_jobs(before):
+    """
+    Return the jobs which finished before ``before`` and are not the last
+    job of a cluster, node or virtual machine.
+
+    Jobs creating the instances of a batch are kept too, as the progress of
+    the batch is counted from them.  Completed objects no longer reference
+    their last job, so these jobs are not otherwise protected.
+    """
+    qs = Job.objects.filter(finished__lt=before)
+    for model in (Cluster, Node, VirtualMachine):
+        qs = qs.exclude(pk__in=model.objects.filter(last_job__isnull=False)
+                        .values('last_job'))
+    return qs.exclude(pk__in=InstanceBatch.jobs.through.objects
+                      .values('job'))
+
+
+def _delete(ids):
+    """
+    Delete jobs without instantiating them, which could refresh them.
+    """
+    DeleteQuery(Job).delete_batch(ids, Job.objects.db)
+
+
+def archive_jobs(before, batch_size=1000, delay=0, prune=False):
+    """
+    Move the jobs which finished before ``before`` to ``ArchivedJob``.
+
+    Each batch is committed separately, so the tables are never locked for
+    long, and archival can be interrupted and resumed at any time.
+
+    @param batch_size  number of jobs moved per transaction
+    @param delay  seconds to wait between batches, to throttle archival
+    @param prune  delete the jobs instead of archiving them
+    @returns the number of jobs archived or deleted
+    """
+    qs = archivable_jobs(before).order_by('id').values_list(*FIELDS)
+    total = 0
+    while True:
+        rows = list(qs[:batch_size])
+        if not rows:
+            return total
+
+        with transaction.commit_on_success():
+            if not prune:
+                ArchivedJob.objects.bulk_create([
+                    ArchivedJob(job_id=job_id, content_type_id=content_type,
+                                object_id=object_id, cluster_id=cluster,
+                                finished=finished, status=status, op=op,
+                                compressed_info=ArchivedJob.compress(info))
+                    for (pk, job_id, content_type, object_id, cluster,
+                         finished, status, op, info) in rows])
+            _delete([row[0] for row in rows])
+
+        total += len(rows)
+        if len(rows) < batch_size:
+            return total
+        if delay:
+            time.sleep(delay)
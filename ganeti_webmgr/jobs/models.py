@@ -1,14 +1,31 @@
+import cPickle
+import zlib
+from base64 import b64decode, b64encode
 from datetime import datetime
 
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Count
+# Per #6579, do not change this import without discussion.
+from django.utils import simplejson as json
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
 
 from ganeti_webmgr.utils import get_rapi
 from ganeti_webmgr.utils.client import GanetiApiError
+from ganeti_webmgr.utils.metrics import Gauge
 from ganeti_webmgr.clusters.models import CachedClusterObject
 
 
+# Longest log line or error kept in a job's summary.
+SUMMARY_TEXT_LENGTH = 1000
+
+
+def _clip(text):
+    if isinstance(text, basestring) and len(text) > SUMMARY_TEXT_LENGTH:
+        return text[:SUMMARY_TEXT_LENGTH - 3] + '...'
+    return text
+
+
 class JobManager(models.Manager):
     """
     Custom manager for Ganeti Jobs model
@@ -19,6 +36,37 @@ class JobManager(models.Manager):
         job.save(force_insert=True)
         return job
 
+    def set_last_jobs(self, model, object_ids, chunk_size=500):
+        """
+        Make the newest job of each of the given objects its last job.  A
+        single UPDATE is run for every ``chunk_size`` objects, instead of one
+        per object.
+        """
+        object_ids = list(object_ids)
+        qn = connection.ops.quote_name
+        opts = model._meta
+        names = {
+            'table': qn(opts.db_table),
+            'last_job': qn(opts.get_field('last_job').column),
+            'pk': qn(opts.pk.column),
+            'jobs': qn(self.model._meta.db_table),
+            'id': qn(self.model._meta.pk.column),
+            'content_type': qn('content_type_id'),
+            'object_id': qn('object_id'),
+        }
+        sql = ('UPDATE %(table)s SET %(last_job)s = '
+               '(SELECT MAX(%(jobs)s.%(id)s) FROM %(jobs)s '
+               'WHERE %(jobs)s.%(content_type)s = %%s '
+               'AND %(jobs)s.%(object_id)s = %(table)s.%(pk)s) '
+               'WHERE %(pk)s IN (%(ids)s)')
+        ct = ContentType.objects.get_for_model(model)
+        cursor = connection.cursor()
+        for i in xrange(0, len(object_ids), chunk_size):
+            chunk = object_ids[i:i + chunk_size]
+            names['ids'] = ', '.join(['%s'] * len(chunk))
+            cursor.execute(sql % names, [ct.pk] + chunk)
+        transaction.commit_unless_managed()
+
 
 class Job(CachedClusterObject):
     """
@@ -29,6 +77,15 @@ class Job(CachedClusterObject):
     immutable.  The lazy cache is modified to become permanent once a complete
     status (success/error) has been detected.  The cache can be disabled by
     settning ignore_cache=True.
+
+    Jobs are looked up by the object they act on and by cluster and status;
+    migration 0003 adds composite indexes on (content_type, object_id) and
+    (cluster, status) for those lookups.  Finished jobs are moved to
+    ``ArchivedJob`` by the ``archivejobs`` command.
+
+    The current operation and a small JSON ``summary`` of the info (status of
+    each operation, last log line and error) are stored alongside the info,
+    so that job lists and status polls never unpickle it.
     """
 
     job_id = models.IntegerField()
@@ -39,9 +96,11 @@ class Job(CachedClusterObject):
                                 editable=False)
     cluster_hash = models.CharField(max_length=40, editable=False)
 
-    finished = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True, db_index=True)
     status = models.CharField(max_length=10)
     op = models.CharField(max_length=50)
+    current_op = models.CharField(max_length=50, blank=True)
+    summary = models.TextField(default="", blank=True, editable=False)
 
     objects = JobManager()
 
@@ -72,7 +131,9 @@ class Job(CachedClusterObject):
         Load info for class.  This will load from ganeti if ignore_cache==True,
         otherwise this will always load from the cache.
         """
-        if self.id and (self.ignore_cache or self.info is None):
+        # an empty summary means no valid info was ever parsed; checking it
+        # instead of info spares unpickling every job loaded
+        if self.id and (self.ignore_cache or not self.summary):
             try:
                 self.refresh()
             except GanetiApiError as e:
@@ -118,13 +179,86 @@ class Job(CachedClusterObject):
         if not cls.valid_job(info):
             return {}
         op = cls.parse_op(info)
-        data = {'status': info['status'], 'op': op}
+        current_op, summary = cls.summarize(info)
+        data = {'status': info['status'], 'op': op, 'current_op': current_op,
+                'summary': json.dumps(summary)}
         if data['status'] in ('error', 'success'):
             data['ignore_cache'] = False
         if info['end_ts']:
             data['finished'] = cls.parse_end_timestamp(info)
         return data
 
+    @staticmethod
+    def current_index(info):
+        """
+        Return the index of the first operation which has not succeeded.
+        """
+        for i, status in enumerate(info.get('opstatus') or []):
+            if status != 'success':
+                return i
+        return 0
+
+    @classmethod
+    def summarize(cls, info):
+        """
+        Extract the parts of a job's info shown while it is polled: the
+        status of each operation, the last log line of the current operation
+        and the reason it failed, if it did.  Log lines and errors are
+        truncated to ``SUMMARY_TEXT_LENGTH``.
+
+        @returns a tuple of the current operation and the summary
+        """
+        index = cls.current_index(info)
+        ops = [op.get('OP_ID') for op in info.get('ops') or []]
+        log = error = None
+        try:
+            log = _clip(info['oplog'][index][-1][3])
+        except (KeyError, IndexError, TypeError):
+            pass
+        if info.get('status') == 'error':
+            try:
+                error = _clip(info['opresult'][index][1][0])
+            except (KeyError, IndexError, TypeError):
+                pass
+        current_op = ops[index] if index < len(ops) else None
+        return current_op or '', {
+            'id': info.get('id'),
+            'status': info.get('status'),
+            'ops': ops,
+            'opstatus': info.get('opstatus') or [],
+            'current': index,
+            'log': log,
+            'error': error,
+        }
+
+    def status_info(self):
+        """
+        Rebuild, from ``summary``, the subset of the info used by the job
+        status poller: the operations, their statuses, and only the last log
+        line and the error of the current operation.
+        """
+        if not self.summary:
+            return self.info
+        summary = json.loads(self.summary)
+        count = len(summary['ops'])
+        index = summary['current']
+        oplog = [[] for i in range(count)]
+        opresult = [None] * count
+        if index < count:
+            if summary['log'] is not None:
+                oplog[index] = [[None, None, None, summary['log']]]
+            if summary['error'] is not None:
+                opresult[index] = [None, [summary['error']]]
+        return {
+            'id': summary['id'],
+            'status': summary['status'],
+            'ops': [{'OP_ID': op} for op in summary['ops']],
+            'opstatus': summary['opstatus'],
+            'oplog': oplog,
+            'opresult': opresult,
+            'summary': True,
+        }
+
     @staticmethod
     def parse_end_timestamp(info):
         sec, micro = info['end_ts']
@@ -142,13 +276,10 @@ class Job(CachedClusterObject):
 
         @returns raw name of the current operation
         """
+        if self.current_op:
+            return self.current_op
         info = self.info
-        index = 0
-        for i in range(len(info['opstatus'])):
-            if info['opstatus'][i] != 'success':
-                index = i
-                break
-        return info['ops'][index]['OP_ID']
+        return info['ops'][self.current_index(info)]['OP_ID']
 
     @property
     def operation(self):
@@ -162,3 +293,54 @@ class Job(CachedClusterObject):
                                              self.status)
 
     __unicode__ = __repr__
+
+
+class ArchivedJob(models.Model):
+    """
+    A finished Job moved out of the Job table by ``archive_jobs()``.  The
+    cached info is kept compressed, since archived jobs are rarely read.
+    """
+    job_id = models.IntegerField()
+    content_type = models.ForeignKey(ContentType, related_name="+")
+    object_id = models.IntegerField()
+    obj = GenericForeignKey('content_type', 'object_id')
+    cluster = models.ForeignKey('clusters.Cluster',
+                                related_name='archived_jobs', editable=False)
+    finished = models.DateTimeField(null=True, blank=True, db_index=True)
+    status = models.CharField(max_length=10)
+    op = models.CharField(max_length=50)
+    compressed_info = models.TextField(default="", editable=False)
+
+    @staticmethod
+    def compress(serialized_info):
+        return b64encode(zlib.compress(str(serialized_info)))
+
+    @property
+    def info(self):
+        if not self.compressed_info:
+            return None
+        return cPickle.loads(zlib.decompress(b64decode(self.compressed_info)))
+
+    def __repr__(self):
+        return "<ArchivedJob %d (%d), status %r>" % (self.id, self.job_id,
+                                                     self.status)
+
+    __unicode__ = __repr__
+
+
+def pending_job_counts():
+    """
+    Count the unfinished jobs of every cluster, by status.  Only unfinished
+    rows are read, through the index on ``finished``.  Archived jobs whose
+    outcome is unknown are not counted.
+
+    @returns a list of ((hostname, status), count) tuples
+    """
+    jobs = Job.objects.filter(finished__isnull=True) \
+        .exclude(status='unknown').order_by() \
+        .values('cluster__hostname', 'status').annotate(count=Count('id'))
+    return [((job['cluster__hostname'], job['status']), job['count'])
+            for job in jobs]
+
+PENDING_JOBS = Gauge('gwm_jobs_pending', 'Jobs which have not finished yet.',
+                     ('cluster', 'status'), collect=pending_job_counts)
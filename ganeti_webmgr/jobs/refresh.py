@@ -0,0 +1,188 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Refreshing the status of pending jobs, a cluster at a time.
+
+Objects with pending jobs used to poll the status of each of their jobs
+whenever they were loaded, so a page listing several of them sent one
+request per job.  ``refresh_cluster_jobs()`` fetches the status of every
+pending job of a cluster at once, updates the jobs in a single transaction,
+and completes the objects whose jobs have all finished.
+"""
+
+import cPickle
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.ganeti_web.caps import GANETI25
+from ganeti_webmgr.utils import (commit_on_success_unless_managed, get_rapi,
+                                 rapi_map)
+from ganeti_webmgr.utils.client import GanetiApiError
+
+from .models import Job
+
+FINISHED = ('success', 'error', 'unknown')
+
+# Set while the jobs of a cluster were refreshed moments ago.
+JOBS_REFRESHED_KEY = 'jobs:refreshed:%s'
+
+
+def fetch_jobs(cluster_id, rapi, job_ids, bulk=False):
+    """
+    Fetch the status of some jobs of a cluster.
+
+    With ``bulk``, every job in the cluster's queue is fetched with a single
+    request; clusters which don't support it return job ids only, in which
+    case the jobs are fetched one by one, concurrently.
+
+    @returns a dictionary mapping job ids to their info, or to None if
+             Ganeti no longer knows about the job.  Jobs which couldn't be
+             fetched are left out.
+    """
+    if bulk and len(job_ids) > 1:
+        try:
+            infos = rapi.GetJobs(bulk=True)
+        except GanetiApiError:
+            infos = None
+        if infos and all(isinstance(info, dict) and 'status' in info
+                         for info in infos):
+            found = dict((int(info['id']), info) for info in infos)
+            return dict((job_id, found.get(job_id)) for job_id in job_ids)
+
+    fetched = {}
+    for job_id, info, error in rapi_map(cluster_id, rapi.GetJobStatus,
+                                        job_ids):
+        if error is None:
+            fetched[job_id] = info
+        elif isinstance(error, GanetiApiError) and error.code == 404:
+            # archived before its outcome was seen
+            fetched[job_id] = None
+    return fetched
+
+
+def _complete(cluster_id, finished):
+    """
+    Complete the objects whose pending jobs have all finished.
+
+    ``_complete_job()`` is called for each job in order, and the objects are
+    updated with its results, without being loaded.  Objects which must be
+    deleted are left alone; they delete themselves when next loaded, as
+    deletion requires an instance.
+
+    @param finished  dictionary mapping (content type id, object id) to the
+                     (op, status) of the object's finished jobs
+    @returns a dictionary mapping (content type id, object id) to the updates
+             made to each object
+    """
+    by_type = {}
+    for ct_id, object_id in finished:
+        by_type.setdefault(ct_id, []).append(object_id)
+
+    results = {}
+    now_pending = Job.objects.filter(ignore_cache=True) \
+        .values_list('content_type', 'object_id')
+    for ct_id, object_ids in by_type.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        hostnames = dict(model.objects.filter(pk__in=object_ids)
+                         .values_list('id', 'hostname'))
+        pending = set(now_pending.filter(content_type=ct_id,
+                                         object_id__in=object_ids))
+        for object_id, hostname in hostnames.items():
+            key = (ct_id, object_id)
+            if key in pending:
+                continue
+            updates = {}
+            for op, status in finished[key]:
+                updates.update(model._complete_job(cluster_id, hostname, op,
+                                                   status) or {})
+            if 'deleted' in updates:
+                results[key] = {'deleted': True}
+                continue
+            updates.update(ignore_cache=False, last_job=None)
+            results[key] = updates
+            # the object is refreshed when next loaded
+            model.objects.filter(pk=object_id).update(cached=None, **updates)
+    return results
+
+
+def jobs_refreshed(cluster_id):
+    """
+    Whether the jobs of a cluster were refreshed less than
+    ``JOB_REFRESH_INTERVAL`` seconds ago, by this or another request.  Their
+    status is unlikely to have changed since, so objects loaded meanwhile,
+    such as the other objects listed on the same page, don't refresh them
+    again.
+    """
+    return bool(settings.JOB_REFRESH_INTERVAL
+                and cache.get(JOBS_REFRESHED_KEY % cluster_id))
+
+
+def refresh_cluster_jobs(cluster_id):
+    """
+    Refresh every pending job of a cluster.
+
+    The jobs are fetched with ``fetch_jobs()``, in bulk if the cluster
+    supports it, and updated in a single transaction.  The objects whose jobs
+    have all finished are then completed by ``_complete()``.
+
+    @returns a dictionary mapping (content type id, object id) to the updates
+             made to each object completed
+    """
+    if settings.JOB_REFRESH_INTERVAL:
+        cache.set(JOBS_REFRESHED_KEY % cluster_id, True,
+                  settings.JOB_REFRESH_INTERVAL)
+
+    pending = list(Job.objects.filter(cluster=cluster_id, ignore_cache=True)
+                   .order_by('job_id')
+                   .values_list('id', 'job_id', 'content_type', 'object_id'))
+    if not pending:
+        return {}
+
+    (hash, capability), = Cluster.objects.filter(pk=cluster_id) \
+        .values_list('hash', 'capability')
+    infos = fetch_jobs(cluster_id, get_rapi(hash, cluster_id),
+                       [job_id for pk, job_id, ct_id, object_id in pending],
+                       bulk=capability is not None and capability >= GANETI25)
+
+    now = datetime.now()
+    finished = {}
+    with commit_on_success_unless_managed():
+        for pk, job_id, ct_id, object_id in pending:
+            if job_id not in infos:
+                continue
+            info = infos[job_id]
+            if info is None:
+                data = {'status': 'unknown', 'ignore_cache': False}
+                Job.objects.filter(pk=pk).update(**data)
+            elif Job.valid_job(info):
+                data = Job.parse_persistent_info(info)
+                Job.objects.filter(pk=pk).update(
+                    serialized_info=cPickle.dumps(info), cached=now, **data)
+            else:
+                continue
+            if data['status'] in FINISHED:
+                finished.setdefault((ct_id, object_id), []) \
+                    .append((data.get('op'), data['status']))
+
+        if not finished:
+            return {}
+        return _complete(cluster_id, finished)
@@ -15,14 +15,29 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
+import cPickle
+from datetime import datetime, timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+# Per #6579, do not change this import without discussion.
+from django.utils import simplejson as json
 
-from ganeti_webmgr.utils.proxy import CallProxy
+from ganeti_webmgr.ganeti_web.caps import GANETI25
+from ganeti_webmgr.utils.proxy import CallProxy, ResponseMap
 from ganeti_webmgr.utils.proxy.constants import JOB, JOB_RUNNING, JOB_ERROR
 from ganeti_webmgr.virtualmachines.tests.views.base import (
     VirtualMachineTestCaseMixin)
 
-from ..models import Job
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
+from ganeti_webmgr.vm_templates.models import InstanceBatch
+
+from ..archive import archivable_jobs, archive_jobs
+from ..models import ArchivedJob, Job
+from ..refresh import JOBS_REFRESHED_KEY, refresh_cluster_jobs
 
 
 class TestJobMixin(VirtualMachineTestCaseMixin):
@@ -171,3 +186,203 @@ class TestJobModel(TestJobMixin, TestCase):
         job.load_info()
         self.assertFalse(job.ignore_cache)
         job._refresh.assertNotCalled(self)
+
+    def test_summary(self):
+        """
+        Tests the summary stored when a job's info is parsed.
+
+        Verifies:
+            * the current operation and summary are stored
+            * the status info is built from the summary, with only the last
+              log line and the error
+            * finished jobs are loaded without unpickling their info
+        """
+        job = Job.objects.create(job_id=1, obj=self.vm, cluster=self.cluster)
+        info = dict(JOB_ERROR)
+        info['oplog'] = [[[1, [1291836084, 0], 'message', 'first'],
+                          [2, [1291836084, 1], 'message', 'last']]]
+        job.info = info
+        job.save()
+
+        job = Job.objects.get(pk=job.pk)
+        self.assertFalse(job.ignore_cache)
+        self.assertEqual('OP_INSTANCE_REBOOT', job.current_op)
+        self.assertEqual('OP_INSTANCE_REBOOT', job.current_operation)
+
+        status = job.status_info()
+        self.assertEqual('1', status['id'])
+        self.assertEqual('error', status['status'])
+        self.assertEqual([{'OP_ID': 'OP_INSTANCE_REBOOT'}], status['ops'])
+        self.assertEqual(['error'], status['opstatus'])
+        self.assertEqual([[[None, None, None, 'last']]], status['oplog'])
+        self.assertEqual(JOB_ERROR['opresult'][0][1][0],
+                         status['opresult'][0][1][0])
+
+        # loading a finished job never unpickles its info
+        Job.objects.filter(pk=job.pk).update(serialized_info='invalid')
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual('error', job.status_info()['status'])
+
+
+class TestJobArchive(TestJobMixin, TestCase):
+
+    def test_archive_jobs(self):
+        """
+        Finished jobs are moved to the archive in batches, except for jobs
+        which are still the last job of an object.
+        """
+        now = datetime.now()
+        old = now - timedelta(days=100)
+        info = cPickle.dumps(JOB)
+        current_op, summary = Job.summarize(JOB)
+
+        def create(finished):
+            job = Job.objects.create(job_id=1, obj=self.vm,
+                                     cluster=self.cluster)
+            Job.objects.filter(pk=job.pk).update(
+                finished=finished, status='success', ignore_cache=False,
+                serialized_info=info, current_op=current_op,
+                summary=json.dumps(summary))
+            return job.pk
+
+        archived = [create(old), create(old), create(old)]
+        last = create(old)
+        kept = [last, create(now), create(None)]
+        # a freshly cached VM isn't refreshed, which would clear last_job
+        VirtualMachine.objects.filter(pk=self.vm.pk).update(last_job=last,
+                                                            cached=now)
+
+        before = now - timedelta(days=90)
+        self.assertEqual(3, archivable_jobs(before).count())
+        self.assertEqual(3, archive_jobs(before, batch_size=2))
+
+        self.assertEqual(set(kept),
+                         set(Job.objects.values_list('id', flat=True)))
+        self.assertTrue(VirtualMachine.objects.filter(pk=self.vm.pk)
+                        .exists())
+        self.assertEqual(3, ArchivedJob.objects.count())
+        for job in ArchivedJob.objects.all():
+            self.assertEqual(self.vm, job.obj)
+            self.assertEqual(JOB, job.info)
+            self.assertEqual('success', job.status)
+            self.assertEqual(old, job.finished)
+        self.assertEqual(0, archive_jobs(before))
+
+        # pruning deletes jobs without archiving them
+        VirtualMachine.objects.filter(pk=self.vm.pk).update(last_job=None)
+        call_command('archivejobs', days=90, dry_run=True, verbosity=0)
+        self.assertEqual(3, Job.objects.count())
+        call_command('archivejobs', days=90, prune=True, verbosity=0)
+        self.assertEqual(set(kept[1:]),
+                         set(Job.objects.values_list('id', flat=True)))
+        self.assertEqual(3, ArchivedJob.objects.count())
+
+    def test_archive_keeps_batches(self):
+        """
+        The jobs of a batch are never archived, so its progress stays
+        finished.
+        """
+        old = datetime.now() - timedelta(days=100)
+        batch = InstanceBatch.objects.create(cluster=self.cluster,
+                                             hostname_pattern='vm#',
+                                             count=2)
+        for job_id in (1, 2):
+            job = Job.objects.create(job_id=job_id, obj=self.vm,
+                                     cluster=self.cluster)
+            Job.objects.filter(pk=job.pk).update(
+                finished=old, status='success', ignore_cache=False)
+            batch.jobs.add(job)
+        progress = batch.progress()
+        self.assertTrue(progress['finished'])
+
+        before = old + timedelta(days=10)
+        self.assertEqual(0, archivable_jobs(before).count())
+        self.assertEqual(0, archive_jobs(before))
+        call_command('archivejobs', days=90, prune=True, verbosity=0)
+        self.assertEqual(progress, batch.progress())
+
+
+class TestJobRefresh(TestJobMixin, TestCase):
+
+    def test_refresh_cluster_jobs(self):
+        """
+        Pending jobs of a cluster are refreshed all at once.
+
+        Verifies:
+            * jobs are fetched with a single bulk request when supported, or
+              one request per job otherwise
+            * objects whose jobs have all finished are completed without
+              being loaded
+            * objects with jobs still running are left alone
+        """
+        vm2, cluster = self.create_virtual_machine(self.cluster,
+                                                   'vm2.example.bak')
+        job1 = Job.objects.create(job_id=1, obj=self.vm, cluster=cluster)
+        job2 = Job.objects.create(job_id=2, obj=vm2, cluster=cluster)
+        for vm, job in ((self.vm, job1), (vm2, job2)):
+            VirtualMachine.objects.filter(pk=vm.pk) \
+                .update(last_job=job, ignore_cache=True)
+
+        def vm_state(vm):
+            return VirtualMachine.objects.filter(pk=vm.pk) \
+                .values_list('ignore_cache', 'last_job', 'cached')[0]
+
+        rapi = cluster.rapi
+        rapi.GetJobs.response = [dict(JOB, id='1'),
+                                 dict(JOB_RUNNING, id='2')]
+        rapi.GetJobs.reset()
+        rapi.GetJobStatus.reset()
+        Cluster.objects.filter(pk=cluster.pk).update(capability=GANETI25)
+
+        vm_type = ContentType.objects.get_for_model(VirtualMachine)
+        results = refresh_cluster_jobs(cluster.pk)
+        rapi.GetJobs.assertCalled(self)
+        rapi.GetJobStatus.assertNotCalled(self)
+        self.assertEqual({(vm_type.id, self.vm.pk): {'ignore_cache': False,
+                                                     'last_job': None}},
+                         results)
+        self.assertEqual(
+            ('success', False, 'OP_INSTANCE_SHUTDOWN'),
+            Job.objects.filter(pk=job1.pk)
+            .values_list('status', 'ignore_cache', 'current_op')[0])
+        self.assertEqual((False, None, None), vm_state(self.vm))
+        self.assertEqual((True, job2.pk), vm_state(vm2)[:2])
+
+        # without bulk support, each pending job is fetched
+        Cluster.objects.filter(pk=cluster.pk).update(capability=None)
+        rapi.GetJobs.reset()
+        rapi.GetJobStatus.response = ResponseMap([(((2,), {}), JOB)])
+        results = refresh_cluster_jobs(cluster.pk)
+        rapi.GetJobs.assertNotCalled(self)
+        rapi.GetJobStatus.assertCalled(self)
+        self.assertEqual([(vm_type.id, vm2.pk)], results.keys())
+        self.assertEqual((False, None, None), vm_state(vm2))
+        self.assertEqual({}, refresh_cluster_jobs(cluster.pk))
+
+    def test_check_job_status_throttled(self):
+        """
+        Loading several objects with pending jobs refreshes the jobs of
+        their cluster once, rather than once per object.
+        """
+        vm2, cluster = self.create_virtual_machine(self.cluster,
+                                                   'vm2.example.bak')
+        job1 = Job.objects.create(job_id=1, obj=self.vm, cluster=cluster)
+        job2 = Job.objects.create(job_id=2, obj=vm2, cluster=cluster)
+        for vm, job in ((self.vm, job1), (vm2, job2)):
+            VirtualMachine.objects.filter(pk=vm.pk) \
+                .update(last_job=job, ignore_cache=True)
+        Cluster.objects.filter(pk=cluster.pk).update(capability=GANETI25)
+
+        rapi = cluster.rapi
+        rapi.GetJobs.response = [dict(JOB_RUNNING, id='1'),
+                                 dict(JOB_RUNNING, id='2')]
+        rapi.GetJobs.reset()
+        cache.delete(JOBS_REFRESHED_KEY % cluster.pk)
+
+        list(VirtualMachine.objects.filter(cluster=cluster))
+        self.assertEqual(1, len(rapi.GetJobs.calls))
+
+        # refreshed again once the interval is over
+        cache.delete(JOBS_REFRESHED_KEY % cluster.pk)
+        VirtualMachine.objects.get(pk=vm2.pk)
+        self.assertEqual(2, len(rapi.GetJobs.calls))
@@ -0,0 +1,213 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Progress of node evacuations and migrations.
+
+Ganeti evacuates or migrates a node with a single job, which submits one
+job per instance moved and returns their ids.  ``node_progress()`` follows
+those jobs without touching the instances; once all of them have finished
+the moved instances are fetched with a single bulk request and their nodes
+updated in one pass, instead of every instance refreshing itself and
+polling its own jobs.
+"""
+
+import cPickle
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import Q
+
+from ganeti_webmgr.authentication.models import ResourceUsage
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.ganeti_web.backend.queries import invalidate_used_resources
+from ganeti_webmgr.jobs.models import Job
+from ganeti_webmgr.utils import (commit_on_success_unless_managed, get_rapi,
+                                 rapi_map)
+from ganeti_webmgr.utils.client import GanetiApiError
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
+
+from .models import Node
+
+NODE_OPS = ('OP_NODE_EVACUATE', 'OP_NODE_MIGRATE')
+FINISHED = ('success', 'error', 'canceled', 'unknown')
+
+# Statuses of finished sub-jobs never change, so they are cached for a day.
+SUB_JOBS_KEY = 'nodes:operation:%s'
+SUB_JOBS_TIMEOUT = 86400
+
+
+def sub_job_ids(info):
+    """
+    Return the ids of the jobs submitted by a node evacuation or migration
+    job.  Older versions of Ganeti moved the instances within the job itself
+    and submit no jobs.
+    """
+    ids = []
+    for result in info.get('opresult') or []:
+        if isinstance(result, dict):
+            for submitted, job_id in result.get('jobs', []):
+                if submitted:
+                    ids.append(int(job_id))
+    return ids
+
+
+def _instance_name(info):
+    for op in info.get('ops') or []:
+        if op.get('instance_name'):
+            return op['instance_name']
+
+
+def _sub_jobs(job, rapi):
+    """
+    Return the status of every job submitted by ``job``, along with the
+    instance it moves and when it finished.  Only unfinished jobs are
+    fetched, concurrently.
+
+    @returns a dictionary mapping job ids to (status, instance, end_ts)
+    """
+    key = SUB_JOBS_KEY % job.pk
+    jobs = cache.get(key) or {}
+    pending = [job_id for job_id in sub_job_ids(job.info)
+               if jobs.get(job_id, (None,))[0] not in FINISHED]
+    if not pending:
+        return jobs
+
+    for job_id, info, error in rapi_map(job.cluster_id, rapi.GetJobStatus,
+                                        pending):
+        if error is None:
+            jobs[job_id] = (info['status'], _instance_name(info),
+                            info.get('end_ts'))
+        elif isinstance(error, GanetiApiError) and error.code == 404:
+            # archived before its outcome was seen
+            jobs[job_id] = ('unknown', None, None)
+        elif job_id not in jobs:
+            jobs[job_id] = ('queued', None, None)
+    cache.set(key, jobs, SUB_JOBS_TIMEOUT)
+    return jobs
+
+
+def refresh_instances(cluster_id, hostnames, since=None):
+    """
+    Refresh the cached info of some instances of a cluster from a single
+    bulk request, and update their nodes from a single query of the nodes of
+    the cluster.
+
+    @param since  only refresh instances not cached since then
+    @returns the number of instances refreshed
+    """
+    vms = VirtualMachine.objects.filter(cluster=cluster_id,
+                                        hostname__in=hostnames)
+    if since is not None:
+        vms = vms.filter(Q(cached__isnull=True) | Q(cached__lt=since))
+    current = dict((hostname, (status, owner)) for hostname, status, owner
+                   in vms.values_list('hostname', 'status', 'owner'))
+    if not current:
+        return 0
+
+    (hash,) = Cluster.objects.filter(pk=cluster_id) \
+        .values_list('hash', flat=True)
+    infos = [info for info in get_rapi(hash, cluster_id)
+             .GetInstances(bulk=True) if info['name'] in current]
+    nodes = dict(Node.objects.filter(cluster=cluster_id)
+                 .values_list('hostname', 'id'))
+
+    now = datetime.now()
+    owners = set()
+    with commit_on_success_unless_managed():
+        for info in infos:
+            status, owner = current[info['name']]
+            if info['status'] != status:
+                owners.add(owner)
+            snodes = info['snodes']
+            VirtualMachine.objects \
+                .filter(cluster=cluster_id, hostname=info['name']) \
+                .update(serialized_info=cPickle.dumps(info), cached=now,
+                        mtime=datetime.fromtimestamp(info['mtime'])
+                        if info['mtime'] else None,
+                        status=info['status'],
+                        primary_node=nodes.get(info['pnode']),
+                        secondary_node=nodes.get(snodes[0])
+                        if snodes else None)
+        owners.discard(None)
+        if owners:
+            # running resources are counted by status
+            ResourceUsage.rebuild(owners=owners, clusters=[cluster_id])
+            invalidate_used_resources(*owners)
+    return len(infos)
+
+
+def node_progress(node_id):
+    """
+    Return the progress of the latest evacuation or migration of a node.
+
+    The job is refreshed through the ``Job`` model, and the jobs it
+    submitted through ``_sub_jobs()``.  When all of them have finished, the
+    instances they moved are refreshed with ``refresh_instances()``; an
+    instance is only refreshed once, since its cache is then newer than the
+    jobs.
+
+    @returns a dictionary describing the progress, or None if the node was
+             never evacuated nor migrated
+    """
+    ct = ContentType.objects.get_for_model(Node)
+    jobs = Job.objects.filter(content_type=ct, object_id=node_id) \
+        .filter(Q(op__in=NODE_OPS) | Q(op='')).order_by('-id')[:1]
+    if not jobs or jobs[0].op not in NODE_OPS:
+        return None
+    job = jobs[0]
+
+    sub_jobs = {}
+    if job.status == 'success':
+        sub_jobs = _sub_jobs(job, get_rapi(job.cluster_hash, job.cluster_id))
+
+    finished = [job_id for job_id, (status, instance, end_ts)
+                in sub_jobs.items() if status in FINISHED]
+    done = job.status in FINISHED and len(finished) == len(sub_jobs)
+    refreshed = 0
+    if done and job.status == 'success':
+        if sub_jobs:
+            hostnames = [instance for status, instance, end_ts
+                         in sub_jobs.values() if instance]
+            ends = [end_ts for status, instance, end_ts in sub_jobs.values()
+                    if end_ts]
+            since = Job.parse_end_timestamp({'end_ts': max(ends)}) \
+                if ends else job.finished
+        else:
+            # the instances were moved by the job itself; until they are
+            # refreshed they are still found on the node
+            hostnames = VirtualMachine.objects \
+                .filter(Q(primary_node=node_id) | Q(secondary_node=node_id)) \
+                .values_list('hostname', flat=True)
+            since = job.finished
+        refreshed = refresh_instances(job.cluster_id, list(hostnames), since)
+
+    return {
+        'job': job.job_id,
+        'op': job.op,
+        'status': job.status,
+        'total': len(sub_jobs),
+        'finished': len(finished),
+        'failed': len([job_id for job_id in finished
+                       if sub_jobs[job_id][0] != 'success']),
+        'jobs': [{'id': job_id, 'status': status, 'instance': instance}
+                 for job_id, (status, instance, end_ts)
+                 in sorted(sub_jobs.items())],
+        'done': done,
+        'refreshed': refreshed,
+    }
@@ -16,7 +16,7 @@
 # USA.
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, Client
 # Per #6579, do not change this import without discussion.
 from django.utils import simplejson as json
 
@@ -26,9 +26,12 @@ from ganeti_webmgr.django_test_tools.views import ViewTestMixin
 from .models import NodeTestCaseMixin
 
 from ganeti_webmgr.utils.client import GanetiApiError
+from ganeti_webmgr.utils.proxy import ResponseMap
+from ganeti_webmgr.utils.proxy.constants import INSTANCE, JOB
 
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
+from ganeti_webmgr.jobs.models import Job
 from ganeti_webmgr.nodes.models import Node
 
 
@@ -51,6 +54,7 @@ class TestNodeViews(TestCase, NodeTestCaseMixin, UserTestMixin, ViewTestMixin):
         self.user_admin.grant('admin', cluster)
 
     def tearDown(self):
+        Job.objects.all().delete()
         VirtualMachine.objects.all().delete()
         Node.objects.all().delete()
         Cluster.objects.all().delete()
@@ -239,3 +243,80 @@ class TestNodeViews(TestCase, NodeTestCaseMixin, UserTestMixin, ViewTestMixin):
         self.assert_200(url, args, [self.superuser], data=data, method='post',
                         mime='application/json', tests=test)
         self.node.rapi.EvacuateNode.error = None
+
+    def test_progress(self):
+        args = (self.cluster.slug, self.node.hostname)
+        url = '/cluster/%s/node/%s/progress'
+        users = [self.superuser, self.user_migrate, self.user_admin]
+        self.assert_standard_fails(url, args)
+
+        c = Client()
+
+        def content():
+            self.assertTrue(c.login(username=self.superuser.username,
+                                         password='secret'))
+            response = c.get(url % args)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('application/json', response['content-type'])
+            return json.loads(response.content)
+
+        # never evacuated
+        self.assert_200(url, args, users, mime='application/json')
+        self.assertEqual(None, content())
+
+        vm1 = VirtualMachine.objects.create(cluster=self.cluster,
+                                            hostname='vm1.example.bak',
+                                            primary_node=self.node)
+        vm2 = VirtualMachine.objects.create(cluster=self.cluster,
+                                            hostname='vm2.example.bak',
+                                            primary_node=self.node)
+        evacuation = dict(JOB, id=5, status='success', opstatus=['success'],
+                          ops=[{'OP_ID': 'OP_NODE_EVACUATE',
+                                'node_name': self.node.hostname}],
+                          opresult=[{'jobs': [[True, 6], [True, 7]]}])
+
+        def job(id, vm, status):
+            return dict(JOB, id=id, status=status,
+                        ops=[{'OP_ID': 'OP_INSTANCE_MIGRATE',
+                              'instance_name': vm.hostname}])
+
+        def instance(vm):
+            return dict(INSTANCE, name=vm.hostname, pnode=self.node2.hostname,
+                        snodes=[self.node.hostname])
+
+        rapi = self.cluster.rapi
+        jobs = {5: evacuation, 6: job(6, vm1, 'success'),
+                7: job(7, vm2, 'running')}
+        rapi.GetInstances.response = [instance(vm1), instance(vm2), INSTANCE]
+        rapi.GetInstances.reset()
+        rapi.GetJobStatus.response = ResponseMap(
+            [(((id,), {}), info) for id, info in jobs.items()])
+        Job.objects.create(job_id=5, obj=self.node,
+                           cluster_id=self.cluster.id)
+
+        # one of the instances is still being migrated
+        data = content()
+        self.assertEqual('OP_NODE_EVACUATE', data['op'])
+        self.assertEqual((2, 1, 0), (data['total'], data['finished'],
+                                     data['failed']))
+        self.assertFalse(data['done'])
+        rapi.GetInstances.assertNotCalled(self)
+
+        # all of them were moved, refresh them together
+        jobs[7]['status'] = 'success'
+        data = content()
+        self.assertEqual((2, 2, 0), (data['total'], data['finished'],
+                                     data['failed']))
+        self.assertTrue(data['done'])
+        self.assertEqual(2, data['refreshed'])
+        self.assertEqual(1, len(rapi.GetInstances.calls))
+        for vm in VirtualMachine.objects.filter(pk__in=[vm1.pk, vm2.pk]) \
+                .values('primary_node', 'secondary_node', 'cached'):
+            self.assertEqual(self.node2.pk, vm['primary_node'])
+            self.assertEqual(self.node.pk, vm['secondary_node'])
+            self.assertTrue(vm['cached'])
+
+        # the instances are only refreshed once
+        data = content()
+        self.assertEqual(0, data['refreshed'])
+        self.assertEqual(1, len(rapi.GetInstances.calls))
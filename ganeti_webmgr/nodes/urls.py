@@ -26,4 +26,5 @@ urlpatterns = patterns(
     url(r'^%s/role/?$' % node_prefix, 'role', name="node-role"),
     url(r'^%s/migrate/?$' % node_prefix, 'migrate', name="node-migrate"),
     url(r'^%s/evacuate/?$' % node_prefix, 'evacuate', name="node-evacuate"),
+    url(r'^%s/progress/?$' % node_prefix, 'progress', name="node-progress"),
 )
@@ -39,6 +39,9 @@ from ganeti_webmgr.virtualmachines.views import BaseVMListView
 
 from .forms import RoleForm, MigrateForm, EvacuateForm
 from .models import Node
+from .operations import node_progress
+from ganeti_webmgr.authentication.models import EffectivePermission
+from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.jobs.models import Job
 
 
@@ -285,16 +288,39 @@ def evacuate(request, cluster_slug, host):
                               context_instance=RequestContext(request))
 
 
+@login_required
+def progress(request, cluster_slug, host):
+    """
+    Return the progress of the latest evacuation or migration of a node, and
+    of the jobs it submitted.  Neither the node nor its instances are loaded.
+    """
+    nodes = Node.objects.filter(cluster__slug=cluster_slug, hostname=host) \
+        .values_list('id', 'cluster')
+    if not nodes:
+        raise Http404('Node does not exist')
+    node_id, cluster_id = nodes[0]
+
+    user = request.user
+    if not (user.is_superuser or EffectivePermission.objects
+            .object_ids(user, Cluster, ['admin', 'migrate'])
+            .filter(object_id=cluster_id).exists()):
+        raise PermissionDenied(NO_PRIVS)
+
+    return HttpResponse(json.dumps(node_progress(node_id)),
+                        mimetype='application/json')
+
+
 @login_required
 def job_status(request, id, rest=False):
     """
-    Return a list of basic info for running jobs.
+    Return a list of basic info for running jobs.  Only the summary of each
+    job is sent; see ``Job.status_info()``.
     """
     ct = ContentType.objects.get_for_model(Node)
     jobs = Job.objects.filter(status__in=("error", "running", "waiting"),
                               content_type=ct,
                               object_id=id).order_by('job_id')
-    jobs = [j.info for j in jobs]
+    jobs = [j.status_info() for j in jobs]
 
     if rest:
         return jobs
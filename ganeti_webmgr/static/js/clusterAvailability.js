@@ -0,0 +1,36 @@
+$(function() {
+    /*
+     * Check that the cluster selected in the VM creation wizard is available.
+     *
+     * Choices are listed without contacting any cluster; the selected one is
+     * checked in the background so that problems are reported before the
+     * form is submitted.
+     */
+
+    var $select = $("select[name$='cluster']");
+    var $message = $("<span class='cluster_availability' />");
+    var xhr;
+
+    function check() {
+        var id = $select.val();
+        if (xhr !== undefined) {
+            xhr.abort();
+        }
+        $message.empty();
+        if (!id) {
+            return;
+        }
+        xhr = $.getJSON("/cluster/" + id + "/available/", function(data) {
+            if (!data.available) {
+                $message.addClass("error").text(
+                    "This cluster is currently unavailable. Please check " +
+                    "for Errors on the cluster detail page.");
+            } else {
+                $message.removeClass("error");
+            }
+        });
+    }
+
+    $select.after($message).change(check);
+    check();
+});
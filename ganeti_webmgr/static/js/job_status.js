@@ -165,6 +165,11 @@ function JobPoller() {
                     scrollable.append(log_html);
                 }
                 var log = data['oplog'][op_index];
+                if (data.summary) {
+                    // summaries only carry the latest log line
+                    log_html.children("ul").empty();
+                    current_log_count = 0;
+                }
                 for (var i=current_log_count; i<log.length; i++) {
                     log_html.children("ul")
                     .append("<li>"+log[i][3]+"</li>");
@@ -1,23 +1,101 @@
+import logging
 import random
 import string
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from Queue import Queue, Empty
+from threading import BoundedSemaphore, Lock, RLock, Thread
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
 
 from .client import GanetiRapiClient, GanetiApiError
+from .instrumentation import propagate, record_cache
 from .proxy import RapiProxy, XenRapiProxy
 
 from ganeti_webmgr.ganeti_web import constants
 from ganeti_webmgr.ganeti_web.caps import has_balloonmem
 
+logger = logging.getLogger(__name__)
+
 
 def generate_random_password(length=12):
     "Generate random sequence of specified length"
     return "".join(random.sample(string.letters + string.digits, length))
 
 
-RAPI_CACHE = {}
-RAPI_CACHE_HASHES = {}
+class RapiRegistry(object):
+    """
+    A thread-safe cache of RAPI clients, keyed by the hash of the credentials
+    of their cluster.  At most ``RAPI_CLIENT_CACHE_SIZE`` clients are kept;
+    the least recently used client is dropped first.
+
+    Each cluster has at most one client.  When its credentials change, the
+    client for the old hash is replaced.
+    """
+
+    def __init__(self):
+        # hash -> client, least recently used first
+        self.clients = OrderedDict()
+        # cluster id -> hash
+        self.hashes = {}
+        self.lock = RLock()
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, hash):
+        return hash in self.clients
+
+    def get(self, hash):
+        """
+        Return the client for a hash and mark it as recently used, or None.
+        """
+        with self.lock:
+            client = self.clients.pop(hash, None)
+            if client is not None:
+                self.clients[hash] = client
+            return client
+
+    def add(self, cluster_id, hash, client):
+        """
+        Cache the client of a cluster, replacing any client for older
+        credentials.  If another thread cached a client for the same hash
+        first, that client is kept.
+
+        @returns the cached client
+        """
+        with self.lock:
+            if hash in self.clients:
+                return self.get(hash)
+            self.invalidate(cluster_id)
+            self.clients[hash] = client
+            self.hashes[cluster_id] = hash
+            while len(self.clients) > settings.RAPI_CLIENT_CACHE_SIZE:
+                evicted, _ = self.clients.popitem(last=False)
+                for pk, value in self.hashes.items():
+                    if value == evicted:
+                        del self.hashes[pk]
+            return client
+
+    def invalidate(self, cluster_id, hash=None):
+        """
+        Drop the client of a cluster, unless it is for the given hash.
+        """
+        with self.lock:
+            old = self.hashes.get(cluster_id)
+            if old is not None and old != hash:
+                del self.hashes[cluster_id]
+                self.clients.pop(old, None)
+
+    def clear(self):
+        with self.lock:
+            self.clients.clear()
+            self.hashes.clear()
+
+
+RAPI_REGISTRY = RapiRegistry()
 
 
 def get_rapi_client():
@@ -56,10 +134,10 @@ def get_rapi(hash, cluster):
     # preventing circular imports
     from ganeti_webmgr.clusters.models import Cluster
 
-    rapi_client = get_rapi_client()
-
-    if hash in RAPI_CACHE:
-        return RAPI_CACHE[hash]
+    rapi = RAPI_REGISTRY.get(hash)
+    record_cache('rapi_client', rapi is not None)
+    if rapi is not None:
+        return rapi
 
     # always look up the instance, even if we were given a Cluster instance
     # it ensures we are retrieving the latest credentials.  This helps avoid
@@ -69,37 +147,185 @@ def get_rapi(hash, cluster):
         cluster = cluster.id
     (credentials,) = Cluster.objects.filter(id=cluster) \
         .values_list('hash', 'hostname', 'port', 'username', 'password')
-    hash, host, port, user, password = credentials
+    hash = credentials[0]
+
+    # now that we know hash is fresh, check cache again. The original hash
+    # could have been stale. This avoids constructing a new RAPI that already
+    # exists.
+    rapi = RAPI_REGISTRY.get(hash)
+    if rapi is not None:
+        return rapi
+
+    return RAPI_REGISTRY.add(cluster, hash, _create_rapi(*credentials[1:]))
+
+
+def _create_rapi(host, port, user, password):
+    """
+    Create a RAPI client from a cluster's stored credentials.
+    """
+    # preventing circular imports
+    from ganeti_webmgr.clusters.models import Cluster
+
     user = user or None
     # decrypt password
     # XXX django-fields only stores str, convert to None if needed
     password = Cluster.decrypt_password(password) if password else None
     password = None if password in ('None', '') else password
 
-    # now that we know hash is fresh, check cache again. The original hash
-    # could have been stale. This avoids constructing a new RAPI that already
-    # exists.
-    if hash in RAPI_CACHE:
-        return RAPI_CACHE[hash]
+    # Set connect timeout in settings.py so that you do not learn patience.
+    return get_rapi_client()(host, port, user, password,
+                             timeout=settings.RAPI_CONNECT_TIMEOUT)
 
-    # delete any old version of the client that was cached.
-    if cluster in RAPI_CACHE_HASHES:
-        del RAPI_CACHE[RAPI_CACHE_HASHES[cluster]]
 
-    # Set connect timeout in settings.py so that you do not learn patience.
-    rapi = rapi_client(host, port, user, password,
-                       timeout=settings.RAPI_CONNECT_TIMEOUT)
-    RAPI_CACHE[hash] = rapi
-    RAPI_CACHE_HASHES[cluster] = hash
-    return rapi
+def warm_rapi_cache():
+    """
+    Create clients for all clusters ahead of their first use, with a single
+    query.  Meant to be called when a server process starts.
+
+    A cluster whose client can't be created, for instance because of broken
+    credentials, is logged and skipped, so it doesn't keep the server from
+    starting; creating its client is retried when it's first used.
+    """
+    # preventing circular imports
+    from ganeti_webmgr.clusters.models import Cluster
+
+    clusters = Cluster.objects.order_by('-pk').values_list(
+        'id', 'hash', 'hostname', 'port', 'username', 'password')
+    for credentials in clusters[:settings.RAPI_CLIENT_CACHE_SIZE]:
+        cluster, hash = credentials[:2]
+        if hash in RAPI_REGISTRY:
+            continue
+        try:
+            rapi = _create_rapi(*credentials[2:])
+        except Exception:
+            logger.exception('Could not create the RAPI client of %s',
+                             credentials[2])
+            continue
+        RAPI_REGISTRY.add(cluster, hash, rapi)
 
 
 def clear_rapi_cache():
     """
     clears the rapi cache
     """
-    RAPI_CACHE.clear()
-    RAPI_CACHE_HASHES.clear()
+    RAPI_REGISTRY.clear()
+
+
+# Semaphores limiting how many RAPI requests a process sends to each cluster
+# at once, shared by every caller of rapi_map().
+RAPI_SEMAPHORES = {}
+RAPI_SEMAPHORES_LOCK = Lock()
+
+
+def _rapi_semaphore(cluster_id):
+    with RAPI_SEMAPHORES_LOCK:
+        if cluster_id not in RAPI_SEMAPHORES:
+            RAPI_SEMAPHORES[cluster_id] = BoundedSemaphore(
+                settings.RAPI_CONCURRENCY)
+        return RAPI_SEMAPHORES[cluster_id]
+
+
+def rapi_map(cluster_id, func, items):
+    """
+    Call ``func`` for each item concurrently, sending at most
+    ``RAPI_CONCURRENCY`` requests to the cluster at any time.
+
+    ``func`` is run in worker threads and must only talk to Ganeti, never to
+    the database.  Exceptions are caught and returned instead of being
+    raised, so one failed request doesn't abort the others.
+
+    @param cluster_id  id of the cluster the requests are sent to
+    @returns a list of (item, result, error) tuples in the order of items
+    """
+    items = list(items)
+    results = [None] * len(items)
+    semaphore = _rapi_semaphore(cluster_id)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def work():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            with semaphore:
+                try:
+                    results[i] = (item, func(item), None)
+                except Exception, e:
+                    results[i] = (item, None, e)
+
+    # requests made by the workers count towards the calling request
+    work = propagate(work)
+    workers = [Thread(target=work)
+               for i in xrange(min(settings.RAPI_CONCURRENCY, len(items)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+@contextmanager
+def commit_on_success_unless_managed():
+    """
+    Run a block in a transaction which is committed if the block succeeds,
+    like ``transaction.commit_on_success()``, unless a transaction is
+    already being managed, for instance by ``TransactionMiddleware``.  The
+    block then joins that transaction, which is left for its owner to commit
+    or roll back.
+    """
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield
+
+
+def bulk_update(model, values, chunk_size=40):
+    """
+    Update many rows of a model, each with its own values, with a single
+    UPDATE per ``chunk_size`` rows instead of one per row.  Every column is
+    set with a ``CASE`` on the primary key.  Each row takes two parameters
+    per field, so chunks are kept small enough for SQLite's limit of 999
+    parameters per query.
+
+    Objects aren't loaded or saved, so neither ``save()`` nor signals are
+    called.
+
+    @param values  dictionary mapping primary keys to dictionaries of field
+                   values; every row must update the same fields.  Foreign
+                   keys are given by id, under the name of the field.
+    """
+    if not values:
+        return
+    qn = connection.ops.quote_name
+    opts = model._meta
+    pk = qn(opts.pk.column)
+    fields = [opts.get_field(name) for name in values.itervalues().next()]
+
+    values = values.items()
+    cursor = connection.cursor()
+    for i in xrange(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        columns = []
+        params = []
+        for field in fields:
+            column = qn(field.column)
+            # ELSE gives the CASE the type of the column
+            columns.append('%s = CASE %s %s ELSE %s END' % (
+                column, pk, ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                column))
+            for row_pk, row in chunk:
+                params.append(row_pk)
+                params.append(field.get_db_prep_save(row[field.name],
+                                                     connection))
+        params.extend(row_pk for row_pk, row in chunk)
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(opts.db_table), ', '.join(columns), pk,
+            ', '.join(['%s'] * len(chunk))), params)
+    transaction.commit_unless_managed()
 
 
 def cluster_default_info(cluster, hypervisor=None):
@@ -188,15 +414,42 @@ def hv_prettify(hv):
     return prettified.get(hv, hv)
 
 
+# Cache key for the operating systems of a cluster.
+OS_LIST_KEY = 'utils:os_list:%s'
+
+
 def cluster_os_list(cluster):
     """
     Create a detailed manifest of available operating systems on the cluster.
+
+    The manifest is cached for ``OS_LIST_CACHE_TIMEOUT`` seconds, since the
+    create and modify forms ask for it at every step, or until the cluster is
+    saved.
     """
+    timeout = settings.OS_LIST_CACHE_TIMEOUT
+    pk = getattr(cluster, 'pk', None)
+    if timeout and pk is not None:
+        os_list = cache.get(OS_LIST_KEY % pk)
+        record_cache('os_list', os_list is not None)
+        if os_list is not None:
+            return os_list
+
     try:
-        return os_prettify(cluster.rapi.GetOperatingSystems())
+        os_list = os_prettify(cluster.rapi.GetOperatingSystems())
     except GanetiApiError:
         return []
 
+    if timeout and pk is not None:
+        cache.set(OS_LIST_KEY % pk, os_list, timeout)
+    return os_list
+
+
+def invalidate_os_list(cluster_id):
+    """
+    Discard the cached operating systems of a cluster.
+    """
+    cache.delete(OS_LIST_KEY % cluster_id)
+
 
 def os_prettify(oses):
     """
@@ -27,10 +27,17 @@ Ganeti RAPI client.
 import logging
 import simplejson as json
 import socket
+import time
 
 import requests
 
 
+# Callables run after every request sent by any client, with the client, the
+# HTTP method and path, the seconds the request took and the exception it
+# raised, or None.  These allow RAPI traffic to be instrumented without
+# subclassing the client.
+REQUEST_HOOKS = []
+
 GANETI_RAPI_PORT = 5080
 GANETI_RAPI_VERSION = 2
 
@@ -179,6 +186,7 @@ class GanetiRapiClient(object):  # pylint: disable-msg=R0904
         elif password is not None and username is None:
             raise ClientError("Specified password without username")
 
+        self.host = host
         self.username = username
         self.password = password
         self.timeout = timeout
@@ -195,6 +203,23 @@ class GanetiRapiClient(object):  # pylint: disable-msg=R0904
         self._base_url = "https://%s" % address
 
     def _SendRequest(self, method, path, query=None, content=None):
+        """
+        Sends an HTTP request with ``_Request()`` and runs the
+        ``REQUEST_HOOKS`` once it is answered or has failed.
+        """
+        start = time.time()
+        error = None
+        try:
+            return self._Request(method, path, query, content)
+        except Exception, e:
+            error = e
+            raise
+        finally:
+            seconds = time.time() - start
+            for hook in REQUEST_HOOKS:
+                hook(self, method, path, seconds, error)
+
+    def _Request(self, method, path, query=None, content=None):
         """
         Sends an HTTP request.
 
@@ -970,17 +995,24 @@ class GanetiRapiClient(object):  # pylint: disable-msg=R0904
         return self._SendRequest("get", ("/%s/instances/%s/console" %
                                          (GANETI_RAPI_VERSION, instance)))
 
-    def GetJobs(self):
+    def GetJobs(self, bulk=False):
         """
         Gets all jobs for the cluster.
 
-        :rtype: list of int
-        :return: job ids for the cluster
-        """
+        :type bulk: bool
+        :param bulk: whether to return all information about all jobs
 
-        jobs = self._SendRequest("get", "/%s/jobs" % GANETI_RAPI_VERSION)
+        :rtype: list of int or list of dict
+        :return: if bulk is True, info about the jobs,
+                 else job ids for the cluster
+        """
 
-        return [int(job["id"]) for job in jobs]
+        if bulk:
+            return self._SendRequest("get", "/%s/jobs" % GANETI_RAPI_VERSION,
+                                     query={"bulk": 1})
+        else:
+            jobs = self._SendRequest("get", "/%s/jobs" % GANETI_RAPI_VERSION)
+            return [int(job["id"]) for job in jobs]
 
     def GetJobStatus(self, job_id):
         """
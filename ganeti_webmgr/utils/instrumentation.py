@@ -0,0 +1,238 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Per-request accounting of database queries, RAPI requests and cache lookups.
+
+``RequestStatsMiddleware`` starts a ``RequestStats`` for every request and
+makes it the current one for the thread handling the request.  RAPI requests
+are recorded through a hook on ``GanetiRapiClient``, and cached lookups
+report hits and misses with ``record_cache()``.  Anything happening outside
+of a request is not recorded.
+
+When a request finishes its stats are added to per-view totals kept in the
+process, which ``totals()`` returns.
+"""
+
+import re
+import time
+from collections import defaultdict
+from functools import wraps
+from threading import Lock, local
+
+from .client import REQUEST_HOOKS
+
+# Request paths are grouped by resource rather than by object, e.g.
+# "GET /2/instances/<name>/tags".
+OBJECT_PATH = re.compile(r'^(/2/(?:instances|nodes|jobs|groups))/[^/]+')
+
+_local = local()
+
+
+def request_name(method, path):
+    """
+    Return the name RAPI requests are grouped by.
+    """
+    return '%s %s' % (method.upper(), OBJECT_PATH.sub(r'\1/<name>', path))
+
+
+class RequestStats(object):
+    """
+    Counters for a single request.  RAPI requests may be recorded from other
+    threads working on behalf of the request, see ``propagate()``.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = 0
+        self.queries = 0
+        self.query_time = 0
+        # cluster -> request name -> [count, seconds, errors]
+        self.rapi = defaultdict(lambda: defaultdict(lambda: [0, 0, 0]))
+        # name -> [hits, misses]
+        self.cache = defaultdict(lambda: [0, 0])
+        self._lock = Lock()
+
+    def add_rapi(self, cluster, name, seconds, error=False):
+        with self._lock:
+            counter = self.rapi[cluster][name]
+            counter[0] += 1
+            counter[1] += seconds
+            if error:
+                counter[2] += 1
+
+    def add_cache(self, name, hit):
+        with self._lock:
+            self.cache[name][0 if hit else 1] += 1
+
+    def add_queries(self, queries):
+        """
+        Add queries as recorded by a debug cursor in ``connection.queries``.
+        """
+        for query in queries:
+            self.queries += 1
+            self.query_time += float(query['time'])
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+
+    @property
+    def rapi_calls(self):
+        return sum(c[0] for names in self.rapi.values()
+                   for c in names.values())
+
+    @property
+    def rapi_time(self):
+        return sum(c[1] for names in self.rapi.values()
+                   for c in names.values())
+
+    @property
+    def cache_hits(self):
+        return sum(c[0] for c in self.cache.values())
+
+    @property
+    def cache_misses(self):
+        return sum(c[1] for c in self.cache.values())
+
+    def as_dict(self):
+        """
+        Return the stats as a dictionary which can be serialized to JSON.
+        """
+        return {
+            'seconds': round(self.seconds, 6),
+            'db': {
+                'queries': self.queries,
+                'time': round(self.query_time, 6),
+            },
+            'rapi': {
+                'calls': self.rapi_calls,
+                'time': round(self.rapi_time, 6),
+                'clusters': dict(
+                    (cluster, dict(
+                        (name, {'calls': c[0], 'time': round(c[1], 6),
+                                'errors': c[2]})
+                        for name, c in names.items()))
+                    for cluster, names in self.rapi.items()),
+            },
+            'cache': dict((name, {'hits': c[0], 'misses': c[1]})
+                          for name, c in self.cache.items()),
+        }
+
+
+def start_request():
+    """
+    Start recording stats for the current thread.
+    """
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def end_request():
+    """
+    Stop recording stats for the current thread.
+
+    @returns the finished ``RequestStats``, or None if none were recorded
+    """
+    stats = current()
+    _local.stats = None
+    if stats is not None:
+        stats.finish()
+    return stats
+
+
+def current():
+    """
+    Return the ``RequestStats`` being recorded by the current thread, if any.
+    """
+    return getattr(_local, 'stats', None)
+
+
+def propagate(func):
+    """
+    Wrap ``func`` so that it records into the current thread's stats when run
+    in another thread.
+    """
+    stats = current()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        _local.stats = stats
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stats = None
+    return wrapper
+
+
+def record_cache(name, hit):
+    """
+    Record a hit or miss of a cached lookup.
+    """
+    stats = current()
+    if stats is not None:
+        stats.add_cache(name, hit)
+
+
+def _record_rapi(client, method, path, seconds, error):
+    stats = current()
+    if stats is not None:
+        stats.add_rapi(client.host, request_name(method, path), seconds,
+                       error is not None)
+
+REQUEST_HOOKS.append(_record_rapi)
+
+
+# view -> [requests, seconds, queries, query time, rapi calls, rapi time,
+#          cache hits, cache misses]
+_totals = defaultdict(lambda: [0] * 8)
+_totals_lock = Lock()
+
+TOTAL_FIELDS = ('requests', 'seconds', 'queries', 'query_time', 'rapi_calls',
+                'rapi_time', 'cache_hits', 'cache_misses')
+
+
+def add_to_totals(view, stats):
+    """
+    Add a finished request's stats to the totals of its view.
+    """
+    values = (1, stats.seconds, stats.queries, stats.query_time,
+              stats.rapi_calls, stats.rapi_time, stats.cache_hits,
+              stats.cache_misses)
+    with _totals_lock:
+        total = _totals[view]
+        for i, value in enumerate(values):
+            total[i] += value
+
+
+def totals():
+    """
+    Return the totals of every view seen by this process, along with the
+    mean time per request.
+    """
+    with _totals_lock:
+        items = [(view, list(total)) for view, total in _totals.items()]
+
+    result = {}
+    for view, total in items:
+        result[view] = data = dict(zip(TOTAL_FIELDS, total))
+        data['mean'] = data['seconds'] / data['requests']
+    return result
+
+
+def reset_totals():
+    with _totals_lock:
+        _totals.clear()
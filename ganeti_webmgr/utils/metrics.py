@@ -0,0 +1,226 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Counters and histograms exported in the Prometheus text format.
+
+Metrics are updated in place as things happen and kept in the memory of the
+process, so exporting them never touches the database.  Each process
+exports only what it has seen itself.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+from .client import REQUEST_HOOKS
+from .instrumentation import request_name
+
+# Upper bounds of the buckets for durations, in seconds.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30, 60)
+
+# Upper bounds of the buckets for the age of cached info, in seconds.
+AGE_BUCKETS = (10, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """
+    A metric with a fixed set of label names.  Values are kept per
+    combination of label values.
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def lines(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s %s' % (self.name, self.kind)
+        with self._lock:
+            values = self._snapshot()
+        for line in self._samples(values):
+            yield line
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        self._values = defaultdict(int)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _snapshot(self):
+        return sorted(self._values.items())
+
+    def _samples(self, values):
+        for key, value in values:
+            yield '%s%s %s' % (self.name, _format_labels(self.labels, key),
+                               _format_value(value))
+
+
+class Histogram(Metric):
+    """
+    A histogram of observed values.  Observations are counted in the first
+    bucket they fit in; the cumulative counts Prometheus expects are only
+    computed when exporting.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # key -> [bucket counts..., sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _snapshot(self):
+        return sorted((key, list(counts))
+                      for key, counts in self._values.items())
+
+    def _samples(self, values):
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.labels, key,
+                                   [('le', _format_value(bound))]),
+                    total)
+            labels = _format_labels(self.labels, key)
+            yield '%s_sum%s %s' % (self.name, labels,
+                                   _format_value(float(counts[-1])))
+            yield '%s_count%s %d' % (self.name, labels, total)
+
+
+class Gauge(Metric):
+    """
+    A gauge whose values are read from ``collect`` when exported.
+    ``collect`` must return (label values, value) pairs.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self.collect = collect
+
+    def _snapshot(self):
+        return sorted(self.collect()) if self.collect else []
+
+    def _samples(self, values):
+        for key, value in values:
+            yield '%s%s %s' % (self.name, _format_labels(self.labels, key),
+                               _format_value(value))
+
+
+def export():
+    """
+    Return all registered metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.lines())
+    return '\n'.join(lines) + '\n'
+
+
+RAPI_DURATION = Histogram(
+    'gwm_rapi_request_duration_seconds',
+    'Time taken by RAPI requests.', ('cluster', 'request'))
+RAPI_ERRORS = Counter(
+    'gwm_rapi_request_errors_total',
+    'RAPI requests which failed.', ('cluster', 'request'))
+REFRESH_DURATION = Histogram(
+    'gwm_refresh_duration_seconds',
+    'Time taken to refresh the cached info of an object.', ('type',))
+SYNC_DURATION = Histogram(
+    'gwm_sync_duration_seconds',
+    'Time taken to synchronize the nodes or virtual machines of a cluster.',
+    ('cluster', 'type'))
+CACHE_AGE = Histogram(
+    'gwm_cache_age_seconds',
+    'Age of the cached info of objects when they are loaded.', ('type',),
+    buckets=AGE_BUCKETS)
+GANETI_ERRORS = Counter(
+    'gwm_ganeti_errors_total',
+    'Errors reported by Ganeti and stored.', ('type', 'code'))
+
+
+def _observe_rapi(client, method, path, seconds, error):
+    name = request_name(method, path)
+    RAPI_DURATION.observe(seconds, cluster=client.host, request=name)
+    if error is not None:
+        RAPI_ERRORS.inc(cluster=client.host, request=name)
+
+REQUEST_HOOKS.append(_observe_rapi)
@@ -1,15 +1,22 @@
 import re
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
+from hashlib import sha1
+from threading import local
 
+from django.utils.encoding import smart_str
 from django.utils.translation import ugettext_lazy as _
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
 
+from .metrics import GANETI_ERRORS
+
 
 ssh_public_key_re = re.compile(r'^ssh-(rsa|dsa|dss) [A-Z0-9+/=]+ .+$',
                                re.IGNORECASE)
@@ -57,7 +64,7 @@ class GanetiError(models.Model):
     code = models.PositiveIntegerField(blank=True, null=True)
 
     # XXX could be fixed with django-model-util's TimeStampedModel
-    timestamp = models.DateTimeField()
+    timestamp = models.DateTimeField(db_index=True)
 
     # determines if the errors still appears or not
     cleared = models.BooleanField(default=False)
@@ -67,15 +74,27 @@ class GanetiError(models.Model):
     obj_id = models.PositiveIntegerField()
     obj = GenericForeignKey("obj_type", "obj_id")
 
+    # msg is a TextField and can't be indexed; a hash of it can.
+    msg_hash = models.CharField(max_length=40, editable=False)
+
     objects = QuerySetManager()
 
     class Meta:
         ordering = ("-timestamp", "code", "msg")
+        unique_together = (("obj_type", "obj_id", "code", "msg_hash"),)
 
     def __unicode__(self):
         base = u"[%s] %s" % (self.timestamp, self.msg)
         return base
 
+    def save(self, *args, **kwargs):
+        self.msg_hash = self.hash_msg(self.msg)
+        super(GanetiError, self).save(*args, **kwargs)
+
+    @staticmethod
+    def hash_msg(msg):
+        return sha1(smart_str(msg)).hexdigest()
+
     class QuerySet(QuerySet):
 
         def clear_errors(self, obj=None):
@@ -130,6 +149,10 @@ class GanetiError(models.Model):
         """
         Create and save an error with the given information.
 
+        If a batch is in progress (see ``GanetiError.batch``) the error is
+        only recorded and will be written when the batch is flushed; None is
+        returned in that case.
+
         @param  msg  error's message
         @param  obj  object (i.e. cluster or vm) affected by the error
         @param code  error's code number
@@ -150,40 +173,215 @@ class GanetiError(models.Model):
                 ct = ContentType.objects.get_for_model(Cluster)
                 is_cluster = True
 
+        GANETI_ERRORS.inc(type=ct.model, code=code)
+
+        cluster_id = obj.pk if is_cluster else obj.cluster_id
+        values = dict(msg=msg, msg_hash=cls.hash_msg(msg), obj_type=ct,
+                      obj_id=obj.pk, cluster_id=cluster_id, code=code,
+                      **kwargs)
+
+        batch = getattr(_error_batch, 'current', None)
+        if batch is not None:
+            batch.store(values, is_cluster)
+            return None
+
         # 404 -- object not found
         # 404 can occur on any object, but when it occurs on a cluster, then
         # any of its children must not see the error again
-        elif code == 404:
-            if not is_cluster:
-                # return if the error exists for cluster
-                try:
-                    c_ct = ContentType.objects.get_for_model(Cluster)
-                    return cls.objects.filter(msg=msg, obj_type=c_ct,
-                                              code=code,
-                                              obj_id=obj.cluster_id,
-                                              cleared=False)[0]
-
-                except (cls.DoesNotExist, IndexError):
-                    # we want to proceed when the error is not
-                    # cluster-specific
-                    pass
-
-        # XXX use a try/except instead of get_or_create().  get_or_create()
-        # does not allow us to set cluster_id.  This means we'd have to query
-        # the cluster object to create the error.  we can't guaranteee the
-        # cluster will already be queried so use create() instead which does
-        # allow cluster_id
+        if code == 404 and not is_cluster:
+            # return if the error exists for cluster
+            c_ct = ContentType.objects.get_for_model(Cluster)
+            existing = cls.objects.filter(msg_hash=values['msg_hash'],
+                                          obj_type=c_ct, code=code,
+                                          obj_id=obj.cluster_id,
+                                          cleared=False)[:1]
+            if existing:
+                return existing[0]
+
+        lookup = dict((k, v) for k, v in values.items()
+                      if k not in ('msg', 'cluster_id'))
+        try:
+            return cls.objects.filter(**lookup)[0]
+        except IndexError:
+            pass
+
+        # the unique index on (obj_type, obj_id, code, msg_hash) catches a
+        # concurrent writer storing the same error.
+        sid = transaction.savepoint()
+        try:
+            error = cls.objects.create(timestamp=datetime.now(), **values)
+            transaction.savepoint_commit(sid)
+            return error
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return cls.objects.filter(**lookup)[0]
+
+    @classmethod
+    def clear_obj_errors(cls, obj):
+        """
+        Clear all errors for an object, or record that they should be cleared
+        if a batch is in progress.
+        """
+        batch = getattr(_error_batch, 'current', None)
+        if batch is not None:
+            batch.clear(obj)
+        else:
+            cls.objects.clear_errors(obj=obj)
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """
+        Collect errors stored and cleared within this block and write them
+        with a few bulk queries when it exits.  Used by cluster syncs, which
+        may otherwise issue several queries for every object.
+
+        Nested batches join the outermost one.
+        """
+        if getattr(_error_batch, 'current', None) is not None:
+            yield _error_batch.current
+            return
+
+        batch = _error_batch.current = GanetiErrorBatch()
         try:
-            return cls.objects.filter(msg=msg, obj_type=ct, obj_id=obj.pk,
-                                      code=code, **kwargs)[0]
+            yield batch
+        finally:
+            _error_batch.current = None
+            batch.flush()
+
+
+# The batch of errors being collected by the current thread, if any.
+_error_batch = local()
+
+
+class GanetiErrorBatch(object):
+    """
+    Errors stored and cleared during a sync pass, waiting to be written.
+    """
+
+    # Number of objects handled per query, to stay well under the bound
+    # parameter limits of some databases.
+    chunk_size = 500
+
+    def __init__(self):
+        self.errors = {}
+        self.cleared = defaultdict(set)
+
+    @staticmethod
+    def _key(values):
+        return (values['obj_type'].pk, values['obj_id'], values['code'],
+                values['msg_hash'])
+
+    def store(self, values, is_cluster):
+        values['is_cluster'] = is_cluster
+        self.errors.setdefault(self._key(values), values)
 
-        except (cls.DoesNotExist, IndexError):
-            cluster_id = obj.pk if is_cluster else obj.cluster_id
+    def clear(self, obj):
+        self.clear_ids(obj.__class__, [obj.pk])
 
-            return cls.objects.create(timestamp=datetime.now(), msg=msg,
-                                      obj_type=ct, obj_id=obj.pk,
-                                      cluster_id=cluster_id, code=code,
-                                      **kwargs)
+    def clear_ids(self, model, ids):
+        """
+        Clear the errors of several objects of a model, given their ids.
+        """
+        ct = ContentType.objects.get_for_model(model)
+        ids = set(ids)
+        self.cleared[ct].update(ids)
+        # errors stored earlier in this batch are cleared as well
+        for key in self.errors.keys():
+            if key[0] == ct.pk and key[1] in ids:
+                del self.errors[key]
+
+    def store_ids(self, model, ids, cluster_id, msg, code):
+        """
+        Store the same error for several objects of a model of a cluster,
+        given their ids.
+        """
+        ct = ContentType.objects.get_for_model(model)
+        msg_hash = GanetiError.hash_msg(msg)
+        for pk in ids:
+            GANETI_ERRORS.inc(type=ct.model, code=code)
+            self.store(dict(msg=msg, msg_hash=msg_hash, obj_type=ct,
+                            obj_id=pk, cluster_id=cluster_id, code=code),
+                       False)
+
+    def _chunks(self, items):
+        items = list(items)
+        for i in xrange(0, len(items), self.chunk_size):
+            yield items[i:i + self.chunk_size]
+
+    def flush(self):
+        from ganeti_webmgr.clusters.models import Cluster
+
+        cluster_ct = ContentType.objects.get_for_model(Cluster)
+        for ct, ids in self.cleared.items():
+            for chunk in self._chunks(ids):
+                qs = GanetiError.objects.filter(cleared=False)
+                if ct == cluster_ct:
+                    # clearing a cluster clears the errors of its objects too
+                    qs.filter(cluster__in=chunk).update(cleared=True)
+                else:
+                    qs.filter(obj_type=ct, obj_id__in=chunk) \
+                        .update(cleared=True)
+
+        # 404 errors on clusters hide the same error on any of their objects.
+        pending = self.errors.values()
+        cluster_404s = set(
+            (values['obj_id'], values['msg_hash']) for values in pending
+            if values['code'] == 404 and values['is_cluster'])
+        needs_check = set(values['cluster_id'] for values in pending
+                          if values['code'] == 404
+                          and not values['is_cluster'])
+        for chunk in self._chunks(needs_check):
+            cluster_404s.update(GanetiError.objects.filter(
+                obj_type=cluster_ct, obj_id__in=chunk, code=404,
+                cleared=False).values_list('obj_id', 'msg_hash'))
+        pending = [values for values in pending
+                   if values['is_cluster'] or values['code'] != 404 or
+                   (values['cluster_id'], values['msg_hash'])
+                   not in cluster_404s]
+
+        now = datetime.now()
+        for chunk in self._chunks(pending):
+            existing = set(GanetiError.objects.filter(
+                obj_id__in=set(values['obj_id'] for values in chunk),
+                msg_hash__in=set(values['msg_hash'] for values in chunk),
+            ).values_list('obj_type', 'obj_id', 'code', 'msg_hash'))
+
+            new = []
+            for values in chunk:
+                if self._key(values) not in existing:
+                    values = dict(values)
+                    del values['is_cluster']
+                    new.append(GanetiError(timestamp=now, **values))
+            self._insert(new)
+
+        self.errors.clear()
+        self.cleared.clear()
+
+    @staticmethod
+    def _insert(errors):
+        """
+        Bulk insert errors.  If another process stored one of them in the
+        meantime, fall back to inserting them one at a time and skip the
+        duplicates.
+        """
+        if not errors:
+            return
+        sid = transaction.savepoint()
+        try:
+            GanetiError.objects.bulk_create(errors)
+            transaction.savepoint_commit(sid)
+            return
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+
+        for error in errors:
+            sid = transaction.savepoint()
+            try:
+                error.save(force_insert=True)
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
 
 
 class Quota(models.Model):
@@ -18,5 +18,7 @@
 from .call_proxy import CallProxy
 from .rapi_proxy import RapiProxy, XenRapiProxy, XenHvmRapiProxy
 from .response_map import ResponseMap
+from .simulated import SimulatedRapi
 
-__all__ = ['RapiProxy', 'XenRapiProxy', 'CallProxy', 'ResponseMap']
+__all__ = ['RapiProxy', 'XenRapiProxy', 'CallProxy', 'ResponseMap',
+           'SimulatedRapi']
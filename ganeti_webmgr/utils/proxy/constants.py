@@ -20,7 +20,8 @@ __all__ = ['INSTANCE', 'INSTANCES', 'XEN_PVM_INSTANCE', 'XEN_HVM_INSTANCE',
            'XEN_INSTANCES', 'NODE', 'NODES', 'NODES_BULK', 'INFO', 'XEN_INFO',
            'OPERATING_SYSTEMS', 'XEN_OPERATING_SYSTEMS', 'JOB', 'JOB_RUNNING',
            'JOB_ERROR', 'JOB_DELETE_SUCCESS', 'JOB_LOG', 'INSTANCES_BULK',
-           'NODES_MAP']
+           'NODES_MAP', 'INSTANCES_MAP', 'XEN_HVM_INSTANCES_MAP',
+           'XEN_PVM_INSTANCES_MAP']
 
 from .response_map import ResponseMap
 
@@ -682,3 +683,22 @@ NODES_MAP = ResponseMap([
     (((True,), {}), NODES_BULK),
     (((), {'bulk': True}), NODES_BULK),
 ])
+
+
+def instances_map(instance):
+    """
+    map instances response for bulk argument, with ``instance`` as the info
+    of every instance
+    """
+    bulk = [dict(instance, name=name) for name in INSTANCES]
+    return ResponseMap([
+        (((), {}), INSTANCES),
+        (((False,), {}), INSTANCES),
+        (((), {'bulk': False}), INSTANCES),
+        (((True,), {}), bulk),
+        (((), {'bulk': True}), bulk),
+    ])
+
+INSTANCES_MAP = instances_map(INSTANCE)
+XEN_HVM_INSTANCES_MAP = instances_map(XEN_HVM_INSTANCE)
+XEN_PVM_INSTANCES_MAP = instances_map(XEN_PVM_INSTANCE)
@@ -35,7 +35,7 @@ class RapiProxy(client.GanetiRapiClient):
         """
         instance = object.__new__(cls)
         instance.__init__(*args, **kwargs)
-        CallProxy.patch(instance, 'GetInstances', False, INSTANCES)
+        CallProxy.patch(instance, 'GetInstances', False, INSTANCES_MAP)
         CallProxy.patch(instance, 'GetInstance', False, INSTANCE)
         CallProxy.patch(instance, 'GetNodes', False, NODES_MAP)
         CallProxy.patch(instance, 'GetNode', False, NODE)
@@ -43,6 +43,7 @@ class RapiProxy(client.GanetiRapiClient):
         CallProxy.patch(instance, 'GetOperatingSystems', False,
                         OPERATING_SYSTEMS)
         CallProxy.patch(instance, 'GetJobStatus', False, JOB_RUNNING)
+        CallProxy.patch(instance, 'GetJobs', False, [])
         CallProxy.patch(instance, 'StartupInstance', False, 1)
         CallProxy.patch(instance, 'ShutdownInstance', False, 1)
         CallProxy.patch(instance, 'RebootInstance', False, 1)
@@ -75,8 +76,8 @@ class RapiProxy(client.GanetiRapiClient):
         if key in ['GetInstances', 'GetInstance', 'GetNodes', 'GetNode',
                    'GetInfo', 'StartupInstance', 'ShutdownInstance',
                    'RebootInstance', 'AddInstanceTags', 'DeleteInstanceTags',
-                   'GetOperatingSystems', 'GetJobStatus', 'CreateInstance',
-                   'ReinstallInstance'] \
+                   'GetOperatingSystems', 'GetJobStatus', 'GetJobs',
+                   'CreateInstance', 'ReinstallInstance'] \
                 and self.error:
             return self.fail
         return super(RapiProxy, self).__getattribute__(key)
@@ -94,7 +95,8 @@ class XenRapiProxy(RapiProxy):
         instance.GetInstance = None
         instance.GetInfo = None
         instance.GetOperatingSystems = None
-        CallProxy.patch(instance, 'GetInstances', False, INSTANCES)
+        CallProxy.patch(instance, 'GetInstances', False,
+                        XEN_PVM_INSTANCES_MAP)
         CallProxy.patch(instance, 'GetInstance', False, XEN_PVM_INSTANCE)
         CallProxy.patch(instance, 'GetInfo', False, XEN_INFO)
         CallProxy.patch(instance, 'GetOperatingSystems', False,
@@ -115,7 +117,8 @@ class XenHvmRapiProxy(XenRapiProxy):
         instance.GetInstance = None
         instance.GetInfo = None
         instance.GetOperatingSystems = None
-        CallProxy.patch(instance, 'GetInstances', False, INSTANCES)
+        CallProxy.patch(instance, 'GetInstances', False,
+                        XEN_HVM_INSTANCES_MAP)
         CallProxy.patch(instance, 'GetInstance', False, XEN_HVM_INSTANCE)
         CallProxy.patch(instance, 'GetInfo', False, XEN_INFO)
         CallProxy.patch(instance, 'GetOperatingSystems', False,
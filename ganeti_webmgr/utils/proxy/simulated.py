@@ -0,0 +1,168 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+An in-process stand-in for the RAPI of a large Ganeti cluster.
+
+Unlike ``RapiProxy``, which patches individual client methods to return a
+single canned object, ``SimulatedRapi`` answers at the HTTP layer: it
+replaces ``_Request()`` and serves a generated cluster of any size, so
+every client method works unmodified.  Requests can be slowed down to
+simulate network latency, and are counted per method and resource.
+"""
+
+import time
+from collections import defaultdict
+from copy import deepcopy
+from random import Random
+from threading import Lock
+
+from ..client import GanetiRapiClient, GanetiApiError
+from ..instrumentation import request_name
+from .constants import INFO, INSTANCE, JOB, NODE, OPERATING_SYSTEMS
+
+
+class SimulatedRapi(GanetiRapiClient):
+    """
+    A GanetiRapiClient talking to a simulated cluster of ``nodes`` nodes and
+    ``instances`` instances, spread evenly over the nodes.
+
+    @param latency  seconds each request takes
+    @param jitter   maximum number of seconds randomly added to or taken
+                    from the latency of each request
+    @param seed     seed for the jitter, so runs can be repeated
+    """
+
+    def __init__(self, host, port=5080, username=None, password=None,
+                 nodes=3, instances=10, latency=0, jitter=0, seed=0,
+                 **kwargs):
+        super(SimulatedRapi, self).__init__(host, port, username, password,
+                                            **kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._job_id = 0
+        self.calls = defaultdict(int)
+
+        self.nodes = {}
+        self.instances = {}
+        node_names = ['node%03d.%s' % (i, host) for i in xrange(nodes)]
+        primary = defaultdict(list)
+        secondary = defaultdict(list)
+        for i in xrange(instances):
+            name = 'vm%05d.%s' % (i, host)
+            info = self.instances[name] = self._instance(i, name, node_names)
+            primary[info['pnode']].append(name)
+            for node in info['snodes']:
+                secondary[node].append(name)
+        for i, name in enumerate(node_names):
+            self.nodes[name] = self._node(i, name, primary[name],
+                                          secondary[name])
+
+    def _instance(self, i, name, node_names):
+        info = deepcopy(INSTANCE)
+        info['name'] = name
+        info['uuid'] = '%08x-0000-0000-0000-%012x' % (i, i)
+        info['status'] = 'running' if i % 4 else 'ADMIN_down'
+        info['admin_state'] = info['oper_state'] = bool(i % 4)
+        info['network_port'] = 11000 + i
+        info['nic.macs'] = ['aa:00:00:%02x:%02x:%02x' % (
+            (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)]
+        if node_names:
+            info['pnode'] = node_names[i % len(node_names)]
+            if len(node_names) > 1:
+                info['snodes'] = [node_names[(i + 1) % len(node_names)]]
+        else:
+            info['pnode'] = None
+        return info
+
+    def _node(self, i, name, primary, secondary):
+        info = deepcopy(NODE)
+        info['name'] = name
+        info['uuid'] = '%08x-0000-0000-0000-%012x' % (i, i)
+        info['pinst_list'] = primary
+        info['pinst_cnt'] = len(primary)
+        info['sinst_list'] = secondary
+        info['sinst_cnt'] = len(secondary)
+        info['role'] = 'M' if i == 0 else 'R'
+        return info
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        """ Forget the requests counted so far """
+        with self._lock:
+            self.calls.clear()
+
+    def _wait(self):
+        with self._lock:
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _next_job(self):
+        with self._lock:
+            self._job_id += 1
+            return self._job_id
+
+    def _Request(self, method, path, query=None, content=None):
+        method = method.upper()
+        with self._lock:
+            self.calls[request_name(method, path)] += 1
+        self._wait()
+
+        if method != 'GET':
+            # Every change is accepted and answered with a new job id; the
+            # simulated cluster itself doesn't change.
+            return self._next_job()
+
+        bulk = bool(query and query.get('bulk'))
+        parts = path.strip('/').split('/')[1:]
+        if parts == ['info']:
+            info = deepcopy(INFO)
+            info['name'] = self.host
+            return info
+        elif parts == ['os']:
+            return list(OPERATING_SYSTEMS)
+        elif parts in (['instances'], ['nodes']):
+            objects = getattr(self, parts[0])
+            if bulk:
+                return [deepcopy(objects[name]) for name in sorted(objects)]
+            return [{'id': name, 'uri': '/2/%s/%s' % (parts[0], name)}
+                    for name in sorted(objects)]
+        elif len(parts) >= 2 and parts[0] in ('instances', 'nodes'):
+            try:
+                info = getattr(self, parts[0])[parts[1]]
+            except KeyError:
+                raise GanetiApiError('404', code=404)
+            if parts[2:] == ['tags']:
+                return list(info['tags'])
+            elif parts[2:] == ['role']:
+                return 'master' if info['role'] == 'M' else 'regular'
+            elif not parts[2:]:
+                return deepcopy(info)
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = deepcopy(JOB)
+            job['id'] = int(parts[1])
+            return job
+
+        raise GanetiApiError('404', code=404)
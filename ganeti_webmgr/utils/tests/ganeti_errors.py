@@ -215,6 +215,63 @@ class TestGanetiErrorModel(TestGanetiErrorBase, TestCase):
         self.assertEqual(len(errors), 0)
         get_errors(obj=cluster0).delete()
 
+    def test_batch(self):
+        """
+        Tests storing and clearing errors inside a batch
+
+        Verifies:
+            * errors are written when the batch exits
+            * duplicate errors are stored once
+            * errors already in the database are not stored again
+            * clearing an object drops its pending errors
+            * a 404 on the cluster hides the same 404 on its VMs
+        """
+        cluster0 = self.create_model(Cluster, hostname="test0",
+                                     slug="OSL_TEST0")
+        vm0 = self.create_model(VirtualMachine, cluster=cluster0,
+                                hostname="vm0.test.org")
+        vm1 = self.create_model(VirtualMachine, cluster=cluster0,
+                                hostname="vm1.test.org")
+        get_errors = GanetiError.objects.get_errors
+
+        existing = GanetiError.store_error("old error", obj=vm1, code=500)
+
+        with GanetiError.batch():
+            self.assertEqual(None, GanetiError.store_error(
+                "error", obj=vm0, code=500))
+            GanetiError.store_error("error", obj=vm0, code=500)
+            GanetiError.store_error("old error", obj=vm1, code=500)
+            GanetiError.store_error("cleared", obj=vm1, code=500)
+            GanetiError.clear_obj_errors(vm1)
+            GanetiError.store_error("not found", obj=vm0, code=404)
+            GanetiError.store_error("not found", obj=cluster0, code=404)
+
+            # nested batches join the outer one
+            with GanetiError.batch():
+                GanetiError.store_error("nested", obj=vm0, code=500)
+
+            self.assertEqual(1, GanetiError.objects.count())
+
+        self.assertEqual(set(["error", "nested"]),
+                         set(get_errors(obj=vm0).values_list('msg',
+                                                             flat=True)))
+        self.assertFalse(get_errors(obj=vm1).filter(cleared=False).exists())
+        self.assertTrue(GanetiError.objects.get(pk=existing.pk).cleared)
+        self.assertEqual(1, get_errors(obj=cluster0).filter(code=404).count())
+
+        # errors are written with a fixed number of queries
+        GanetiError.objects.all().delete()
+        vms = [vm0, vm1]
+        with self.assertNumQueries(3):
+            with GanetiError.batch():
+                for i in range(20):
+                    for vm in vms:
+                        GanetiError.store_error("error %d" % i, obj=vm,
+                                                code=500)
+                    GanetiError.store_error("gone", obj=vms[i % 2],
+                                            code=404)
+        self.assertEqual(42, GanetiError.objects.count())
+
     def refresh(self, object):
         """
         NOTE: this test is borrowed from TestCachedClusterObject.
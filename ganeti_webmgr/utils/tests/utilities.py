@@ -15,18 +15,37 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
-from django.test import SimpleTestCase
-
-from ganeti_webmgr.utils import (compare, get_hypervisor, hv_prettify,
-                                 os_prettify)
+from datetime import datetime
+from threading import Lock
+from time import sleep, time
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+
+from ganeti_webmgr import utils
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.utils import (RAPI_REGISTRY, RapiRegistry, bulk_update,
+                                 compare, get_hypervisor, get_rapi,
+                                 hv_prettify, os_prettify, rapi_map,
+                                 warm_rapi_cache)
+from ganeti_webmgr.utils import instrumentation, metrics
+from ganeti_webmgr.utils.client import GanetiApiError
+from ganeti_webmgr.utils.proxy import SimulatedRapi
 from ganeti_webmgr.utils.proxy.constants import (INSTANCE, XEN_PVM_INSTANCE,
                                                  XEN_HVM_INSTANCE)
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
 
 __all__ = (
+    "TestBulkUpdate",
     "TestCompare",
     "TestGetHypervisor",
     "TestHvPrettify",
+    "TestInstrumentation",
+    "TestMetrics",
     "TestOSPrettify",
+    "TestRapiMap",
+    "TestRapiRegistry",
+    "TestSimulatedRapi",
 )
 
 
@@ -156,3 +175,322 @@ class TestOSPrettify(SimpleTestCase):
         self.assertEqual(os_prettify(["deb-ver1", "noop"]),
                          [("Unknown", [("deb-ver1", "deb-ver1"),
                           ("noop", "noop"), ]), ])
+
+
+class TestRapiMap(SimpleTestCase):
+
+    def test_results(self):
+        def func(item):
+            if item == 3:
+                raise GanetiApiError("failed", 500)
+            return item * 2
+
+        results = rapi_map(1, func, range(6))
+        self.assertEqual([0, 1, 2, 3, 4, 5], [r[0] for r in results])
+        self.assertEqual([0, 2, 4, None, 8, 10], [r[1] for r in results])
+        self.assertEqual("failed", str(results[3][2]))
+        self.assertEqual([None] * 5,
+                         [r[2] for r in results if r[0] != 3])
+
+    def test_concurrency(self):
+        """
+        Requests to a cluster never exceed RAPI_CONCURRENCY
+        """
+        lock = Lock()
+        running = [0]
+        most = [0]
+
+        def func(item):
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+            sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        rapi_map(2, func, range(20))
+        self.assertTrue(1 < most[0] <= settings.RAPI_CONCURRENCY)
+
+
+class TestSimulatedRapi(SimpleTestCase):
+
+    def setUp(self):
+        self.rapi = SimulatedRapi('sim.example.test', nodes=3, instances=7)
+
+    def test_cluster(self):
+        rapi = self.rapi
+        self.assertEqual('sim.example.test', rapi.GetInfo()['name'])
+
+        instances = rapi.GetInstances()
+        self.assertEqual(7, len(instances))
+        self.assertEqual(7, len(rapi.GetInstances(bulk=True)))
+        info = rapi.GetInstance(instances[1])
+        self.assertEqual(instances[1], info['name'])
+        self.assertEqual('running', info['status'])
+        self.assertEqual('ADMIN_down',
+                         rapi.GetInstance(instances[0])['status'])
+
+        nodes = rapi.GetNodes()
+        self.assertEqual(3, len(nodes))
+        self.assertEqual(info['pnode'], nodes[1])
+        self.assertEqual(info['snodes'], [nodes[2]])
+        self.assertEqual(3, rapi.GetNode(nodes[0])['pinst_cnt'])
+        self.assertEqual(7, sum(node['pinst_cnt']
+                                for node in rapi.GetNodes(bulk=True)))
+
+        self.assertRaises(GanetiApiError, rapi.GetInstance, 'missing')
+
+        # changes are answered with new jobs
+        job = rapi.StartupInstance(instances[0])
+        self.assertEqual(job + 1, rapi.ShutdownInstance(instances[0]))
+        self.assertEqual(job, rapi.GetJobStatus(job)['id'])
+
+    def test_calls(self):
+        rapi = self.rapi
+        rapi.GetInstance(rapi.GetInstances()[0])
+        rapi.GetInstance(rapi.GetInstances()[1])
+        self.assertEqual({'GET /2/instances': 2,
+                          'GET /2/instances/<name>': 2}, dict(rapi.calls))
+        self.assertEqual(4, rapi.total_calls)
+        rapi.reset()
+        self.assertEqual(0, rapi.total_calls)
+
+    def test_latency(self):
+        rapi = SimulatedRapi('sim.example.test', latency=0.02, jitter=0.01)
+        start = time()
+        rapi.GetInfo()
+        self.assertTrue(0.01 <= time() - start)
+
+
+class TestInstrumentation(SimpleTestCase):
+
+    def setUp(self):
+        self.rapi = SimulatedRapi('sim.example.test', instances=3)
+
+    def tearDown(self):
+        instrumentation.end_request()
+
+    def test_rapi(self):
+        rapi = self.rapi
+        # nothing is recorded outside of a request
+        rapi.GetInfo()
+        self.assertEqual(None, instrumentation.current())
+
+        stats = instrumentation.start_request()
+        for name in rapi.GetInstances():
+            rapi.GetInstance(name)
+        self.assertRaises(GanetiApiError, rapi.GetInstance, 'missing')
+        self.assertEqual(stats, instrumentation.end_request())
+
+        self.assertEqual(5, stats.rapi_calls)
+        data = stats.as_dict()['rapi']['clusters']['sim.example.test']
+        self.assertEqual(1, data['GET /2/instances']['calls'])
+        self.assertEqual(4, data['GET /2/instances/<name>']['calls'])
+        self.assertEqual(1, data['GET /2/instances/<name>']['errors'])
+
+    def test_rapi_map(self):
+        stats = instrumentation.start_request()
+        rapi_map(1, self.rapi.GetInstance, self.rapi.GetInstances())
+        instrumentation.end_request()
+        self.assertEqual(4, stats.rapi_calls)
+
+    def test_cache(self):
+        stats = instrumentation.start_request()
+        instrumentation.record_cache('vm_ids', True)
+        instrumentation.record_cache('vm_ids', False)
+        instrumentation.record_cache('vm_ids', True)
+        instrumentation.end_request()
+        self.assertEqual({'vm_ids': {'hits': 2, 'misses': 1}},
+                         stats.as_dict()['cache'])
+
+    def test_totals(self):
+        instrumentation.reset_totals()
+        for i in xrange(2):
+            stats = instrumentation.start_request()
+            self.rapi.GetInfo()
+            stats.add_queries([{'sql': '', 'time': '0.5'}])
+            instrumentation.end_request()
+            instrumentation.add_to_totals('view', stats)
+
+        totals = instrumentation.totals()['view']
+        self.assertEqual(2, totals['requests'])
+        self.assertEqual(2, totals['queries'])
+        self.assertEqual(1.0, totals['query_time'])
+        self.assertEqual(2, totals['rapi_calls'])
+        instrumentation.reset_totals()
+
+
+class TestMetrics(SimpleTestCase):
+
+    def setUp(self):
+        self.counter = metrics.Counter('test_total', 'Test counter.',
+                                       ('kind',))
+        self.histogram = metrics.Histogram('test_seconds', 'Test histogram.',
+                                           buckets=(1, 5))
+
+    def tearDown(self):
+        metrics.REGISTRY.remove(self.counter)
+        metrics.REGISTRY.remove(self.histogram)
+
+    def test_counter(self):
+        self.counter.inc(kind='a')
+        self.counter.inc(2, kind='a')
+        self.counter.inc(kind='b"')
+        self.assertEqual(3, self.counter.value(kind='a'))
+        self.assertEqual(['# HELP test_total Test counter.',
+                          '# TYPE test_total counter',
+                          'test_total{kind="a"} 3',
+                          'test_total{kind="b\\""} 1'],
+                         list(self.counter.lines()))
+
+    def test_histogram(self):
+        for value in (0.5, 1, 3, 10):
+            self.histogram.observe(value)
+        self.assertEqual(4, self.histogram.count())
+        self.assertEqual(['# HELP test_seconds Test histogram.',
+                          '# TYPE test_seconds histogram',
+                          'test_seconds_bucket{le="1"} 2',
+                          'test_seconds_bucket{le="5"} 3',
+                          'test_seconds_bucket{le="+Inf"} 4',
+                          'test_seconds_sum 14.5',
+                          'test_seconds_count 4'],
+                         list(self.histogram.lines()))
+
+    def test_rapi(self):
+        rapi = SimulatedRapi('metrics.example.test', instances=1)
+        labels = {'cluster': 'metrics.example.test',
+                  'request': 'GET /2/instances/<name>'}
+        count = metrics.RAPI_DURATION.count(**labels)
+        errors = metrics.RAPI_ERRORS.value(**labels)
+
+        rapi.GetInstance(rapi.GetInstances()[0])
+        self.assertRaises(GanetiApiError, rapi.GetInstance, 'missing')
+
+        self.assertEqual(count + 2, metrics.RAPI_DURATION.count(**labels))
+        self.assertEqual(errors + 1, metrics.RAPI_ERRORS.value(**labels))
+        self.assertTrue('gwm_rapi_request_duration_seconds_count{'
+                        'cluster="metrics.example.test",'
+                        'request="GET /2/instances/<name>"}'
+                        in metrics.export())
+
+
+class TestRapiRegistry(TestCase):
+
+    def setUp(self):
+        self.size = settings.RAPI_CLIENT_CACHE_SIZE
+
+    def tearDown(self):
+        settings.RAPI_CLIENT_CACHE_SIZE = self.size
+
+    def test_lru(self):
+        settings.RAPI_CLIENT_CACHE_SIZE = 2
+        registry = RapiRegistry()
+        registry.add(1, 'a', 'client a')
+        registry.add(2, 'b', 'client b')
+        self.assertEqual('client a', registry.get('a'))
+
+        # b is the least recently used
+        registry.add(3, 'c', 'client c')
+        self.assertEqual(2, len(registry))
+        self.assertEqual(None, registry.get('b'))
+        self.assertEqual({1: 'a', 3: 'c'}, registry.hashes)
+
+        # new credentials replace the old client
+        registry.add(1, 'd', 'client d')
+        self.assertFalse('a' in registry)
+        self.assertEqual('client d', registry.get('d'))
+
+        # a client cached first is kept
+        self.assertEqual('client d', registry.add(1, 'd', 'other client'))
+
+        registry.invalidate(1, 'd')
+        self.assertTrue('d' in registry)
+        registry.invalidate(1)
+        self.assertFalse('d' in registry)
+
+    def test_warm_and_invalidate(self):
+        cluster = Cluster.objects.create(hostname='warm.example.test',
+                                         slug='warm')
+        RAPI_REGISTRY.invalidate(cluster.pk)
+
+        warm_rapi_cache()
+        self.assertTrue(cluster.hash in RAPI_REGISTRY)
+        rapi = RAPI_REGISTRY.get(cluster.hash)
+        with self.assertNumQueries(0):
+            self.assertTrue(get_rapi(cluster.hash, cluster) is rapi)
+
+        # saving without changing the credentials keeps the client
+        cluster.description = 'warm cluster'
+        cluster.save()
+        self.assertTrue(get_rapi(cluster.hash, cluster) is rapi)
+
+        old = cluster.hash
+        cluster.username = 'tester'
+        cluster.password = 'secret'
+        cluster.save()
+        self.assertFalse(old in RAPI_REGISTRY)
+        self.assertFalse(get_rapi(cluster.hash, cluster) is rapi)
+
+        pk, hash = cluster.pk, cluster.hash
+        cluster.delete()
+        self.assertFalse(hash in RAPI_REGISTRY)
+        self.assertFalse(pk in RAPI_REGISTRY.hashes)
+
+    def test_warm_skips_broken_clusters(self):
+        """
+        A cluster whose client can't be created doesn't stop the others
+        from being warmed.
+        """
+        broken = Cluster.objects.create(hostname='broken.example.test',
+                                        slug='broken', username='tester')
+        cluster = Cluster.objects.create(hostname='warm.example.test',
+                                         slug='warm')
+        RAPI_REGISTRY.invalidate(broken.pk)
+        RAPI_REGISTRY.invalidate(cluster.pk)
+
+        create_rapi = utils._create_rapi
+
+        def _create_rapi(host, *args):
+            if host == broken.hostname:
+                raise GanetiApiError('no password')
+            return create_rapi(host, *args)
+
+        utils._create_rapi = _create_rapi
+        try:
+            warm_rapi_cache()
+        finally:
+            utils._create_rapi = create_rapi
+        self.assertFalse(broken.hash in RAPI_REGISTRY)
+        self.assertTrue(cluster.hash in RAPI_REGISTRY)
+
+
+class TestBulkUpdate(TestCase):
+
+    def test_bulk_update(self):
+        """
+        Rows are updated with their own values, a chunk per query.
+        """
+        cluster = Cluster.objects.create(hostname='bulk.example.test',
+                                         slug='bulk')
+        node = cluster.nodes.create(hostname='node.example.test')
+        vms = [VirtualMachine.objects.create(cluster=cluster,
+                                             hostname='vm%d.example.test' % i,
+                                             primary_node=node)
+               for i in range(3)]
+        # SQLite stores the decimal timestamps as floats, so keep it exact
+        mtime = datetime(2012, 1, 2, 3, 4, 5, 500000)
+        values = dict((vm.pk, {'ram': 128 * i, 'status': 'status%d' % i,
+                               'mtime': mtime, 'primary_node': None})
+                      for i, vm in enumerate(vms))
+
+        with self.assertNumQueries(2):
+            bulk_update(VirtualMachine, values, chunk_size=2)
+        to_datetime = VirtualMachine._meta.get_field('mtime').to_python
+        for i, vm in enumerate(vms):
+            row = VirtualMachine.objects.filter(pk=vm.pk) \
+                .values_list('ram', 'status', 'primary_node', 'mtime')[0]
+            self.assertEqual((128 * i, 'status%d' % i, None), row[:3])
+            self.assertEqual(mtime, to_datetime(row[3]))
+
+        with self.assertNumQueries(0):
+            bulk_update(VirtualMachine, {})
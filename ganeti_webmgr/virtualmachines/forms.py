@@ -27,6 +27,7 @@ from django.forms import (Form, BooleanField, CharField, ChoiceField,
 from django.http import HttpResponseRedirect
 # Per #6579, do not change this import without discussion.
 from django.utils import simplejson as json
+from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
 
 from object_log.models import LogItem
@@ -49,6 +50,7 @@ from ganeti_webmgr.ganeti_web.constants import (EMPTY_CHOICE_FIELD,
 from ganeti_webmgr.ganeti_web.views.generic import (LoginRequiredMixin,
                                                     PermissionRequiredMixin)
 from ganeti_webmgr.utils.fields import DataVolumeField, MACAddressField
+from ganeti_webmgr.clusters.forms import ClusterChoiceField
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.authentication.models import ClusterUser
 from ganeti_webmgr.nodes.models import Node
@@ -62,6 +64,17 @@ from ganeti_webmgr.utils.client import (REPLACE_DISK_AUTO, REPLACE_DISK_PRI,
 
 username_or_mtime = Q(username='') | Q(mtime__isnull=True)
 
+BULK_ACTION_CHOICES = (
+    ('startup', _('Start')),
+    ('shutdown', _('Shut down')),
+    ('shutdown_now', _('Shut down now')),
+    ('reboot', _('Reboot')),
+    ('migrate', _('Migrate')),
+)
+
+# Maximum number of virtual machines a bulk action may be performed on.
+MAX_BULK_ACTION = 500
+
 
 class VirtualMachineForm(forms.ModelForm):
     """
@@ -465,6 +478,54 @@ class KvmModifyVirtualMachineForm(PvmModifyVirtualMachineForm,
         self.fields['boot_order'].choices = self.boot_devices
 
 
+def modify_values(vm, balloon):
+    """
+    Return the current values of the fields of a VM's modify form, read from
+    its cached info.  All hypervisor parameters are included.
+
+    @param balloon  whether the cluster uses min/maxmem rather than memory
+    """
+    info = vm.info
+    values = dict(info['hvparams'])
+    values.update(vcpus=info['beparams']['vcpus'], os=info['os'],
+                  notes=vm.note_text)
+    if balloon:
+        values['maxmem'] = info['beparams']['maxmem']
+        values['minmem'] = info['beparams']['minmem']
+    else:
+        values['memory'] = info['beparams']['memory']
+    for i, link in enumerate(info['nic.links']):
+        values['nic_link_%s' % i] = link
+        values['nic_mac_%s' % i] = info['nic.macs'][i]
+    return values
+
+
+def modify_diff(vm, data, balloon):
+    """
+    Reduce the cleaned data of a modify form to the fields that differ from
+    the VM's cached info, which is all the modify flow keeps in the session.
+    The NIC counts are always kept.
+    """
+    values = modify_values(vm, balloon)
+    return dict((key, value) for key, value in data.items()
+                if key in ('nic_count', 'nic_count_original')
+                or key not in values or values[key] != value)
+
+
+def modify_data(vm, diff, balloon):
+    """
+    Complete a diff made by ``modify_diff()`` with the fields
+    ``ModifyConfirmForm`` always needs: the memory and CPUs checked against
+    quotas, and the link of every NIC.
+    """
+    values = modify_values(vm, balloon)
+    keys = ['vcpus', 'maxmem', 'minmem'] if balloon else ['vcpus', 'memory']
+    keys.extend('nic_link_%s' % i for i in xrange(diff['nic_count']))
+    data = dict((key, values[key]) for key in keys if key in values)
+    data.update(diff)
+    return data
+
+
 class ModifyConfirmForm(forms.Form):
 
     def clean(self):
@@ -520,6 +581,31 @@ class MigrateForm(forms.Form):
                                          "migration"))
 
 
+class BulkActionForm(forms.Form):
+    """ Form used for power actions on many Virtual Machines at once """
+    action = forms.ChoiceField(choices=BULK_ACTION_CHOICES)
+    vm = forms.Field(widget=forms.MultipleHiddenInput)
+    mode = forms.ChoiceField(choices=MODE_CHOICES, required=False)
+    cleanup = forms.BooleanField(initial=False, required=False)
+
+    def clean_vm(self):
+        try:
+            ids = set(int(pk) for pk in self.cleaned_data['vm'])
+        except (TypeError, ValueError):
+            raise ValidationError(_('Invalid virtual machine.'))
+        if len(ids) > MAX_BULK_ACTION:
+            raise ValidationError(_('At most %d virtual machines can be '
+                                    'selected.') % MAX_BULK_ACTION)
+        return ids
+
+    def clean(self):
+        data = self.cleaned_data
+        if data.get('action') == 'migrate' and not data.get('mode'):
+            msg = self.fields['mode'].error_messages['required']
+            self._errors['mode'] = self.error_class([force_unicode(msg)])
+        return data
+
+
 class RenameForm(forms.Form):
     """ form used for renaming a Virtual Machine """
     hostname = forms.CharField(label=_('Instance Name'), max_length=255,
@@ -638,15 +724,16 @@ class ReplaceDisksForm(forms.Form):
 
 
 class VMWizardClusterForm(Form):
-    cluster = ModelChoiceField(label=_('Cluster'),
-                               queryset=Cluster.objects.all(),
-                               empty_label=None)
+    cluster = ClusterChoiceField(label=_('Cluster'),
+                                 queryset=Cluster.objects.all(),
+                                 empty_label=None)
 
     class Media:
         css = {
             # I'm not quite sure if this is the proper way to use static
             'all': ('/static/css/vm_wizard/cluster_form.css',)
         }
+        js = ('/static/js/clusterAvailability.js',)
 
     def __init__(self, options=None, *args, **kwargs):
         super(VMWizardClusterForm, self).__init__(*args, **kwargs)
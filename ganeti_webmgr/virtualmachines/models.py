@@ -1,11 +1,10 @@
 
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 
 from ganeti_webmgr.clusters.models import CachedClusterObject
 from ganeti_webmgr.jobs.models import Job
 
-from ganeti_webmgr.ganeti_web import constants
 from ganeti_webmgr.utils import generate_random_password, get_rapi
 from ganeti_webmgr.utils.client import REPLACE_DISK_AUTO
 from ganeti_webmgr.utils.fields import LowerCaseCharField
@@ -97,32 +96,13 @@ class VirtualMachine(CachedClusterObject):
         if self.id is None:
             self.cluster_hash = self.cluster.hash
 
-        info_ = self.info
-        if info_:
-            found = False
-            remove = []
-            if self.cluster.username:
-                for tag in info_['tags']:
-                    # Update owner Tag. Make sure the tag is set to the owner
-                    #  that is set in webmgr.
-                    if tag.startswith(constants.OWNER_TAG):
-                        id = int(tag[len(constants.OWNER_TAG):])
-                        # Since there is no 'update tag' delete old tag and
-                        #  replace with tag containing correct owner id.
-                        if id == self.owner_id:
-                            found = True
-                        else:
-                            remove.append(tag)
-                if remove:
-                    self.rapi.DeleteInstanceTags(self.hostname, remove)
-                    for tag in remove:
-                        info_['tags'].remove(tag)
-                if self.owner_id and not found:
-                    tag = '%s%s' % (constants.OWNER_TAG, self.owner_id)
-                    self.rapi.AddInstanceTags(self.hostname, [tag])
-                    self.info['tags'].append(tag)
-
-        super(VirtualMachine, self).save(*args, **kwargs)
+        # The owner's ResourceUsage is adjusted by a post_save receiver and
+        # must be committed along with this row.
+        if transaction.is_managed():
+            super(VirtualMachine, self).save(*args, **kwargs)
+        else:
+            with transaction.commit_on_success():
+                super(VirtualMachine, self).save(*args, **kwargs)
 
     @models.permalink
     def get_absolute_url(self):
@@ -142,10 +122,15 @@ class VirtualMachine(CachedClusterObject):
         return self.status == 'running'
 
     @classmethod
-    def parse_persistent_info(cls, info):
+    def parse_persistent_info(cls, info, nodes=None):
         """
         Loads all values from cached info, included persistent properties that
         are stored in the database
+
+        @param nodes  dictionary mapping the hostnames of the cluster's nodes
+                      to their ids.  The nodes are then returned as ids,
+                      suitable for bulk updates, instead of being looked up
+                      one at a time.
         """
         from ganeti_webmgr.nodes.models import Node
         data = super(VirtualMachine, cls).parse_persistent_info(info)
@@ -162,6 +147,13 @@ class VirtualMachine(CachedClusterObject):
         data['status'] = info['status']
 
         primary = info['pnode']
+        secondary = info['snodes'][0] if info['snodes'] else None
+        if nodes is not None:
+            # nodes not created yet are left out of the map
+            data['primary_node'] = nodes.get(primary)
+            data['secondary_node'] = nodes.get(secondary)
+            return data
+
         if primary:
             try:
                 data['primary_node'] = Node.objects.get(hostname=primary)
@@ -171,9 +163,7 @@ class VirtualMachine(CachedClusterObject):
         else:
             data['primary_node'] = None
 
-        secondary = info['snodes']
-        if len(secondary):
-            secondary = secondary[0]
+        if secondary:
             try:
                 data['secondary_node'] = Node.objects.get(hostname=secondary)
             except Node.DoesNotExist:
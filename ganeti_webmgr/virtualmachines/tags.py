@@ -0,0 +1,139 @@
+# Copyright (C) 2012 Oregon State University et al.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+"""
+Reconciling the owner tags of instances, a cluster at a time.
+
+The owner of a virtual machine is recorded in Ganeti as an owner tag on its
+instance.  Saving a virtual machine used to fix the tags of its instance
+with up to two RAPI requests, even when the save only stored a refreshed
+cache.  ``reconcile_owner_tags()`` instead finds the virtual machines of a
+cluster whose cached tags disagree with their owner, fixes their instances
+concurrently, and updates the cached tags in a single transaction.  It is
+run by the ``reconciletags`` management command.
+"""
+
+import cPickle
+
+from ganeti_webmgr.clusters.models import Cluster
+from ganeti_webmgr.ganeti_web.constants import OWNER_TAG
+from ganeti_webmgr.utils import (commit_on_success_unless_managed, get_rapi,
+                                 rapi_map)
+
+from .models import VirtualMachine
+
+
+def owner_tag_changes(tags, owner_id):
+    """
+    Compare the tags of an instance with the owner of its virtual machine.
+
+    Malformed owner tags, whose owner isn't an id, are removed as well.
+
+    @returns a tuple of (the owner tags to remove, the owner tag to add or
+             None)
+    """
+    remove = []
+    found = False
+    for tag in tags:
+        if tag.startswith(OWNER_TAG):
+            try:
+                tagged = int(tag[len(OWNER_TAG):])
+            except ValueError:
+                tagged = None
+            if tagged is not None and tagged == owner_id:
+                found = True
+            else:
+                remove.append(tag)
+    add = '%s%s' % (OWNER_TAG, owner_id) if owner_id and not found else None
+    return remove, add
+
+
+def mismatched_owner_tags(cluster_id):
+    """
+    Find the virtual machines of a cluster whose cached tags disagree with
+    their owner.  Virtual machines being deleted or created from templates
+    are left out.
+
+    @returns a list of (vm id, hostname, time the info was cached, info,
+             tags to remove, tag to add)
+    """
+    vms = VirtualMachine.objects \
+        .filter(cluster=cluster_id, pending_delete=False,
+                template__isnull=True) \
+        .exclude(serialized_info='') \
+        .values_list('id', 'hostname', 'owner', 'cached', 'serialized_info')
+
+    # values_list() returns the stored timestamps
+    to_datetime = VirtualMachine._meta.get_field('cached').to_python
+    mismatched = []
+    for pk, hostname, owner_id, cached, serialized_info in vms.iterator():
+        info = cPickle.loads(str(serialized_info))
+        if not info:
+            continue
+        remove, add = owner_tag_changes(info['tags'], owner_id)
+        if remove or add:
+            mismatched.append((pk, hostname, to_datetime(cached), info,
+                               remove, add))
+    return mismatched
+
+
+def reconcile_owner_tags(cluster_id, dry_run=False):
+    """
+    Fix the owner tags of the instances of a cluster.
+
+    The instances found by ``mismatched_owner_tags()`` are fixed
+    concurrently, and the cached info of those fixed is updated in one
+    transaction.  Info refreshed since it was scanned is left alone, as it
+    is newer than the scanned info.  Clusters without credentials can't be
+    tagged and are skipped.
+
+    @param dry_run  only find the instances to fix
+    @returns a tuple of (the number of instances fixed, or to fix, the
+             number of instances which couldn't be fixed)
+    """
+    (hash, username), = Cluster.objects.filter(pk=cluster_id) \
+        .values_list('hash', 'username')
+    if not username:
+        return 0, 0
+
+    mismatched = mismatched_owner_tags(cluster_id)
+    if dry_run or not mismatched:
+        return len(mismatched), 0
+
+    rapi = get_rapi(hash, cluster_id)
+
+    def fix(item):
+        pk, hostname, cached, info, remove, add = item
+        if remove:
+            rapi.DeleteInstanceTags(hostname, remove)
+        if add:
+            rapi.AddInstanceTags(hostname, [add])
+
+    failed = 0
+    with commit_on_success_unless_managed():
+        for item, result, error in rapi_map(cluster_id, fix, mismatched):
+            if error is not None:
+                # left for the next run
+                failed += 1
+                continue
+            pk, hostname, cached, info, remove, add = item
+            info['tags'] = [tag for tag in info['tags'] if tag not in remove]
+            if add:
+                info['tags'].append(add)
+            VirtualMachine.objects.filter(pk=pk, cached=cached) \
+                .update(serialized_info=cPickle.dumps(info))
+    return len(mismatched) - failed, failed
@@ -16,14 +16,18 @@
 # USA.
 
 
+import cPickle
 from datetime import datetime
 
+from django.conf import settings
 from django.test import TestCase
 
 from ganeti_webmgr.utils.proxy.constants import (INSTANCE, JOB, JOB_RUNNING,
                                                  JOB_DELETE_SUCCESS)
 
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
+from ganeti_webmgr.virtualmachines import tags as tags_module
+from ganeti_webmgr.virtualmachines.tags import reconcile_owner_tags
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.authentication.models import ClusterUser
 from ganeti_webmgr.jobs.models import Job
@@ -51,6 +55,14 @@ class VirtualMachineTestCaseMixin(object):
 
 class TestVirtualMachineModel(TestCase, VirtualMachineTestCaseMixin):
 
+    def setUp(self):
+        # jobs are polled again right away
+        self.job_refresh_interval = settings.JOB_REFRESH_INTERVAL
+        settings.JOB_REFRESH_INTERVAL = 0
+
+    def tearDown(self):
+        settings.JOB_REFRESH_INTERVAL = self.job_refresh_interval
+
     def test_save(self):
         """
         Test saving a VirtualMachine
@@ -119,35 +131,94 @@ class TestVirtualMachineModel(TestCase, VirtualMachineTestCaseMixin):
 
     def test_update_owner_tag(self):
         """
-        Test changing owner
+        Test reconciling owner tags after changing owner
+
+        Verifies:
+            * saving a VM doesn't send any tag requests
+            * owner tags are added, replaced and removed by the reconciler
+            * instances with matching tags are left alone
+            * malformed owner tags are removed
+            * info refreshed while tags are fixed is kept
         """
         vm, cluster = self.create_virtual_machine()
+        rapi = cluster.rapi
 
         owner0 = ClusterUser(id=74, name='owner0')
         owner1 = ClusterUser(id=21, name='owner1')
         owner0.save()
         owner1.save()
+        tag0 = '%s%s' % (constants.OWNER_TAG, owner0.id)
+        tag1 = '%s%s' % (constants.OWNER_TAG, owner1.id)
+
+        def set_owner(owner):
+            saved = VirtualMachine.objects.get(pk=vm.pk)
+            saved.owner = owner
+            saved.save()
+
+        def tags():
+            info = VirtualMachine.objects.filter(pk=vm.pk) \
+                .values_list('serialized_info', flat=True)[0]
+            return cPickle.loads(str(info))['tags']
 
         # no owner
         vm.refresh()
-        self.assertEqual([], vm.info['tags'])
+        self.assertEqual([], tags())
+        self.assertEqual((0, 0), reconcile_owner_tags(cluster.id))
 
         # setting owner
-        vm.owner = owner0
-        vm.save()
-        self.assertEqual(['%s%s' % (constants.OWNER_TAG, owner0.id)],
-                         vm.info['tags'])
+        rapi.AddInstanceTags.reset()
+        set_owner(owner0)
+        rapi.AddInstanceTags.assertNotCalled(self)
+        self.assertEqual((1, 0), reconcile_owner_tags(cluster.id,
+                                                      dry_run=True))
+        rapi.AddInstanceTags.assertNotCalled(self)
+        self.assertEqual((1, 0), reconcile_owner_tags(cluster.id))
+        rapi.AddInstanceTags.assertCalled(self, vm.hostname, [tag0])
+        self.assertEqual([tag0], tags())
+        self.assertEqual((0, 0), reconcile_owner_tags(cluster.id))
 
         # changing owner
-        vm.owner = owner1
-        vm.save()
-        self.assertEqual(['%s%s' % (constants.OWNER_TAG, owner1.id)],
-                         vm.info['tags'])
+        rapi.DeleteInstanceTags.reset()
+        set_owner(owner1)
+        self.assertEqual((1, 0), reconcile_owner_tags(cluster.id))
+        rapi.DeleteInstanceTags.assertCalled(self, vm.hostname, [tag0])
+        rapi.AddInstanceTags.assertCalled(self, vm.hostname, [tag1])
+        self.assertEqual([tag1], tags())
 
         # setting owner to none
-        vm.owner = None
-        vm.save()
-        self.assertEqual([], vm.info['tags'])
+        set_owner(None)
+        self.assertEqual((1, 0), reconcile_owner_tags(cluster.id))
+        self.assertEqual([], tags())
+
+        # malformed owner tags are removed
+        malformed = '%sadmin' % constants.OWNER_TAG
+        info = VirtualMachine.objects.get(pk=vm.pk).info
+        info['tags'] = [malformed]
+        VirtualMachine.objects.filter(pk=vm.pk) \
+            .update(serialized_info=cPickle.dumps(info))
+        rapi.DeleteInstanceTags.reset()
+        self.assertEqual((1, 0), reconcile_owner_tags(cluster.id))
+        rapi.DeleteInstanceTags.assertCalled(self, vm.hostname, [malformed])
+        self.assertEqual([], tags())
+
+        # info refreshed after the scan isn't overwritten
+        set_owner(owner0)
+        scan = tags_module.mismatched_owner_tags
+
+        def mismatched_owner_tags(cluster_id):
+            mismatched = scan(cluster_id)
+            refreshed = dict(info, tags=[tag0, 'refreshed'])
+            VirtualMachine.objects.filter(pk=vm.pk).update(
+                serialized_info=cPickle.dumps(refreshed),
+                cached=datetime.now())
+            return mismatched
+
+        tags_module.mismatched_owner_tags = mismatched_owner_tags
+        try:
+            self.assertEqual((1, 0), reconcile_owner_tags(cluster.id))
+        finally:
+            tags_module.mismatched_owner_tags = scan
+        self.assertEqual([tag0, 'refreshed'], tags())
 
         owner0.delete()
         owner1.delete()
@@ -1,6 +1,12 @@
+from __future__ import absolute_import
+
+from django.utils import simplejson as json
+
 from ...models import VirtualMachine
 from ganeti_webmgr.jobs.models import Job
+from ganeti_webmgr.utils.client import GanetiApiError
 
+from object_log.models import LogItem
 from object_permissions import grant
 
 from .base import TestVirtualMachineViewsBase
@@ -83,3 +89,100 @@ class TestVirtualMachineActions(TestVirtualMachineViewsBase):
         data = {'mode': 'live'}
         self.validate_post_only_url(url, args, data, users=authorized,
                                     get_allowed=True)
+
+    def test_view_bulk(self):
+        """
+        Tests performing an action on many virtual machines at once
+        """
+        url = '/vms/bulk/'
+        vm2 = VirtualMachine.objects.create(cluster=self.cluster,
+                                            hostname='vm2.example.bak')
+        data = {'action': 'reboot', 'vm': [self.vm.id, vm2.id]}
+
+        def post(user, data):
+            self.assertTrue(self.c.login(username=user.username,
+                                         password='secret'))
+            response = self.c.post(url, data)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('application/json', response['content-type'])
+            return json.loads(response.content)
+
+        def reset():
+            VirtualMachine.objects.all().update(last_job=None)
+            Job.objects.all().delete()
+            LogItem.objects.all().delete()
+
+        # anonymous user, and GET
+        response = self.c.post(url, data, follow=True)
+        self.assertTemplateUsed(response, 'registration/login.html')
+        self.assertTrue(self.c.login(username=self.superuser.username,
+                                     password='secret'))
+        self.assertEqual(405, self.c.get(url, data).status_code)
+
+        # invalid form
+        content = post(self.superuser, {'action': 'explode', 'vm': 'x'})
+        self.assertTrue('action' in content)
+        self.assertTrue('vm' in content)
+        content = post(self.superuser, {'action': 'migrate',
+                                        'vm': [self.vm.id]})
+        self.assertTrue('mode' in content)
+
+        # unauthorized user
+        content = post(self.unauthorized, data)
+        self.assertEqual(2, len(content))
+        self.assertTrue(all(r['error'] and r['job_id'] is None
+                            for r in content))
+        self.assertFalse(Job.objects.exists())
+
+        # vm admin may only act on their vm
+        content = dict((r['hostname'], r) for r in post(self.vm_admin, data))
+        self.assertEqual(1, content[self.vm.hostname]['job_id'])
+        self.assertEqual(None, content[self.vm.hostname]['error'])
+        self.assertTrue(content[vm2.hostname]['error'])
+        self.assertEqual(1, Job.objects.count())
+        reset()
+
+        # cluster admin may act on every vm of the cluster
+        content = post(self.cluster_admin, data)
+        self.assertTrue(all(r['job_id'] == 1 for r in content))
+        self.assertEqual(2, Job.objects.count())
+        for vm in VirtualMachine.objects.filter(pk__in=data['vm']) \
+                .values('id', 'last_job__object_id', 'ignore_cache'):
+            self.assertEqual(vm['id'], vm['last_job__object_id'])
+            self.assertTrue(vm['ignore_cache'])
+        self.assertEqual(
+            set([self.vm.hostname, vm2.hostname]),
+            set(item.data['hostname'] for item in
+                LogItem.objects.filter(action='VM_REBOOT')))
+        reset()
+
+        # migrating requires permissions on the cluster
+        data = {'action': 'migrate', 'mode': 'live',
+                'vm': [self.vm.id, vm2.id]}
+        content = post(self.vm_admin, data)
+        self.assertTrue(all(r['error'] for r in content))
+        content = post(self.cluster_migrate, data)
+        self.assertTrue(all(r['job_id'] == 1 for r in content))
+        reset()
+
+        # owners may not exceed their quota
+        profile = self.vm_admin.get_profile()
+        self.cluster.set_quota(profile, dict(ram=200, disk=2000,
+                                             virtual_cpus=10))
+        self.vm_admin.grant('power', vm2)
+        VirtualMachine.objects.filter(pk__in=[self.vm.id, vm2.id]) \
+            .update(owner=profile, ram=128, virtual_cpus=1)
+        content = post(self.vm_admin, {'action': 'startup',
+                                       'vm': [self.vm.id, vm2.id]})
+        self.assertEqual(1, len([r for r in content if r['job_id']]))
+        self.assertEqual(1, len([r for r in content if r['error'] and
+                                 'enough RAM' in r['error']]))
+        reset()
+
+        # errors from ganeti are reported per vm
+        msg = "SIMULATING_AN_ERROR"
+        self.vm.rapi.error = GanetiApiError(msg)
+        content = post(self.superuser, {'action': 'shutdown',
+                                        'vm': [self.vm.id, vm2.id]})
+        self.assertTrue(all(r['error'] == msg for r in content))
+        self.assertFalse(Job.objects.exists())
@@ -7,6 +7,7 @@ from ganeti_webmgr.utils.proxy.constants import JOB_RUNNING
 from .base import TestVirtualMachineViewsBase
 from ...models import VirtualMachine
 from ganeti_webmgr.jobs.models import Job
+from ganeti_webmgr.virtualmachines.forms import modify_values
 
 __all__ = ['TestVirtualMachineEditViews',
            'TestVirtualMachineDeleteViews',
@@ -528,6 +529,58 @@ class TestVirtualMachineEditViews(TestVirtualMachineViewsBase):
         self.c.logout()
 
 
+    def test_view_modify_diff(self):
+        """
+        Test that the modify flow keeps only the changes in the session
+
+        Verifies:
+            * the session holds the changed fields only
+            * the confirm page is rendered without fetching operating systems
+            * only the changed hvparams are submitted
+        """
+        args = (self.cluster.slug, self.vm.hostname)
+        url = '/cluster/%s/%s/edit' % args
+        rapi = self.cluster.rapi
+
+        # loading the VM caches its info
+        vm = VirtualMachine.objects.get(pk=self.vm.pk)
+        data = modify_values(vm, False)
+        data.update(nic_count=1, vcpus=data['vcpus'] + 1,
+                    os='image+debian-osgeo')
+        self.assertTrue(self.c.login(username=self.superuser.username,
+                                     password='secret'))
+        response = self.c.post(url, data)
+        self.assertEqual(302, response.status_code)
+        changes = self.c.session['edit_form']
+        self.assertEqual(data['vcpus'], changes['vcpus'])
+        self.assertEqual(data['os'], changes['os'])
+        for key in ('memory', 'acpi', 'nic_link_0', 'nic_mac_0'):
+            self.assertFalse(key in changes, key)
+
+        # going back to edit merges the changes into the cached info
+        response = self.c.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(data['vcpus'], response.context['form'].data['vcpus'])
+        self.assertEqual(data['kernel_path'],
+                         response.context['form'].data['kernel_path'])
+
+        rapi.GetOperatingSystems.reset()
+        response = self.c.get(url + '/confirm')
+        self.assertEqual(200, response.status_code)
+        rapi.GetOperatingSystems.assertNotCalled(self)
+        rapi_dict = response.context['form'].fields['rapi_dict'].initial
+
+        rapi.ModifyInstance.reset()
+        response = self.c.post(url + '/confirm',
+                               {'rapi_dict': rapi_dict, 'save': True})
+        self.assertEqual(302, response.status_code)
+        rapi.ModifyInstance.assertCalled(self)
+        kwargs = rapi.ModifyInstance.calls[0][1]
+        self.assertEqual(data['os'], kwargs['os_name'])
+        self.assertFalse('acpi' in kwargs['hvparams'])
+        self.assertEqual(data['vcpus'], kwargs['beparams']['vcpus'])
+        self.assertFalse('edit_form' in self.c.session)
+
 class TestVirtualMachineDeleteViews(TestVirtualMachineViewsBase):
     """
     Test the virtual machine deletion view in a variety of ways.
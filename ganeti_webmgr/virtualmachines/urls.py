@@ -10,6 +10,8 @@ urlpatterns = patterns(
 
     url(r'^vms/$', VMListView.as_view(), name="virtualmachine-list"),
 
+    url(r'^vms/bulk/?$', 'bulk', name="virtualmachine-bulk"),
+
     url(r'^%s/?$' % vm_prefix, 'detail', name="instance-detail"),
 
     url(r'^vm/(?P<id>\d+)/jobs/status/?$', 'job_status',
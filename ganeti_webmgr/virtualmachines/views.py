@@ -46,6 +46,7 @@ from object_permissions.signals import (view_add_user, view_edit_user,
 from object_permissions.views.permissions import view_users, view_permissions
 
 
+from ganeti_webmgr.ganeti_web.backend.actions import bulk_action
 from ganeti_webmgr.ganeti_web.backend.queries import vm_qs_for_users
 from ganeti_webmgr.ganeti_web.caps import has_shutdown_timeout, has_balloonmem
 from ganeti_webmgr.ganeti_web.templatetags.webmgr_tags import render_storage
@@ -57,7 +58,8 @@ from ganeti_webmgr.ganeti_web.views.tables import BaseVMTable
 
 from .forms import (KvmModifyVirtualMachineForm, PvmModifyVirtualMachineForm,
                     HvmModifyVirtualMachineForm, ModifyConfirmForm,
-                    MigrateForm, RenameForm, ChangeOwnerForm, ReplaceDisksForm)
+                    MigrateForm, RenameForm, ChangeOwnerForm, ReplaceDisksForm,
+                    BulkActionForm, modify_data, modify_diff, modify_values)
 
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.jobs.models import Job
@@ -436,6 +438,27 @@ def migrate(request, cluster_slug, instance):
                               context_instance=RequestContext(request))
 
 
+@require_POST
+@login_required
+def bulk(request):
+    """
+    Perform a power or migrate action on many virtual machines at once.
+
+    Returns the result for each virtual machine: the id of the job submitted
+    for it, or the reason it was skipped.
+    """
+    form = BulkActionForm(request.POST)
+    if not form.is_valid():
+        return HttpResponse(json.dumps(form.errors),
+                            mimetype='application/json')
+
+    data = form.cleaned_data
+    results = bulk_action(request.user, data['action'], data['vm'],
+                          mode=data['mode'] or 'live',
+                          cleanup=data['cleanup'])
+    return HttpResponse(json.dumps(results), mimetype='application/json')
+
+
 @login_required
 def replace_disks(request, cluster_slug, instance):
     """
@@ -651,6 +674,18 @@ def object_log(request, cluster_slug, instance, rest=False):
         return list_for_object(request, vm)
 
 
+def modify_label(fields, key):
+    """
+    Return the label of a modify form field.  NIC fields are added by the
+    form's constructor and aren't among ``fields``.
+    """
+    if key.startswith('nic_link_'):
+        return _('NIC/%s Link' % key[len('nic_link_'):])
+    elif key.startswith('nic_mac_'):
+        return _('NIC/%s Mac' % key[len('nic_mac_'):])
+    return fields[key].label
+
+
 @login_required
 def modify(request, cluster_slug, instance):
     vm, cluster = get_vm_and_cluster_or_404(cluster_slug, instance)
@@ -688,8 +723,9 @@ def modify(request, cluster_slug, instance):
         form.vm = vm
         form.cluster = cluster
         if form.is_valid():
-            data = form.cleaned_data
-            request.session['edit_form'] = data
+            # only the changes are kept, see modify_diff()
+            request.session['edit_form'] = modify_diff(
+                vm, form.cleaned_data, has_balloonmem(cluster))
             request.session['edit_vm'] = vm.id
             return HttpResponseRedirect(
                 reverse('instance-modify-confirm',
@@ -699,7 +735,9 @@ def modify(request, cluster_slug, instance):
     elif request.method == 'GET':
         if 'edit_form' in request.session \
                 and vm.id == request.session['edit_vm']:
-            form = hv_form(vm, request.session['edit_form'])
+            data = modify_values(vm, has_balloonmem(cluster))
+            data.update(request.session['edit_form'])
+            form = hv_form(vm, data)
         else:
             form = hv_form(vm)
 
@@ -763,14 +801,17 @@ def modify_confirm(request, cluster_slug, instance):
                     beparams['minmem'] = rapi_dict.pop('minmem')
                 else:
                     beparams['memory'] = rapi_dict.pop('memory')
-                os_name = rapi_dict.pop('os')
-                notes = rapi_dict.pop('notes')
+                # the OS, notes and hvparams are only there if they changed
+                kwargs = {}
+                if 'os' in rapi_dict:
+                    kwargs['os_name'] = rapi_dict.pop('os')
+                notes = rapi_dict.pop('notes', vm.note_text)
                 job_id = cluster.rapi.ModifyInstance(
                     instance,
                     nics=nics,
-                    os_name=os_name,
                     hvparams=rapi_dict,
-                    beparams=beparams)
+                    beparams=beparams,
+                    **kwargs)
                 # Create job and update message on virtual machine detail page
                 job = Job.objects.create(job_id=job_id,
                                          obj=vm,
@@ -780,6 +821,7 @@ def modify_confirm(request, cluster_slug, instance):
                                              note_text=notes)
                 # log information about modifying this instance
                 log_action('EDIT', user, vm)
+                request.session.pop('edit_form', None)
                 if 'reboot' in request.POST and vm.info['status'] == 'running':
                     if power:
                         # Reboot the vm
@@ -811,36 +853,20 @@ def modify_confirm(request, cluster_slug, instance):
     if 'edit_form' not in request.session:
         return HttpResponseBadRequest('Incorrect Session Data')
 
-    data = session['edit_form']
-    info = vm.info
-    hvparams = info['hvparams']
-
-    old_set = dict(
-        vcpus=info['beparams']['vcpus'],
-        os=info['os'],
-        notes=vm.note_text
-    )
-    if has_balloonmem(cluster):
-        old_set['maxmem'] = info['beparams']['maxmem']
-        old_set['minmem'] = info['beparams']['minmem']
-    else:
-        old_set['memory'] = info['beparams']['memory']
-    nic_count = len(info['nic.links'])
-    for i in xrange(nic_count):
-        old_set['nic_link_%s' % i] = info['nic.links'][i]
-        old_set['nic_mac_%s' % i] = info['nic.macs'][i]
-
-    # Add hvparams to the old_set
-    old_set.update(hvparams)
+    balloon = has_balloonmem(cluster)
+    changes = session['edit_form']
+    data = modify_data(vm, changes, balloon)
+    old_set = modify_values(vm, balloon)
 
+    # labels are read from the form class, without building a form
+    fields = hv_form.base_fields
     instance_diff = {}
-    fields = hv_form(vm, data).fields
-    for key in data.keys():
+    for key in changes.keys():
         if key in ['memory', 'maxmem', 'minmem']:
             diff = compare(render_storage(old_set[key]),
-                           render_storage(data[key]))
+                           render_storage(changes[key]))
         elif key == 'os':
-            oses = os_prettify([old_set[key], data[key]])
+            oses = os_prettify([old_set[key], changes[key]])
             if len(oses) > 1:
                 """
                 XXX - Special case for a cluster with two different types of
@@ -866,18 +892,12 @@ def modify_confirm(request, cluster_slug, instance):
             continue
         elif key not in old_set.keys():
             diff = ""
-            instance_diff[fields[key].label] = _('Added')
+            instance_diff[modify_label(fields, key)] = _('Added')
         else:
-            diff = compare(old_set[key], data[key])
+            diff = compare(old_set[key], changes[key])
 
         if diff != "":
-            label = fields[key].label
-            instance_diff[label] = diff
-
-    # remove mac if it has not changed
-    for i in xrange(nic_count):
-        if fields['nic_mac_%s' % i].label not in instance_diff:
-            del data['nic_mac_%s' % i]
+            instance_diff[modify_label(fields, key)] = diff
 
     # Repopulate form with changed values
     form.fields['rapi_dict'] = CharField(widget=HiddenInput,
@@ -1018,13 +1038,14 @@ def reparent(request, cluster_slug, instance):
 @login_required
 def job_status(request, id, rest=False):
     """
-    Return a list of basic info for running jobs.
+    Return a list of basic info for running jobs.  Only the summary of each
+    job is sent; see ``Job.status_info()``.
     """
     ct = ContentType.objects.get_for_model(VirtualMachine)
     jobs = Job.objects.filter(status__in=("error", "running", "waiting"),
                               content_type=ct,
                               object_id=id).order_by('job_id')
-    jobs = [j.info for j in jobs]
+    jobs = [j.status_info() for j in jobs]
 
     if rest:
         return jobs
@@ -15,10 +15,14 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
 # USA.
 
-from django.forms import Form, CharField, ModelChoiceField, ValidationError
+from django.conf import settings
+from django.forms import (Form, CharField, IntegerField, ModelChoiceField,
+                          ValidationError)
 from django.utils.translation import ugettext_lazy as _
 
 from ganeti_webmgr.authentication.models import ClusterUser
+from ganeti_webmgr.ganeti_web.backend.templates import batch_hostnames
+from ganeti_webmgr.virtualmachines.models import VirtualMachine
 
 
 class VirtualMachineTemplateCopyForm(Form):
@@ -46,6 +50,95 @@ class VMInstanceFromTemplate(Form):
         return hostname
 
 
+class VMInstancesFromTemplate(Form):
+    owner = ModelChoiceField(label=_('Owner'),
+                             queryset=ClusterUser.objects.all(),
+                             empty_label=None)
+    hostname_pattern = CharField(
+        label=_('Instance Names'), max_length=255,
+        help_text=_("A run of '#' is replaced by the number of each "
+                    "instance, e.g. web##.example.org"))
+    count = IntegerField(label=_('Number of Instances'), min_value=1,
+                         max_value=settings.MAX_BATCH_INSTANCES)
+    start = IntegerField(label=_('First Number'), min_value=0, initial=1)
+
+    def __init__(self, cluster, template=None, *args, **kwargs):
+        super(VMInstancesFromTemplate, self).__init__(*args, **kwargs)
+        self.cluster = cluster
+        self.template = template
+
+    def clean_hostname_pattern(self):
+        pattern = self.cleaned_data.get('hostname_pattern')
+
+        # Spaces in hostname will always break things.
+        if ' ' in pattern:
+            raise ValidationError(_("Hostnames cannot contain spaces."))
+        if pattern.count('#') == 0:
+            raise ValidationError(_("The pattern must contain a run of '#' "
+                                    "for the instance number."))
+        return pattern
+
+    def clean(self):
+        data = self.cleaned_data
+        pattern = data.get('hostname_pattern')
+        count = data.get('count')
+        start = data.get('start')
+
+        if pattern and count and start is not None:
+            try:
+                hostnames = batch_hostnames(pattern, count, start)
+            except ValueError:
+                msg = _("The pattern must contain a single run of '#'.")
+                self._errors['hostname_pattern'] = self.error_class([msg])
+                del data['hostname_pattern']
+                return data
+
+            used = VirtualMachine.objects \
+                .filter(cluster=self.cluster, hostname__in=hostnames) \
+                .values_list('hostname', flat=True)
+            if used:
+                raise ValidationError(
+                    _("Hostnames already in use for this cluster: %s")
+                    % ', '.join(sorted(used)))
+            data['hostnames'] = hostnames
+
+            owner = data.get('owner')
+            if owner is not None and self.template is not None:
+                self.check_quota(owner, count)
+
+        return data
+
+    def check_quota(self, owner, count):
+        """
+        Check that the owner's quota on the cluster leaves room for ``count``
+        instances of the template.  RAM and virtual CPUs only count towards
+        the quota when the instances are started.
+        """
+        quota = self.cluster.get_quota(owner)
+        if not quota.values():
+            return
+        used = owner.used_resources(self.cluster, only_running=True)
+        template = self.template
+        disk = sum(int(disk['size']) for disk in template.disks)
+
+        errors = []
+        if (template.start and quota['ram'] is not None and
+                used['ram'] + count * template.memory > quota['ram']):
+            errors.append(_("Owner does not have enough ram remaining on "
+                            "this cluster for this many instances."))
+        if quota['disk'] and used['disk'] + count * disk > quota['disk']:
+            errors.append(_("Owner does not have enough diskspace remaining "
+                            "on this cluster for this many instances."))
+        if (template.start and quota['virtual_cpus'] is not None and
+                used['virtual_cpus'] + count * template.vcpus >
+                quota['virtual_cpus']):
+            errors.append(_("Owner does not have enough virtual cpus "
+                            "remaining on this cluster for this many "
+                            "instances."))
+        if errors:
+            raise ValidationError(errors)
+
+
 class TemplateFromVMInstance(Form):
     template_name = CharField(label=_("Template Name"), max_length=255)
 
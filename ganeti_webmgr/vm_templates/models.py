@@ -1,3 +1,4 @@
+import cPickle
 import time
 from django.core.validators import MinValueValidator
 from django.utils.translation import ugettext_lazy as _
@@ -102,3 +103,87 @@ class VirtualMachineTemplate(models.Model):
             # of microseconds since the epoch; I figure that it'll work out
             # alright.
             self.template_name = str(int(time.time() * (10 ** 6)))
+
+
+class InstanceBatch(models.Model):
+    """
+    A group of virtual machines created together from one template.
+
+    The creation jobs of the whole batch are tracked together so that its
+    progress can be reported as a single unit.
+    """
+
+    template = models.ForeignKey(VirtualMachineTemplate,
+                                 related_name="batches", null=True,
+                                 on_delete=models.SET_NULL)
+    cluster = models.ForeignKey("clusters.Cluster",
+                                related_name="instance_batches")
+    owner = models.ForeignKey("authentication.ClusterUser",
+                              related_name="instance_batches", null=True,
+                              on_delete=models.SET_NULL)
+    hostname_pattern = models.CharField(max_length=255)
+    count = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    jobs = models.ManyToManyField("jobs.Job", related_name="+")
+    # (hostname, error message) pairs for instances Ganeti refused to create
+    failures = PickleField(default=list)
+
+    # job statuses which will not change anymore
+    FINISHED = ('success', 'error', 'canceled', 'unknown')
+
+    def __unicode__(self):
+        return u'%s (%d)' % (self.hostname_pattern, self.count)
+
+    @models.permalink
+    def get_absolute_url(self):
+        return 'instance-batch-detail', (), {'cluster_slug': self.cluster.slug,
+                                             'batch_id': self.pk}
+
+    def progress(self):
+        """
+        Summarize the batch with a single query on its jobs.
+
+        @returns a dict with the number of instances in each state
+        """
+        counts = dict(self.jobs.order_by().values_list('status')
+                      .annotate(models.Count('id')))
+        done = counts.get('success', 0)
+        errors = (counts.get('error', 0) + counts.get('canceled', 0) +
+                  len(self.failures))
+        finished = done + errors + counts.get('unknown', 0)
+        return {
+            'total': self.count,
+            'success': done,
+            'error': errors,
+            'pending': self.count - finished,
+            'finished': finished == self.count,
+        }
+
+    def refresh(self):
+        """
+        Update the status of the batch's unfinished jobs from Ganeti.
+
+        Jobs are queried concurrently, and the job rows are updated without
+        creating ``Job`` instances, which would query Ganeti once more per job.
+        """
+        from ganeti_webmgr.jobs.models import Job
+        from ganeti_webmgr.utils import rapi_map
+
+        jobs = self.jobs.exclude(status__in=self.FINISHED) \
+            .values_list('id', 'job_id')
+        if not jobs:
+            return
+
+        rapi = self.cluster.rapi
+        results = rapi_map(self.cluster_id,
+                           lambda job: rapi.GetJobStatus(job[1]), jobs)
+        for (pk, job_id), info, error in results:
+            if getattr(error, 'code', None) == 404:
+                # the job was archived, its outcome is unknown
+                Job.objects.filter(pk=pk).update(status='unknown')
+                continue
+            if error is not None or not Job.valid_job(info):
+                continue
+            values = Job.parse_persistent_info(info)
+            values['serialized_info'] = cPickle.dumps(info)
+            Job.objects.filter(pk=pk).update(**values)
@@ -25,9 +25,13 @@ from ganeti_webmgr.django_test_tools.views import ViewTestMixin
 
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
-from ganeti_webmgr.vm_templates.models import VirtualMachineTemplate
+from ganeti_webmgr.vm_templates.models import (InstanceBatch,
+                                               VirtualMachineTemplate)
+from ganeti_webmgr.ganeti_web.backend.templates import template_to_instances
 
-from ganeti_webmgr.utils.proxy.constants import INSTANCE
+from ganeti_webmgr.utils.client import GanetiApiError
+from ganeti_webmgr.utils.proxy.constants import (INSTANCE, JOB,
+                                                 JOB_RUNNING)
 
 
 __all__ = ('TestTemplateViews', )
@@ -84,6 +88,7 @@ class TestTemplateViews(TestCase, ViewTestMixin, UserTestMixin):
         self.c = Client()
 
     def tearDown(self):
+        InstanceBatch.objects.all().delete()
         VirtualMachineTemplate.objects.all().delete()
         VirtualMachine.objects.all().delete()
         Cluster.objects.all().delete()
@@ -227,3 +232,143 @@ class TestTemplateViews(TestCase, ViewTestMixin, UserTestMixin):
 
         self.assert_403(url, args,
                         users=[self.unauthorized])
+
+    def test_create_instances_from_template(self):
+        """
+        Test creating a batch of instances from a template
+
+        Verifies:
+            * Only authorized users are able to access view
+            * VMs and jobs are created for every hostname
+            * Hostnames already in use are rejected
+            * Failed hostnames are recorded on the batch
+            * Batches which don't fit the owner's quota are rejected
+        """
+        self.template.memory = 512
+        self.template.vcpus = 1
+        self.template.start = True
+        self.template.save()
+
+        url = '/cluster/%s/template/%s/vms/'
+        args = (self.cluster.slug, self.template)
+        self.assert_standard_fails(url, args)
+
+        # GET
+        self.assert_200(url, args,
+                        users=[self.superuser, self.create_vm,
+                               self.cluster_admin],
+                        template='ganeti/vm_template/to_vms.html')
+
+        # POST
+        owner = self.create_vm.get_profile()
+        data = dict(owner=owner.pk, hostname_pattern='web##.example.test',
+                    count=3, start=1)
+        self.assertTrue(self.c.login(username=self.create_vm.username,
+                                     password='secret'))
+        response = self.c.post(url % args, data)
+        batch = InstanceBatch.objects.get()
+        self.assertRedirects(response, batch.get_absolute_url())
+        self.assertEqual(3, batch.count)
+        self.assertEqual([], batch.failures)
+
+        hostnames = ['web01.example.test', 'web02.example.test',
+                     'web03.example.test']
+        vms = VirtualMachine.objects.filter(hostname__in=hostnames)
+        self.assertEqual(3, len(vms))
+        for vm in vms:
+            self.assertEqual(owner.pk, vm.owner_id)
+            self.assertEqual(self.cluster.hash, vm.cluster_hash)
+            self.assertEqual(vm.pk, vm.last_job.object_id)
+            self.assertTrue(self.create_vm.has_perm('admin', vm))
+        self.assertEqual(set(vm.last_job_id for vm in vms),
+                         set(batch.jobs.values_list('id', flat=True)))
+
+        # hostnames in use
+        data['start'] = 3
+        response = self.c.post(url % args, data)
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, 'ganeti/vm_template/to_vms.html')
+        self.assertTrue(response.context['form'].errors)
+        self.assertEqual(1, InstanceBatch.objects.count())
+
+        # Ganeti refuses one of the hostnames
+        rapi = self.cluster.rapi
+        create = rapi.CreateInstance
+
+        def refuse(mode, hostname, *args, **kwargs):
+            if hostname == 'web05.example.test':
+                raise GanetiApiError('Name already in use', 400)
+            return create(mode, hostname, *args, **kwargs)
+        rapi.CreateInstance = refuse
+        try:
+            data['start'] = 4
+            self.c.post(url % args, data)
+        finally:
+            rapi.CreateInstance = create
+        batch = InstanceBatch.objects.latest('pk')
+        self.assertEqual([('web05.example.test', 'Name already in use')],
+                         batch.failures)
+        self.assertEqual(2, batch.jobs.count())
+        self.assertFalse(VirtualMachine.objects
+                         .filter(hostname='web05.example.test').exists())
+        progress = batch.progress()
+        self.assertEqual(1, progress['error'])
+        self.assertEqual(2, progress['pending'])
+        self.assertFalse(progress['finished'])
+
+        # over quota: three started instances need 1536 MB of ram
+        self.cluster.set_quota(owner, dict(ram=1024, disk=None,
+                                           virtual_cpus=None))
+        data['start'] = 10
+        response = self.c.post(url % args, data)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.context['form'].non_field_errors())
+        self.assertEqual(2, InstanceBatch.objects.count())
+
+    def test_batch_views(self):
+        """
+        Test the progress views of a batch of instances
+
+        Verifies:
+            * Only authorized users are able to access views
+            * Job statuses are refreshed from Ganeti
+        """
+        self.template.memory = 512
+        self.template.vcpus = 1
+        self.template.save()
+
+        owner = self.create_vm.get_profile()
+        template = VirtualMachineTemplate.objects.get(pk=self.template.pk)
+        batch, vms = template_to_instances(
+            template, ['web01.example.test', 'web02.example.test'],
+            owner, pattern='web##.example.test')
+
+        url = '/cluster/%s/batch/%s/'
+        args = (self.cluster.slug, batch.pk)
+        self.assert_standard_fails(url, args)
+        self.assert_200(url, args,
+                        users=[self.superuser, self.create_vm,
+                               self.cluster_admin],
+                        template='ganeti/vm_template/batch.html')
+
+        url = '/cluster/%s/batch/%s/status/'
+        self.assert_standard_fails(url, args)
+        self.assert_200(url, args, users=[self.create_vm],
+                        mime='application/json')
+        self.assertEqual(set(['running']),
+                         set(batch.jobs.values_list('status', flat=True)))
+
+        # finished jobs are no longer queried
+        status = self.cluster.rapi.GetJobStatus
+        status.reset()
+        status.response = JOB
+        try:
+            batch.refresh()
+            self.assertEqual(2, len(status.calls))
+            self.assertEqual({'total': 2, 'success': 2, 'error': 0,
+                              'pending': 0, 'finished': True},
+                             batch.progress())
+            batch.refresh()
+            self.assertEqual(2, len(status.calls))
+        finally:
+            status.response = JOB_RUNNING
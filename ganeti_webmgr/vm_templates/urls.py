@@ -1,6 +1,6 @@
 from django.conf.urls.defaults import patterns, url
 from .views import (TemplateFromVMInstanceView, VMInstanceFromTemplateView,
-                    TemplateListView)
+                    VMInstancesFromTemplateView, TemplateListView)
 
 from ganeti_webmgr.virtualmachines.forms import vm_wizard
 from ganeti_webmgr.virtualmachines.urls import vm_prefix
@@ -8,6 +8,7 @@ from ganeti_webmgr.clusters.urls import cluster
 
 template = '(?P<template>[^/]+)'
 template_prefix = '%s/template/%s' % (cluster, template)
+batch_prefix = '%s/batch/(?P<batch_id>\d+)' % cluster
 
 
 urlpatterns = patterns(
@@ -30,6 +31,15 @@ urlpatterns = patterns(
     url(r'^%s/vm/?$' % template_prefix, VMInstanceFromTemplateView.as_view(),
         name='instance-create-from-template'),
 
+    url(r'^%s/vms/?$' % template_prefix, VMInstancesFromTemplateView.as_view(),
+        name='instances-create-from-template'),
+
+    url(r'^%s/?$' % batch_prefix, 'batch_detail',
+        name='instance-batch-detail'),
+
+    url(r'^%s/status/?$' % batch_prefix, 'batch_status',
+        name='instance-batch-status'),
+
     url(r'^%s/template/?$' % vm_prefix, TemplateFromVMInstanceView.as_view(),
         name='template-create-from-instance'),
 )
@@ -23,16 +23,23 @@ from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 from django.views.decorators.http import require_http_methods
 from django.views.generic.edit import FormView
+# Per #6579, do not change this import without discussion.
+from django.utils import simplejson as json
+
+from object_log.models import LogItem
+log_action = LogItem.objects.log_action
 
 from django_tables2 import SingleTableView
 
 from ganeti_webmgr.ganeti_web.backend.templates import (instance_to_template,
-                                                        template_to_instance)
+                                                        template_to_instance,
+                                                        template_to_instances)
 from .forms import (VirtualMachineTemplateCopyForm, VMInstanceFromTemplate,
-                    TemplateFromVMInstance)
+                    VMInstancesFromTemplate, TemplateFromVMInstance)
 from ganeti_webmgr.clusters.models import Cluster
 from ganeti_webmgr.virtualmachines.models import VirtualMachine
-from ganeti_webmgr.vm_templates.models import VirtualMachineTemplate
+from ganeti_webmgr.vm_templates.models import (InstanceBatch,
+                                               VirtualMachineTemplate)
 
 from ganeti_webmgr.ganeti_web.views.generic import (LoginRequiredMixin,
                                                     PaginationMixin, NO_PRIVS)
@@ -161,6 +168,82 @@ class VMInstanceFromTemplateView(LoginRequiredMixin, FormView):
         return context
 
 
+class VMInstancesFromTemplateView(VMInstanceFromTemplateView):
+    """
+    Create several virtual machine instances from a template at once.
+    """
+
+    form_class = VMInstancesFromTemplate
+    template_name = "ganeti/vm_template/to_vms.html"
+
+    def get_form_kwargs(self):
+        kwargs = super(VMInstancesFromTemplateView, self).get_form_kwargs()
+        self._get_stuff()
+        kwargs['cluster'] = self.cluster
+        kwargs['template'] = self.template
+        return kwargs
+
+    def form_valid(self, form):
+        """
+        Create the new VMs and then redirect to the batch's progress page.
+        """
+
+        data = form.cleaned_data
+        batch, vms = template_to_instances(self.template, data['hostnames'],
+                                           data['owner'],
+                                           pattern=data['hostname_pattern'])
+        for vm in vms:
+            log_action('CREATE', self.request.user, vm)
+
+        return HttpResponseRedirect(batch.get_absolute_url())
+
+
+def _get_batch(request, cluster_slug, batch_id):
+    batch = get_object_or_404(InstanceBatch, pk=batch_id,
+                              cluster__slug=cluster_slug)
+    user = request.user
+    if not (user.is_superuser or
+            user.has_any_perms(batch.cluster, ['admin', 'create_vm'])):
+        raise PermissionDenied(NO_PRIVS)
+    return batch
+
+
+@login_required
+def batch_detail(request, cluster_slug, batch_id):
+    """
+    Show the progress of a batch of VMs created from a template.
+    """
+    batch = _get_batch(request, cluster_slug, batch_id)
+
+    jobs = batch.jobs.values_list('object_id', 'job_id', 'status')
+    hostnames = dict(VirtualMachine.objects
+                     .filter(pk__in=[job[0] for job in jobs])
+                     .values_list('id', 'hostname'))
+    instances = sorted((hostnames[vm_id], job_id, status)
+                       for vm_id, job_id, status in jobs
+                       if vm_id in hostnames)
+
+    return render_to_response(
+        'ganeti/vm_template/batch.html',
+        {'batch': batch,
+         'cluster': batch.cluster,
+         'instances': instances,
+         'progress': batch.progress()},
+        context_instance=RequestContext(request)
+    )
+
+
+@login_required
+def batch_status(request, cluster_slug, batch_id):
+    """
+    Refresh the unfinished jobs of a batch and return its progress.
+    """
+    batch = _get_batch(request, cluster_slug, batch_id)
+    batch.refresh()
+    return HttpResponse(json.dumps(batch.progress()),
+                        mimetype='application/json')
+
+
 @login_required
 def detail(request, cluster_slug, template):
     user = request.user